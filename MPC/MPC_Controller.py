@@ -1,15 +1,24 @@
+import numpy as np
 from scipy.optimize import minimize
 from utils import *
 
 class MPCController:
-    def __init__(self, parameters, steps_ahead=10, dt=0.1):
+    def __init__(self, parameters, steps_ahead=10, dt=0.1, speed_weight=50.0, smoothness_weight=2.0,
+                 limit_weight=100.0, max_lateral_accel=3.0):
         self.steps_ahead = steps_ahead
         self.dt = dt
-        print(parameters["mass"])
+        # Cost weights of the low speed and throttle change penalties
+        self.speed_weight = speed_weight
+        self.smoothness_weight = smoothness_weight
+        # With a road preview: cost weight of exceeding the speed limit, and the
+        # lateral acceleration (m/s^2) capping the speed in curves
+        self.limit_weight = limit_weight
+        self.max_lateral_accel = max_lateral_accel
         self.bounds = [(parameters["max_deceleration"], parameters["max_acceleration"])] * steps_ahead + [(0, 1)] * steps_ahead  # Acceleration >= 0, Throttle 0 to 1
         self.parameters = parameters
 
-    def objective(self, control_vars, init_state):
+    def objective(self, control_vars, init_state, grades=None, limits=None):
+        # grades (radians) and limits (m/s) are the road preview of each step, flat and unlimited without
         cost = 0
         v, accel = init_state[0], init_state[1]  # Initial speed and acceleration
 
@@ -24,36 +33,65 @@ class MPCController:
             distance = v * self.dt  # Calculate distance traveled in this step
             total_distance += distance  # Add to total distance
 
-            F_total = calculate_forces(v, accel, self.parameters)
+            grade = grades[t] if grades is not None else 0.0
+            F_total = calculate_forces(v, accel, self.parameters, grade)
             power = F_total * v
             energy_cost = power * self.dt  # Energy consumption
 
             # Penalty for very low speeds
-            min_speed_penalty = 50 / max(v, 0.1)
+            min_speed_penalty = self.speed_weight / max(v, 0.1)
 
             # Throttle change penalty
-            throttle_change_cost = abs(throttle - (control_vars[self.steps_ahead + t - 1] if t > 0 else 0.5)) * 2
+            throttle_change_cost = abs(throttle - (control_vars[self.steps_ahead + t - 1] if t > 0 else 0.5)) * self.smoothness_weight
 
             # Add costs for this distance
             cost += energy_cost + min_speed_penalty + throttle_change_cost
 
+            # Penalty for exceeding the speed limit
+            if limits is not None:
+                cost += self.limit_weight * max(v - limits[t], 0.0) ** 2
+
         # Normalize the total cost by the distance traveled to get cost per distance
         cost_per_distance = cost / total_distance
         return cost_per_distance
 
 
-    def control(self, vehicle):
-        # Initial state (speed, acceleration) from the Vehicle class
-        init_state = (vehicle.get_speed(), vehicle.get_acceleration())
+    def snapshot(self, vehicle):
+        # Initial state (speed, acceleration) and current throttle from the Vehicle class
+        return (vehicle.get_speed(), vehicle.get_acceleration()), vehicle.get_throttle()
+
+    def road_preview(self, preview):
+        # Grades and speed limits of the horizon from a RouteProfile preview
+        # (grade, speed limit, curvature per step), the curves lower the limit
+        # (steps, 3), or (vehicles, steps, 3) for a fleet
+        preview = np.asarray(preview, dtype=float)
+        curve_limits = np.sqrt(self.max_lateral_accel / np.maximum(np.abs(preview[..., 2]), 1e-6))
+        return preview[..., 0], np.minimum(preview[..., 1], curve_limits)
 
+    def optimize(self, init_state, throttle, grades=None, limits=None):
+        # SLSQP result over the horizon, its x holds the accelerations then the throttles
         # Initial guess for control variables: moderate acceleration and throttle
-        control_vars = [vehicle.get_acceleration() + 0.02] * self.steps_ahead + [vehicle.get_throttle() + 0.05] * self.steps_ahead
+        control_vars = [init_state[1] + 0.02] * self.steps_ahead + [throttle + 0.05] * self.steps_ahead
 
         # Run the optimization
-        result = minimize(self.objective, control_vars, args=(init_state,), bounds=self.bounds, method='SLSQP')
+        return minimize(self.objective, control_vars, args=(init_state, grades, limits), bounds=self.bounds, method='SLSQP')
+
+    def solve(self, init_state, throttle):
+        # Optimized throttle sequence over the horizon, None if the optimization failed
+        # init_state is (speed, acceleration), or (speed, acceleration, preview) to plan on the road ahead
+        grades, limits = None, None
+        if len(init_state) > 2 and init_state[2] is not None:
+            grades, limits = self.road_preview(init_state[2])
+        result = self.optimize(init_state, throttle, grades, limits)
 
         # Check optimization result
         if result.success:
-            return result.x[self.steps_ahead]  # Return the first optimized throttle value
+            return result.x[self.steps_ahead:]
+        return None
+
+    def control(self, vehicle):
+        throttles = self.solve(*self.snapshot(vehicle))
+        if throttles is not None:
+            return throttles[0]  # Return the first optimized throttle value
         else:
             return 0.5
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""
+Asynchronous MPC solver.
+
+Solving the MPC inline stalls the control loop for as long as SLSQP takes.
+AsyncMPCController runs the solves of any controller with
+solve(init_state, throttle) -> throttle sequence (or None) and a dt on a
+worker thread, or a worker process to stay clear of the GIL, while the loop
+only hands over state snapshots and reads back the latest plan:
+
+    mpc = AsyncMPCController(MPCController(parameters, steps_ahead=10, dt=0.1))
+    while True:
+        ...
+        mpc.submit(*controller.snapshot(vehicle), timestamp=now)
+        throttle = mpc.throttle(now)  # Never blocks, None until a plan exists
+    mpc.close()
+
+There is at most one solve in flight. A snapshot submitted while the worker
+is busy waits for it, replacing any older waiting snapshot, so the next solve
+always starts from the freshest state. The published plan is stamped with the
+time of its snapshot: when it is read later than that (the solve ran late),
+throttle() interpolates along the planned sequence at the elapsed time
+instead of replaying its first value, and gives up on plans older than the
+horizon.
+"""
+
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+# Planned throttle sequence, one value per dt from timestamp, and how long it took
+Plan = collections.namedtuple('Plan', ['throttles', 'timestamp', 'solve_time'])
+
+_worker_controller = None
+
+
+def _init_worker(controller):
+    global _worker_controller
+    _worker_controller = controller
+
+
+def _timed_solve(controller, init_state, throttle):
+    start = time.time()
+    throttles = controller.solve(init_state, throttle)
+    return throttles, time.time() - start
+
+
+def _solve_in_worker(init_state, throttle):
+    return _timed_solve(_worker_controller, init_state, throttle)
+
+
+class AsyncMPCController(object):
+    """Runs the solves of an MPC controller in the background"""
+
+    def __init__(self, controller, processes=False, max_staleness=None):
+        """
+        Constructor method. With processes the controller is copied to a
+        worker process, it has to be picklable. Plans older than max_staleness
+        seconds are not used, by default once their horizon has passed.
+        """
+        self.dt = controller.dt
+        self.steps_ahead = controller.steps_ahead
+        self.max_staleness = max_staleness if max_staleness is not None else controller.steps_ahead * controller.dt
+        self.solves = 0  # Plans published
+        self.failures = 0  # Solves that did not converge or raised
+        self.dropped = 0  # Snapshots replaced by a newer one before being solved
+        self.staleness = None  # Age of the plan at the last throttle() call
+        self._plan = None
+        self._finished = None  # Snapshot timestamp of the last solve, converged or not
+        self._future = None
+        self._pending = None
+        # The done callback runs in the caller when the solve already finished
+        self._lock = threading.RLock()
+        self._published = threading.Condition(self._lock)
+        if processes:
+            self._executor = ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(controller,))
+            self._solve = _solve_in_worker
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            self._solve = lambda init_state, throttle: _timed_solve(controller, init_state, throttle)
+
+    @property
+    def plan(self):
+        """Latest published Plan, None before the first solve"""
+        return self._plan
+
+    @property
+    def busy(self):
+        """True while a solve is running"""
+        return self._future is not None
+
+    def submit(self, init_state, throttle, timestamp):
+        """Hands over the state captured at timestamp (s), never blocks"""
+        snapshot = (init_state, throttle, timestamp)
+        with self._lock:
+            if self._future is None:
+                self._start(snapshot)
+            else:
+                if self._pending is not None:
+                    self.dropped += 1
+                self._pending = snapshot
+
+    def _start(self, snapshot):
+        init_state, throttle, timestamp = snapshot
+        future = self._executor.submit(self._solve, init_state, throttle)
+        self._future = future
+        future.add_done_callback(lambda x: self._done(x, timestamp))
+
+    def _done(self, future, timestamp):
+        try:
+            throttles, solve_time = future.result()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('MPC solve failed')
+            throttles, solve_time = None, None
+        with self._lock:
+            if throttles is None:
+                self.failures += 1
+            elif self._plan is None or timestamp >= self._plan.timestamp:
+                self._plan = Plan(np.asarray(throttles, dtype=float), timestamp, solve_time)
+                self.solves += 1
+            if self._finished is None or timestamp > self._finished:
+                self._finished = timestamp
+            self._published.notify_all()
+            self._future = None
+            if self._pending is not None:
+                snapshot, self._pending = self._pending, None
+                self._start(snapshot)
+
+    def wait_for(self, timestamp, timeout):
+        """
+        Waits up to timeout seconds for the solve of a snapshot taken at
+        timestamp or later, returns False if it did not publish a plan in time
+        """
+        def finished():
+            return self._finished is not None and self._finished >= timestamp
+        with self._published:
+            self._published.wait_for(finished, timeout)
+            return self._plan is not None and self._plan.timestamp >= timestamp
+
+    def throttle(self, now, default=None):
+        """
+        Throttle the latest plan gives for time now (s, same clock as the
+        timestamps), default if there is no plan or it is too old
+        """
+        plan = self._plan
+        if plan is None:
+            self.staleness = None
+            return default
+        self.staleness = now - plan.timestamp
+        if self.staleness > self.max_staleness:
+            return default
+        step = max(0.0, self.staleness) / self.dt
+        return float(np.interp(step, np.arange(len(plan.throttles)), plan.throttles))
+
+    def close(self):
+        """Stops the worker, a solve in flight is abandoned"""
+        with self._lock:
+            self._pending = None
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,107 @@
+"""
+Closed-loop MPC throttle.
+
+ClosedLoopMPC applies the MPC throttle to the vehicle instead of only
+predicting it. The steering (and the braking) of the agent or of the driver
+is kept, only the throttle is replaced:
+
+    closed_loop = ClosedLoopMPC(AsyncMPCController(controller), controller.snapshot, budget=0.05)
+    ...
+    control = agent.run_step()
+    closed_loop.apply(vehicle, control, simulation_time)
+
+Every call captures the vehicle state, hands it to the asynchronous solver
+and waits at most budget seconds for the plan solved from it. When the solve
+does not make it in time the fallback policy decides the throttle:
+
+    plan  the latest older plan, interpolated at the elapsed time, while it
+          covers it, else the base throttle
+    base  the throttle of the agent / driver
+    hold  the last applied throttle
+
+While the base control brakes, it is applied as is. The latency from the
+state capture to apply_control() and where the throttle came from are kept
+in last (merged into the collected rows) and summarized by summary().
+"""
+
+import time
+
+import numpy as np
+
+FALLBACKS = ('plan', 'base', 'hold')
+
+
+class ClosedLoopMPC(object):
+    """Applies the MPC throttle under a per-tick compute budget"""
+
+    def __init__(self, mpc, snapshot, budget=0.05, fallback='plan'):
+        """
+        Constructor method. mpc is an AsyncMPCController, snapshot(vehicle)
+        returns the (init_state, throttle) its controller solves from and
+        budget is in seconds.
+        """
+        if fallback not in FALLBACKS:
+            raise ValueError('unknown fallback %r, expected one of %s' % (fallback, ', '.join(FALLBACKS)))
+        self.mpc = mpc
+        self.snapshot = snapshot
+        self.budget = budget
+        self.fallback = fallback
+        self.last = {}  # Record of the last applied control
+        self.latencies = []  # s, state capture to apply_control()
+        self.sources = {}  # Source -> number of ticks
+        self._throttle = None
+
+    def apply(self, vehicle, control, timestamp):
+        """
+        Applies control to vehicle with the MPC throttle, timestamp being the
+        simulation time (s) of the state
+        """
+        captured = time.time()
+        init_state, throttle = self.snapshot(vehicle)
+        self.mpc.submit(init_state, throttle, timestamp)
+        base = control.throttle
+        mpc_throttle = None
+        if control.brake > 0.0:
+            source = 'brake'
+        elif self.mpc.wait_for(timestamp, self.budget):
+            source, mpc_throttle = 'mpc', self.mpc.throttle(timestamp)
+        elif self.fallback == 'plan':
+            source, mpc_throttle = 'plan', self.mpc.throttle(timestamp)
+        elif self.fallback == 'hold':
+            source, mpc_throttle = 'hold', self._throttle
+        else:
+            source = 'base'
+        if mpc_throttle is None and source in ('plan', 'hold'):
+            # Nothing to fall back on yet
+            source = 'base'
+        applied = base if mpc_throttle is None else min(max(mpc_throttle, 0.0), 1.0)
+        vehicle.apply_control(type(control)(
+            throttle=applied, steer=control.steer, brake=control.brake,
+            hand_brake=control.hand_brake, reverse=control.reverse,
+            manual_gear_shift=control.manual_gear_shift, gear=control.gear))
+        latency = time.time() - captured
+        self._throttle = applied
+        self.latencies.append(latency)
+        self.sources[source] = self.sources.get(source, 0) + 1
+        plan = self.mpc.plan
+        self.last = {
+            'Base Throttle': round(base, 3),
+            'MPC Throttle': round(applied, 3),
+            'MPC Source': source,
+            'MPC Latency (ms)': round(1e3 * latency, 2),
+            'MPC Plan Age (s)': round(timestamp - plan.timestamp, 3) if plan is not None else None}
+        return applied
+
+    def summary(self):
+        """Latency and throttle source statistics"""
+        if not self.latencies:
+            return 'MPC: no control applied'
+        latencies = 1e3 * np.asarray(self.latencies)
+        total = float(len(latencies))
+        sources = ', '.join('%s %.1f%%' % (x, 100.0 * n / total) for x, n in sorted(self.sources.items()))
+        return 'MPC: %d ticks, latency mean %.1f ms, p95 %.1f ms, max %.1f ms (budget %.0f ms), %s' % (
+            total, latencies.mean(), np.percentile(latencies, 95), latencies.max(), 1e3 * self.budget, sources)
+
+    def close(self):
+        """Stops the solver"""
+        self.mpc.close()
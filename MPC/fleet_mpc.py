@@ -0,0 +1,219 @@
+"""
+Fleet-batched MPC.
+
+FleetMPCController plans the throttle of N vehicles in one optimization
+instead of N SLSQP calls. The cost of each vehicle is the MPCController
+objective (energy per distance plus the low speed, throttle change and speed
+limit penalties); the vehicles are independent, so minimizing the sum of
+their costs over an (N, 2 * steps_ahead) array of accelerations and
+throttles solves every one of them. The objective and its gradient are
+computed for the whole fleet at once with NumPy and handed to L-BFGS-B:
+
+    fleet = FleetMPCController(parameters, steps_ahead=10, dt=0.1)
+    throttles = fleet.solve_fleet(speeds, accelerations, throttles, previews=None)  # (N, steps_ahead)
+
+The throttle change penalty |x| is smoothed to sqrt(x^2 + eps^2) so the
+gradient exists everywhere; with eps = 1e-3 it differs from MPCController by
+at most eps per step. The convergence test of L-BFGS-B is relative to the
+summed cost, so its tolerance shrinks with N to hold for every vehicle.
+
+The objective is not convex. Plans reaching the 0.1 m/s floor of the low
+speed penalty, where its gradient vanishes, can stall in a worse local
+minimum than SLSQP finds, so those vehicles are re-solved on their own with
+MPCController's SLSQP and keep the cheaper plan; so are all the vehicles
+when the fleet solve fails. A vehicle whose own solve fails too gets a NaN
+row, the others are unaffected. Every solve is warm started from the
+previous plan of the same fleet shifted by one step. A FleetMPCController is
+also a plant_sim policy, planning all the episodes of a batch together.
+
+    python MPC/fleet_mpc.py --vehicles 50   # fleet solve vs one SLSQP per vehicle, with the cost gaps
+"""
+
+import argparse
+import time
+
+import numpy as np
+from scipy.optimize import minimize
+
+from MPC_Controller import MPCController
+from plant_sim import CONFIG_FILE
+from utils import read_config_file
+
+
+class FleetMPCController(MPCController):
+    """MPCController solving the horizons of many vehicles together"""
+
+    def __init__(self, parameters, steps_ahead=10, dt=0.1, speed_weight=50.0, smoothness_weight=2.0,
+                 limit_weight=100.0, max_lateral_accel=3.0, smoothing=1e-3, fallback=0.5):
+        """Constructor method, fallback is the throttle returned by __call__() when a solve fails"""
+        MPCController.__init__(self, parameters, steps_ahead, dt, speed_weight, smoothness_weight,
+                               limit_weight, max_lateral_accel)
+        self.smoothing = smoothing
+        self.fallback = fallback
+        self.iterations = 0  # L-BFGS-B iterations of the last solve
+        self.polished = 0  # Vehicles re-solved on their own in the last solve
+        self.plans = None  # (N, 2 * steps_ahead) accelerations and throttles of the last solve
+
+    def fleet_objective(self, control_vars, speeds, grades, limits):
+        """
+        Sum of the costs of the vehicles and its gradient. control_vars is the
+        flattened (N, 2 * steps_ahead) array, speeds (N,) and grades, limits
+        (N, steps_ahead) arrays, limits None without speed limits.
+        """
+        p = self.parameters
+        dt, steps = self.dt, self.steps_ahead
+        x = control_vars.reshape(len(speeds), 2 * steps)
+        accel, throttle = x[:, :steps], x[:, steps:]
+        v = speeds[:, None] + dt * np.cumsum(accel, axis=1)
+        distance = dt * v.sum(axis=1)
+
+        # Energy, F(v, a, grade) * v * dt per step
+        drag = 0.5 * p["air_density"] * p["frontal_area"] * p["drag_coefficient"]
+        static = p["mass"] * p["g"] * (p["rolling_coefficient"] * np.cos(grades) + np.sin(grades))
+        force = p["mass"] * accel + static + drag * v ** 2
+        cost = (force * v * dt).sum(axis=1)
+        grad_v = (p["mass"] * accel + static + 3.0 * drag * v ** 2) * dt
+        grad_a = p["mass"] * v * dt
+
+        # Low speed penalty
+        slow = v > 0.1
+        cost += (self.speed_weight / np.maximum(v, 0.1)).sum(axis=1)
+        grad_v -= np.where(slow, self.speed_weight / np.where(slow, v, 1.0) ** 2, 0.0)
+
+        # Throttle change penalty, from 0.5 like MPCController
+        change = np.diff(throttle, axis=1, prepend=0.5)
+        smooth = np.sqrt(change ** 2 + self.smoothing ** 2)
+        cost += self.smoothness_weight * smooth.sum(axis=1)
+        slope = self.smoothness_weight * change / smooth
+        grad_throttle = slope.copy()
+        grad_throttle[:, :-1] -= slope[:, 1:]
+
+        # Speed limit penalty
+        if limits is not None:
+            excess = np.maximum(v - limits, 0.0)
+            cost += self.limit_weight * (excess ** 2).sum(axis=1)
+            grad_v += 2.0 * self.limit_weight * excess
+
+        # v[t] depends on the accelerations up to t, distance on all of them
+        grad_a += dt * np.cumsum(grad_v[:, ::-1], axis=1)[:, ::-1]
+        grad_distance = dt * dt * np.arange(steps, 0, -1)
+        # Gradient of cost / distance
+        value = cost / distance
+        grad_a = (grad_a - value[:, None] * grad_distance) / distance[:, None]
+        grad_throttle = grad_throttle / distance[:, None]
+        return value.sum(), np.hstack([grad_a, grad_throttle]).ravel()
+
+    def _initial_guess(self, accelerations, throttles):
+        steps = self.steps_ahead
+        guess = np.hstack([np.repeat(accelerations[:, None] + 0.02, steps, axis=1),
+                           np.repeat(throttles[:, None] + 0.05, steps, axis=1)])
+        previous = self.plans
+        if previous is not None and previous.shape == guess.shape:
+            # Plan of the previous solve shifted by one step, repeating its last values
+            planned = np.isfinite(previous).all(axis=1)
+            for half in (slice(0, steps), slice(steps, 2 * steps)):
+                shifted = previous[planned, half]
+                guess[planned, half] = np.hstack([shifted[:, 1:], shifted[:, -1:]])
+        low, high = zip(*self.bounds)
+        return np.clip(guess, low, high)
+
+    def solve_fleet(self, speeds, accelerations, throttles, previews=None):
+        """
+        Optimized throttle sequences, (N, steps_ahead), of N vehicles from
+        their speeds, accelerations and throttles, with NaN rows for the
+        vehicles whose optimization failed. previews is an
+        (N, steps_ahead, 3) array of RouteProfile previews to plan on the road
+        ahead.
+        """
+        speeds = np.asarray(speeds, dtype=float)
+        accelerations = np.asarray(accelerations, dtype=float)
+        throttles = np.asarray(throttles, dtype=float)
+        n, steps = len(speeds), self.steps_ahead
+        grades, limits = np.zeros((n, steps)), None
+        if previews is not None:
+            grades, limits = self.road_preview(previews)
+        guess = self._initial_guess(accelerations, throttles)
+        # The default ftol of L-BFGS-B, per vehicle
+        result = minimize(self.fleet_objective, guess.ravel(), args=(speeds, grades, limits), jac=True,
+                          bounds=self.bounds * n, method='L-BFGS-B',
+                          options={'ftol': 2.2e-9 / n, 'maxiter': 15000})
+        self.iterations = result.nit
+        plans = result.x.reshape(n, 2 * steps).copy()
+        if result.success:
+            planned_speeds = speeds[:, None] + self.dt * np.cumsum(plans[:, :steps], axis=1)
+            retry = (planned_speeds <= 0.1).any(axis=1)
+        else:
+            plans[:] = np.nan
+            retry = np.ones(n, dtype=bool)
+
+        self.polished = int(retry.sum())
+        for i in np.flatnonzero(retry):
+            vehicle_limits = limits[i] if limits is not None else None
+            alone = self.optimize((speeds[i], accelerations[i]), throttles[i], grades[i], vehicle_limits)
+            if not alone.success:
+                continue
+            if not np.isfinite(plans[i]).all() or \
+                    alone.fun < self.objective(plans[i], (speeds[i], accelerations[i]), grades[i], vehicle_limits):
+                plans[i] = alone.x
+        self.plans = plans
+        return plans[:, steps:]
+
+    def __call__(self, state):
+        first = self.solve_fleet(state.speed, state.acceleration, state.throttle)[:, 0]
+        return np.where(np.isfinite(first), first, self.fallback)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Fleet-batched MPC vs one SLSQP solve per vehicle')
+    argparser.add_argument(
+        '--config',
+        default=CONFIG_FILE,
+        help='Vehicle parameters (default: %(default)s)')
+    argparser.add_argument(
+        '--vehicles',
+        type=int,
+        default=50,
+        help='Vehicles of the fleet (default: 50)')
+    argparser.add_argument(
+        '--steps-ahead',
+        type=int,
+        default=10,
+        help='Horizon in steps (default: 10)')
+    argparser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed of the random vehicle states (default: 0)')
+    args = argparser.parse_args()
+
+    parameters = read_config_file(args.config)
+    rng = np.random.RandomState(args.seed)
+    speeds = rng.uniform(2.0, 15.0, args.vehicles)
+    accelerations = rng.uniform(-0.5, 0.5, args.vehicles)
+    throttles = rng.uniform(0.2, 0.7, args.vehicles)
+
+    single = MPCController(parameters, steps_ahead=args.steps_ahead)
+    start = time.time()
+    separate = [single.optimize((v, a), t) for v, a, t in zip(speeds, accelerations, throttles)]
+    separate_time = time.time() - start
+
+    fleet = FleetMPCController(parameters, steps_ahead=args.steps_ahead)
+    start = time.time()
+    fleet.solve_fleet(speeds, accelerations, throttles)
+    fleet_time = time.time() - start
+
+    # Cost of each vehicle's fleet plan minus its own SLSQP optimum, both with the MPCController objective
+    gaps = np.array([single.objective(plan, (v, a)) - result.fun
+                     for plan, v, a, result in zip(fleet.plans, speeds, accelerations, separate)
+                     if result.success and np.isfinite(plan).all()])
+    print('%d vehicles, %d steps ahead' % (args.vehicles, args.steps_ahead))
+    print('  SLSQP per vehicle: %7.1f ms per vehicle, %d/%d converged' % (
+        1e3 * separate_time / args.vehicles, sum(x.success for x in separate), args.vehicles))
+    print('  fleet L-BFGS-B:    %7.1f ms per vehicle, %d iterations, %d vehicles re-solved alone, %d/%d planned' % (
+        1e3 * fleet_time / args.vehicles, fleet.iterations, fleet.polished,
+        np.isfinite(fleet.plans).all(axis=1).sum(), args.vehicles))
+    print('  cost vs SLSQP:     %d vehicles worse (max %+.1f), %d better (min %+.1f), %d within 1' % (
+        (gaps > 1.0).sum(), gaps.max(), (gaps < -1.0).sum(), gaps.min(), (np.abs(gaps) <= 1.0).sum()))
+
+if __name__ == '__main__':
+    main()
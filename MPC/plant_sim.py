@@ -0,0 +1,276 @@
+"""
+Batched longitudinal plant simulator.
+
+Evaluates controllers in closed loop without a CARLA server: N independent
+episodes are stepped together as NumPy arrays. The plant is the road-load
+model of utils.calculate_forces plus a throttle/brake -> acceleration map
+identified from the collected logs:
+
+    a = throttle * max(drive + drive_speed * v, 0) - brake * brake_decel
+        - (rolling + air + grade forces at v) / mass
+
+The map lives in the [throttle_map] section of config.ini next to the
+road-load parameters and is refitted from logs with
+
+    python MPC/plant_sim.py --fit LOG.xlsx [LOG.csv ...]
+
+A policy is any callable taking the PlantState of all the episodes and
+returning their throttles, or (throttle, brake), as arrays. SpeedTrackingPolicy
+is a vectorized baseline, ControllerPolicy runs one solve(init_state,
+throttle) controller (MPCController) per episode:
+
+    simulator = PlantSimulator.from_config()
+    result = simulator.run(SpeedTrackingPolicy(targets, gains), speed=np.zeros(1000), steps=600)
+    result.energy, result.distance  # (1000,) arrays
+
+The energy follows the convention of the collectors and of the MPC
+objective: calculate_forces(v, a) * v * dt summed over the steps.
+"""
+
+import argparse
+import collections
+import configparser
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils import calculate_forces, read_config_file
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+MAP_SECTION = 'throttle_map'
+
+# State of every episode at the current step, (N,) arrays
+PlantState = collections.namedtuple('PlantState', ['time', 'position', 'speed', 'acceleration', 'throttle'])
+# Outcome of every episode, (N,) arrays, trajectory holds (steps, N) arrays when recorded
+EpisodeResult = collections.namedtuple(
+    'EpisodeResult', ['energy', 'distance', 'mean_speed', 'final_speed', 'throttle_variation', 'trajectory'])
+
+
+def read_log(filename):
+    """Reads a collected log (Excel, CSV or Parquet)"""
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
+    if filename.endswith('.csv'):
+        return pd.read_csv(filename)
+    return pd.read_excel(filename)
+
+
+class ThrottleMap(object):
+    """Acceleration produced by the throttle and the brake"""
+
+    def __init__(self, drive, drive_speed, brake_decel):
+        """
+        Constructor method. drive (m/s^2) is the acceleration at full
+        throttle from standstill, drive_speed (1/s) how it changes with
+        speed and brake_decel (m/s^2) the deceleration at full brake.
+        """
+        self.drive = drive
+        self.drive_speed = drive_speed
+        self.brake_decel = brake_decel
+
+    def acceleration(self, throttle, brake, speed):
+        """Acceleration of the actuators alone, before the road loads"""
+        drive = np.maximum(self.drive + self.drive_speed * speed, 0.0)
+        return throttle * drive - brake * self.brake_decel
+
+    @classmethod
+    def fit(cls, logs, parameters, min_speed=0.5, max_step=0.5):
+        """
+        Bounded least squares fit on logs (DataFrames with Time, Speed,
+        Throttle and Braking columns), on the equations of
+        system_identification with the road loads of parameters known. Logs
+        without actuator columns are skipped.
+        """
+        from system_identification import LOWER_BOUNDS, bounded_least_squares, log_equations
+        # The last two unknowns of the identification are the road loads
+        known = np.array([parameters["rolling_coefficient"],
+                          parameters["drag_coefficient"] * parameters["frontal_area"] / parameters["mass"]])
+        gram, moment, samples = np.zeros((3, 3)), np.zeros(3), 0
+        for data in logs:
+            equations = log_equations(data, parameters["air_density"], parameters["g"], min_speed, max_step)
+            if equations is None:
+                continue
+            rows, rhs = equations
+            rhs = rhs - rows[:, 3:].dot(known)
+            gram += rows[:, :3].T.dot(rows[:, :3])
+            moment += rows[:, :3].T.dot(rhs)
+            samples += len(rhs)
+        if samples < 3:
+            raise ValueError('not enough moving samples to fit the throttle map')
+        return cls(*bounded_least_squares(gram, moment, LOWER_BOUNDS[:3]))
+
+    @classmethod
+    def load(cls, filename=CONFIG_FILE):
+        """Reads the [throttle_map] section of a config file"""
+        config = configparser.ConfigParser()
+        config.read(filename)
+        if not config.has_section(MAP_SECTION):
+            raise ValueError('%s has no [%s] section, fit one with --fit' % (filename, MAP_SECTION))
+        section = config[MAP_SECTION]
+        return cls(float(section['drive']), float(section['drive_speed']), float(section['brake_decel']))
+
+    def save(self, filename=CONFIG_FILE):
+        """Writes the [throttle_map] section of a config file, keeping the others"""
+        config = configparser.ConfigParser()
+        config.read(filename)
+        config[MAP_SECTION] = {
+            'drive': '%.6g' % self.drive,
+            'drive_speed': '%.6g' % self.drive_speed,
+            'brake_decel': '%.6g' % self.brake_decel}
+        with open(filename, 'w') as config_file:
+            config.write(config_file)
+
+
+class PlantSimulator(object):
+    """Steps many longitudinal vehicle episodes at once"""
+
+    def __init__(self, parameters, throttle_map, dt=0.1):
+        """Constructor method"""
+        self.parameters = parameters
+        self.throttle_map = throttle_map
+        self.dt = dt
+
+    @classmethod
+    def from_config(cls, filename=CONFIG_FILE, dt=None):
+        """Simulator of the vehicle of a config file, at its time step by default"""
+        parameters = read_config_file(filename)
+        if dt is None:
+            dt = parameters.get("time_step", 0.1)
+        return cls(parameters, ThrottleMap.load(filename), dt)
+
+    def acceleration(self, speed, throttle, brake=0.0, grade=0.0):
+        """Acceleration of the vehicle (m/s^2), grade in radians"""
+        resist = calculate_forces(speed, 0.0, self.parameters, grade) / self.parameters["mass"]
+        return self.throttle_map.acceleration(throttle, brake, speed) - resist
+
+    def run(self, policy, speed, steps, grade=None, record=False):
+        """
+        Runs len(speed) episodes for steps steps from the initial speeds.
+        grade (radians) is a scalar, an (N,) array or a function of the
+        positions. Returns an EpisodeResult.
+        """
+        speed = np.array(speed, dtype=float)
+        n = len(speed)
+        dt = self.dt
+        position = np.zeros(n)
+        accel = np.zeros(n)
+        throttle = np.zeros(n)
+        energy = np.zeros(n)
+        variation = np.zeros(n)
+        trajectory = None
+        if record:
+            trajectory = dict((x, np.empty((steps, n))) for x in ('speed', 'acceleration', 'throttle', 'brake'))
+        for step in range(steps):
+            state = PlantState(step * dt, position, speed, accel, throttle)
+            command = policy(state)
+            if isinstance(command, tuple):
+                new_throttle, brake = command
+            else:
+                new_throttle, brake = command, 0.0
+            new_throttle = np.clip(np.broadcast_to(new_throttle, (n,)), 0.0, 1.0)
+            brake = np.clip(np.broadcast_to(brake, (n,)), 0.0, 1.0)
+            slope = grade(position) if callable(grade) else (0.0 if grade is None else grade)
+
+            # No reverse, a braking vehicle stops
+            new_speed = np.maximum(speed + self.acceleration(speed, new_throttle, brake, slope) * dt, 0.0)
+            accel = (new_speed - speed) / dt
+            position = position + 0.5 * (speed + new_speed) * dt
+            energy += calculate_forces(new_speed, accel, self.parameters, slope) * new_speed * dt
+            if step > 0:
+                variation += np.abs(new_throttle - throttle)
+            speed, throttle = new_speed, new_throttle
+            if record:
+                trajectory['speed'][step] = speed
+                trajectory['acceleration'][step] = accel
+                trajectory['throttle'][step] = throttle
+                trajectory['brake'][step] = brake
+        return EpisodeResult(energy, position, position / (steps * dt), speed, variation, trajectory)
+
+
+class SpeedTrackingPolicy(object):
+    """Proportional speed controller, one target and gain per episode"""
+
+    def __init__(self, target_speed, gain, brake_gain=0.5):
+        """Constructor method, target_speed in m/s, gain in throttle per m/s"""
+        self.target_speed = np.asarray(target_speed, dtype=float)
+        self.gain = np.asarray(gain, dtype=float)
+        self.brake_gain = brake_gain
+
+    def __call__(self, state):
+        error = self.target_speed - state.speed
+        return np.clip(self.gain * error, 0.0, 1.0), np.clip(-self.brake_gain * self.gain * error, 0.0, 1.0)
+
+
+class ControllerPolicy(object):
+    """
+    One controller per episode with solve((speed, acceleration), throttle)
+    returning a throttle sequence, like MPCController. With a RouteProfile the
+    road preview of the horizon is added to the state, as PreviewSnapshot does.
+    """
+
+    def __init__(self, controllers, fallback=0.5, profile=None):
+        """Constructor method, fallback is the throttle when a solve fails"""
+        self.controllers = controllers
+        self.fallback = fallback
+        self.profile = profile
+
+    def __call__(self, state):
+        throttle = np.empty(len(self.controllers))
+        for i, controller in enumerate(self.controllers):
+            init_state = (state.speed[i], state.acceleration[i])
+            if self.profile is not None:
+                init_state += (self.profile.preview(
+                    state.position[i], state.speed[i], controller.steps_ahead, controller.dt),)
+            throttles = controller.solve(init_state, state.throttle[i])
+            throttle[i] = throttles[0] if throttles is not None else self.fallback
+        return throttle
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Batched longitudinal plant simulator')
+    argparser.add_argument(
+        '--config',
+        default=CONFIG_FILE,
+        help='Vehicle parameters, the throttle map is read from and written to it (default: %(default)s)')
+    argparser.add_argument(
+        '--fit',
+        metavar='LOG',
+        nargs='+',
+        help='Fit the throttle map on these logs and write it to the config')
+    argparser.add_argument(
+        '--episodes',
+        default=2000,
+        type=int,
+        help='Speed tracking variants evaluated in one batch (default: 2000)')
+    argparser.add_argument(
+        '--steps',
+        default=600,
+        type=int,
+        help='Steps of each episode (default: 600)')
+    args = argparser.parse_args()
+
+    if args.fit:
+        throttle_map = ThrottleMap.fit([read_log(x) for x in args.fit], read_config_file(args.config))
+        throttle_map.save(args.config)
+        print('Throttle map: drive %.3f m/s^2, drive_speed %.3f 1/s, brake_decel %.3f m/s^2 written to %s' % (
+            throttle_map.drive, throttle_map.drive_speed, throttle_map.brake_decel, args.config))
+
+    simulator = PlantSimulator.from_config(args.config)
+    rng = np.random.RandomState(0)
+    targets = rng.uniform(5.0, 15.0, args.episodes)
+    gains = rng.uniform(0.05, 1.0, args.episodes)
+    start = time.time()
+    result = simulator.run(SpeedTrackingPolicy(targets, gains), np.zeros(args.episodes), args.steps)
+    elapsed = time.time() - start
+    per_km = result.energy / np.maximum(result.distance, 1.0) * 1000.0
+    print('%d episodes of %.0f s in %.2f s (%.0f episodes/min)' % (
+        args.episodes, args.steps * simulator.dt, elapsed, 60.0 * args.episodes / elapsed))
+    for i in np.argsort(per_km)[:5]:
+        print('  target %5.1f m/s gain %.2f: %8.0f J/km, %6.0f m, throttle variation %.2f' % (
+            targets[i], gains[i], per_km[i], result.distance[i], result.throttle_variation[i]))
+
+
+if __name__ == '__main__':
+    main()
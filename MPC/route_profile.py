@@ -0,0 +1,225 @@
+"""
+Indexed route profile for the preview-aware MPC.
+
+A RouteProfile holds the road ahead of the vehicle as arrays sorted by the
+distance along the route: the grade (radians), the speed limit (m/s) and the
+curvature (1/m) of the road at each sampled point. Every lookup by travelled
+distance is a binary search, so the MPC gets the preview of its horizon
+without querying the server:
+
+    profile = RouteProfile.from_points(xyz, speed_limits)   # or from_log(data)
+    preview = profile.preview(distance, speed, steps=10, dt=0.1)
+    preview[:, 0], preview[:, 1], preview[:, 2]  # grade, speed limit, curvature per step
+
+The horizon distances assume the current speed is kept, the MPC only needs
+the road under its prediction. Profiles are built once per route and cached
+in cache/route_profiles (get_profile()). RouteTracker follows a vehicle along
+a profile from its location, searching near its last position, and
+PreviewSnapshot wraps an MPC snapshot(vehicle) so the preview travels with the
+state handed to MPCController.solve().
+
+    python MPC/route_profile.py LOG.xlsx   # flat vs preview MPC on the road of a log
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'route_profiles')
+
+
+class RouteProfile(object):
+    """Grade, speed limit and curvature along a route, indexed by distance"""
+
+    def __init__(self, distance, grade, speed_limit, curvature, xy=None):
+        """
+        Constructor method, (n,) arrays sorted by increasing distance (m).
+        xy (n, 2) are the planar positions of the points, needed to locate a
+        vehicle on the route.
+        """
+        self.distance = np.asarray(distance, dtype=float)
+        self.grade = np.asarray(grade, dtype=float)
+        self.speed_limit = np.asarray(speed_limit, dtype=float)
+        self.curvature = np.asarray(curvature, dtype=float)
+        self.xy = None if xy is None else np.asarray(xy, dtype=float)
+
+    def __len__(self):
+        return len(self.distance)
+
+    @property
+    def length(self):
+        """Length of the route (m)"""
+        return float(self.distance[-1])
+
+    @classmethod
+    def from_points(cls, xyz, speed_limit=None, spacing=1.0):
+        """
+        Profile of a polyline given as an (n, 3) array, with the speed limit
+        (m/s) at each point (scalar or (n,), unlimited by default). Points
+        closer than spacing (m) to the previous kept one are dropped, so
+        noisy altitudes do not make steep grades.
+        """
+        xyz = np.asarray(xyz, dtype=float)
+        limits = np.broadcast_to(np.inf if speed_limit is None else speed_limit, (len(xyz),)).astype(float)
+        steps = np.sqrt((np.diff(xyz, axis=0) ** 2).sum(axis=1))
+        travelled = np.concatenate([[0.0], np.cumsum(steps)])
+        # First point of every spacing bin
+        _, keep = np.unique(np.floor(travelled / spacing), return_index=True)
+        if len(keep) < 2:
+            raise ValueError('the route is shorter than %.1f m' % spacing)
+        xyz, limits = xyz[keep], limits[keep]
+
+        delta = np.diff(xyz, axis=0)
+        horizontal = np.hypot(delta[:, 0], delta[:, 1])
+        lengths = np.sqrt(horizontal ** 2 + delta[:, 2] ** 2)
+        distance = np.concatenate([[0.0], np.cumsum(lengths)])
+        # Grade of the segment starting at each point
+        grade = np.arctan2(delta[:, 2], np.maximum(horizontal, 1e-6))
+        grade = np.append(grade, grade[-1])
+        # Heading change over the two segments around each point
+        heading = np.unwrap(np.arctan2(delta[:, 1], delta[:, 0]))
+        curvature = np.zeros(len(xyz))
+        curvature[1:-1] = np.diff(heading) / np.maximum(0.5 * (lengths[:-1] + lengths[1:]), 1e-6)
+        return cls(distance, grade, limits, curvature, xyz[:, :2])
+
+    @classmethod
+    def from_log(cls, data, spacing=1.0):
+        """Profile of the road driven in a collected log (GPS X, GPS Y and Altitude columns)"""
+        xyz = data[['GPS X', 'GPS Y', 'Altitude']].to_numpy(dtype=float)
+        limits = data['Speed Limit (m/s)'].to_numpy(dtype=float) if 'Speed Limit (m/s)' in data else None
+        return cls.from_points(xyz, limits, spacing)
+
+    def at(self, distance):
+        """Grade, speed limit and curvature at the distances (m) along the route"""
+        distance = np.clip(distance, 0.0, self.length)
+        # The speed limit holds until the next point, the others are interpolated
+        index = np.searchsorted(self.distance, distance, side='right') - 1
+        return (np.interp(distance, self.distance, self.grade),
+                self.speed_limit[np.clip(index, 0, len(self) - 1)],
+                np.interp(distance, self.distance, self.curvature))
+
+    def preview(self, distance, speed, steps, dt):
+        """
+        (steps, 3) array of the grade, speed limit and curvature at the end of
+        each of the next steps of dt seconds, driving on at speed (m/s)
+        """
+        ahead = distance + max(speed, 0.0) * dt * np.arange(1, steps + 1)
+        return np.column_stack(self.at(ahead))
+
+    def locate(self, x, y, near=None, window=50.0):
+        """
+        Distance along the route of the point closest to (x, y), searching
+        the points within window meters of the distance near when given
+        """
+        start, end = 0, len(self)
+        if near is not None:
+            start, end = np.searchsorted(self.distance, [near - window, near + window])
+            end = max(end, start + 1)
+        offset = self.xy[start:end] - (x, y)
+        return float(self.distance[start + np.argmin((offset ** 2).sum(axis=1))])
+
+    def save(self, filename):
+        """Writes the profile to an .npz file"""
+        arrays = dict(distance=self.distance, grade=self.grade, speed_limit=self.speed_limit,
+                      curvature=self.curvature)
+        if self.xy is not None:
+            arrays['xy'] = self.xy
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Reads a profile written by save()"""
+        with np.load(filename) as archive:
+            return cls(archive['distance'], archive['grade'], archive['speed_limit'], archive['curvature'],
+                       archive['xy'] if 'xy' in archive else None)
+
+
+def get_profile(name, build):
+    """Profile cached as name in cache/route_profiles, built with build() the first time"""
+    filename = os.path.join(CACHE_DIR, '%s.npz' % name)
+    if os.path.exists(filename):
+        return RouteProfile.load(filename)
+    profile = build()
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    profile.save(filename)
+    return profile
+
+
+class RouteTracker(object):
+    """Distance travelled by a vehicle along a profile, from its locations"""
+
+    def __init__(self, profile, window=50.0):
+        """Constructor method"""
+        self.profile = profile
+        self.window = window
+        self.distance = None
+
+    def update(self, x, y):
+        """Distance (m) along the route of the vehicle at (x, y)"""
+        self.distance = self.profile.locate(x, y, self.distance, self.window)
+        return self.distance
+
+
+class PreviewSnapshot(object):
+    """
+    snapshot(vehicle) -> ((speed, acceleration, preview), throttle), adding
+    the road preview of the horizon to the state of a plain MPC snapshot
+    """
+
+    def __init__(self, profile, snapshot, steps, dt):
+        """Constructor method, snapshot returns ((speed, acceleration), throttle)"""
+        self.tracker = RouteTracker(profile)
+        self.snapshot = snapshot
+        self.steps = steps
+        self.dt = dt
+
+    def __call__(self, vehicle):
+        (speed, acceleration), throttle = self.snapshot(vehicle)
+        location = vehicle.get_location()
+        distance = self.tracker.update(location.x, location.y)
+        preview = self.tracker.profile.preview(distance, speed, self.steps, self.dt)
+        return (speed, acceleration, preview), throttle
+
+
+def main():
+    from MPC_Controller import MPCController
+    from plant_sim import ControllerPolicy, PlantSimulator, read_log
+
+    argparser = argparse.ArgumentParser(description='Flat vs preview MPC on the road of a collected log')
+    argparser.add_argument(
+        'log',
+        help='Collected log (.xlsx, .csv or .parquet) with GPS X, GPS Y and Altitude columns')
+    argparser.add_argument(
+        '--speed-limit',
+        type=float,
+        default=None,
+        help='Speed limit (km/h) of the whole road (default: none)')
+    argparser.add_argument(
+        '--steps',
+        type=int,
+        default=600,
+        help='Steps of the simulated episode (default: 600)')
+    args = argparser.parse_args()
+
+    data = read_log(args.log)
+    profile = RouteProfile.from_log(data)
+    if args.speed_limit is not None:
+        profile.speed_limit[:] = args.speed_limit / 3.6
+    print('%s: %.0f m, %d points, grade %.1f%% to %.1f%%' % (
+        args.log, profile.length, len(profile), 100.0 * np.tan(profile.grade.min()),
+        100.0 * np.tan(profile.grade.max())))
+
+    simulator = PlantSimulator.from_config()
+    speed = np.array([float(data['Speed (m/s)'].iloc[0])])
+    for name, policy in (('flat', ControllerPolicy([MPCController(simulator.parameters)])),
+                         ('preview', ControllerPolicy([MPCController(simulator.parameters)], profile=profile))):
+        result = simulator.run(policy, speed, args.steps, grade=lambda x: profile.at(x)[0])
+        print('  %-8s %8.0f J/km over %6.0f m, mean speed %.1f m/s' % (
+            name, result.energy[0] / max(result.distance[0], 1.0) * 1000.0, result.distance[0],
+            result.mean_speed[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""
+Hyperparameter sweep of the MPC.
+
+Evaluates MPCController configurations (cost weights, horizon, time step)
+in closed loop on the plant simulator over a corpus of collected logs, in a
+process pool, and reports the Pareto front of energy vs. smoothness vs.
+solve time.
+
+Every log gives one scenario: the initial speed, the duration and the grade
+along the travelled distance (from its altitude). A configuration is driven
+through every scenario and scored by
+
+    energy       J/km over the scenario
+    smoothness   mean absolute throttle change per second
+    solve time   mean ms per solve
+
+averaged over the scenarios. The result of each (configuration, scenario)
+pair is cached in cache/mpc_sweep, so extending a grid or resuming a sweep
+only evaluates the new pairs.
+
+Configurations come from a grid:
+
+    python MPC/sweep.py LOG.xlsx ... --speed-weights 10 50 200 --smoothness-weights 0.5 2 8 --horizons 5 10
+
+or from Bayesian optimization (a Gaussian process with expected improvement
+over random scalarizations of the three objectives, so the samples spread
+along the front), --bayesian N samples, evaluated --batch at a time.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from MPC_Controller import MPCController
+from plant_sim import CONFIG_FILE, PlantSimulator, ThrottleMap, read_log
+from utils import read_config_file
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'mpc_sweep')
+OBJECTIVES = ('energy', 'smoothness', 'solve_time')
+
+# Name -> (low, high, log scale, integer) of the searched parameters
+SPACE = (
+    ('speed_weight', (1.0, 500.0, True, False)),
+    ('smoothness_weight', (0.1, 50.0, True, False)),
+    ('steps_ahead', (3, 20, False, True)),
+    ('dt', (0.05, 0.2, False, False)),
+)
+DEFAULTS = {'speed_weight': 50.0, 'smoothness_weight': 2.0, 'steps_ahead': 10, 'dt': 0.1}
+
+
+class Scenario(object):
+    """Initial speed, duration and grade profile of a log"""
+
+    def __init__(self, name, speed, duration, positions, grades):
+        """Constructor method"""
+        self.name = name
+        self.speed = speed
+        self.duration = duration
+        self.positions = positions
+        self.grades = grades
+
+    @classmethod
+    def from_log(cls, filename, max_duration=None):
+        """Scenario replaying the start, duration and road of a log"""
+        data = read_log(filename)
+        t = data['Time'].to_numpy(dtype=float)
+        v = data['Speed (m/s)'].to_numpy(dtype=float)
+        duration = t[-1] - t[0]
+        if max_duration is not None:
+            duration = min(duration, max_duration)
+        positions = np.concatenate([[0.0], np.cumsum(0.5 * (v[:-1] + v[1:]) * np.diff(t))])
+        grades = np.zeros(len(positions))
+        if 'Altitude' in data:
+            altitude = data['Altitude'].to_numpy(dtype=float)
+            distance = np.diff(positions)
+            grades[1:] = np.where(distance > 0.2, np.arctan2(np.diff(altitude), np.maximum(distance, 0.2)), 0.0)
+        # Keep the points where the vehicle moved, the profile must increase
+        keep = np.concatenate([[True], np.diff(positions) > 0.2])
+        return cls(os.path.basename(filename), float(v[0]), float(duration), positions[keep], grades[keep])
+
+    def grade(self, position):
+        """Grade (radians) at the travelled distances"""
+        return np.interp(position, self.positions, self.grades)
+
+    def key(self):
+        """Identity of the scenario in the cache"""
+        digest = zlib.crc32(self.positions.tobytes() + self.grades.tobytes()) & 0xffffffff
+        return '%s-%.3f-%.3f-%08x' % (self.name, self.speed, self.duration, digest)
+
+
+class _TimedPolicy(object):
+    """Runs the controller, timing and counting the solves"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.solve_time = 0.0
+        self.solves = 0
+        self.failures = 0
+
+    def __call__(self, state):
+        start = time.time()
+        throttles = self.controller.solve((state.speed[0], state.acceleration[0]), state.throttle[0])
+        self.solve_time += time.time() - start
+        self.solves += 1
+        if throttles is None:
+            self.failures += 1
+            return np.array([0.5])
+        return np.array([throttles[0]])
+
+
+def evaluate(config, scenario, parameters, throttle_map):
+    """Objectives of one configuration on one scenario"""
+    controller = MPCController(
+        parameters, steps_ahead=int(config['steps_ahead']), dt=config['dt'],
+        speed_weight=config['speed_weight'], smoothness_weight=config['smoothness_weight'])
+    simulator = PlantSimulator(parameters, throttle_map, dt=config['dt'])
+    policy = _TimedPolicy(controller)
+    steps = max(1, int(round(scenario.duration / config['dt'])))
+    result = simulator.run(policy, np.array([scenario.speed]), steps, grade=scenario.grade)
+    distance = max(result.distance[0], 1.0)
+    return {
+        'energy': float(result.energy[0] / distance * 1000.0),
+        'smoothness': float(result.throttle_variation[0] / (steps * config['dt'])),
+        'solve_time': 1e3 * policy.solve_time / policy.solves,
+        'failures': policy.failures / float(policy.solves),
+        'distance': float(result.distance[0])}
+
+
+def _cache_path(config, scenario, parameters, throttle_map):
+    key = json.dumps([sorted(config.items()), scenario.key(), sorted(parameters.items()),
+                      [throttle_map.drive, throttle_map.drive_speed, throttle_map.brake_decel]])
+    return os.path.join(CACHE_DIR, '%08x.json' % (zlib.crc32(key.encode('utf-8')) & 0xffffffff))
+
+
+def _evaluate_cached(config, scenario, parameters, throttle_map):
+    filename = _cache_path(config, scenario, parameters, throttle_map)
+    if os.path.exists(filename):
+        with open(filename) as cache_file:
+            return json.load(cache_file)
+    metrics = evaluate(config, scenario, parameters, throttle_map)
+    # Write then rename, concurrent workers never see a partial file
+    temporary = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temporary, 'w') as cache_file:
+        json.dump(metrics, cache_file)
+    os.replace(temporary, filename)
+    return metrics
+
+
+def evaluate_configs(configs, scenarios, parameters, throttle_map, executor):
+    """Objectives of every configuration averaged over the scenarios, as a DataFrame"""
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    futures = [[executor.submit(_evaluate_cached, config, scenario, parameters, throttle_map)
+                for scenario in scenarios] for config in configs]
+    rows = []
+    for config, config_futures in zip(configs, futures):
+        metrics = [x.result() for x in config_futures]
+        row = dict(config)
+        for name in OBJECTIVES + ('failures',):
+            row[name] = float(np.mean([x[name] for x in metrics]))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def pareto_front(values):
+    """Mask of the rows of values (n, k) no other row is better or equal on, minimizing"""
+    values = np.asarray(values, dtype=float)
+    front = np.ones(len(values), dtype=bool)
+    for i in range(len(values)):
+        dominated = np.all(values <= values[i], axis=1) & np.any(values < values[i], axis=1)
+        front[i] = not dominated.any()
+    return front
+
+
+def grid_configs(args):
+    """Every combination of the grid values"""
+    names = ('speed_weight', 'smoothness_weight', 'steps_ahead', 'dt')
+    values = (args.speed_weights, args.smoothness_weights, args.horizons, args.dts)
+    return [dict(zip(names, x)) for x in itertools.product(*values)]
+
+
+def _encode(config):
+    x = []
+    for name, (low, high, log, _) in SPACE:
+        value = config[name]
+        if log:
+            x.append((np.log(value) - np.log(low)) / (np.log(high) - np.log(low)))
+        else:
+            x.append((value - low) / float(high - low))
+    return np.array(x)
+
+
+def _decode(x):
+    config = {}
+    for value, (name, (low, high, log, integer)) in zip(x, SPACE):
+        value = float(np.clip(value, 0.0, 1.0))
+        value = np.exp(np.log(low) + value * (np.log(high) - np.log(low))) if log else low + value * (high - low)
+        config[name] = int(round(value)) if integer else round(float(value), 4)
+    return config
+
+
+def _gp_posterior(x_train, y_train, x, length_scale=0.25, noise=1e-4):
+    """Mean and standard deviation of a zero-mean RBF Gaussian process"""
+    def kernel(a, b):
+        distance = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2)
+        return np.exp(-0.5 * distance / length_scale ** 2)
+    gram = kernel(x_train, x_train) + noise * np.eye(len(x_train))
+    factor = np.linalg.cholesky(gram)
+    alpha = np.linalg.solve(factor.T, np.linalg.solve(factor, y_train))
+    cross = kernel(x, x_train)
+    mean = cross.dot(alpha)
+    v = np.linalg.solve(factor, cross.T)
+    variance = np.maximum(1.0 - (v ** 2).sum(axis=0), 1e-12)
+    return mean, np.sqrt(variance)
+
+
+def suggest(history, count, rng, candidates=2000):
+    """
+    Next configurations to evaluate: for each, a random weighting of the
+    normalized objectives (ParEGO) and the candidate maximizing the expected
+    improvement of a GP fitted on it
+    """
+    x_train = np.array([_encode(x) for x in history[[x for x, _ in SPACE]].to_dict('records')])
+    objectives = history[list(OBJECTIVES)].to_numpy(dtype=float)
+    low, high = objectives.min(axis=0), objectives.max(axis=0)
+    normalized = (objectives - low) / np.where(high > low, high - low, 1.0)
+    picked = []
+    for _ in range(count):
+        weights = rng.dirichlet(np.ones(len(OBJECTIVES)))
+        # Augmented Chebyshev scalarization
+        y = (normalized * weights).max(axis=1) + 0.05 * (normalized * weights).sum(axis=1)
+        y = (y - y.mean()) / max(y.std(), 1e-9)
+        x = rng.uniform(size=(candidates, len(SPACE)))
+        mean, std = _gp_posterior(x_train, y, x)
+        improvement = y.min() - mean
+        z = improvement / std
+        expected = improvement * norm.cdf(z) + std * norm.pdf(z)
+        # Do not suggest the same point twice in a batch
+        for point in picked:
+            expected[np.sqrt(((x - point) ** 2).sum(axis=1)) < 0.05] = -np.inf
+        picked.append(x[np.argmax(expected)])
+    configs = [_decode(x) for x in picked]
+    return configs
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='MPC hyperparameter sweep on the plant simulator')
+    argparser.add_argument(
+        'logs',
+        metavar='LOG',
+        nargs='+',
+        help='Logs the scenarios are taken from (.xlsx, .csv or .parquet)')
+    argparser.add_argument(
+        '--config',
+        default=CONFIG_FILE,
+        help='Vehicle parameters and throttle map (default: %(default)s)')
+    argparser.add_argument(
+        '--max-duration',
+        type=float,
+        default=60.0,
+        help='Seconds of each log driven, 0 for all of it (default: 60)')
+    argparser.add_argument('--speed-weights', type=float, nargs='+', default=[DEFAULTS['speed_weight']])
+    argparser.add_argument('--smoothness-weights', type=float, nargs='+', default=[DEFAULTS['smoothness_weight']])
+    argparser.add_argument('--horizons', type=int, nargs='+', default=[DEFAULTS['steps_ahead']])
+    argparser.add_argument('--dts', type=float, nargs='+', default=[DEFAULTS['dt']])
+    argparser.add_argument(
+        '--bayesian',
+        metavar='N',
+        type=int,
+        default=0,
+        help='Evaluate N Bayesian-optimized configurations after the grid')
+    argparser.add_argument(
+        '--batch',
+        type=int,
+        default=None,
+        help='Configurations suggested per Bayesian round (default: --workers)')
+    argparser.add_argument(
+        '-j', '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help='Worker processes (default: one per CPU)')
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument(
+        '-o', '--output',
+        default='./MPC/outputs/mpc_sweep.csv',
+        help='CSV of every configuration, pareto column marking the front (default: %(default)s)')
+    args = argparser.parse_args()
+
+    parameters = read_config_file(args.config)
+    throttle_map = ThrottleMap.load(args.config)
+    scenarios = [Scenario.from_log(x, args.max_duration or None) for x in args.logs]
+    rng = np.random.RandomState(args.seed)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        configs = grid_configs(args)
+        if args.bayesian and len(configs) < 2 * len(SPACE):
+            # The GP needs a few points to start from
+            configs += [_decode(x) for x in rng.uniform(size=(2 * len(SPACE) - len(configs), len(SPACE)))]
+        print('Evaluating %d configurations on %d scenarios' % (len(configs), len(scenarios)))
+        results = evaluate_configs(configs, scenarios, parameters, throttle_map, executor)
+        remaining = args.bayesian
+        while remaining > 0:
+            count = min(remaining, args.batch or args.workers)
+            batch = evaluate_configs(suggest(results, count, rng), scenarios, parameters, throttle_map, executor)
+            results = pd.concat([results, batch], ignore_index=True)
+            remaining -= count
+            print('%d/%d Bayesian samples, best energy %.0f J/km' % (
+                args.bayesian - remaining, args.bayesian, results['energy'].min()))
+
+    results = results.drop_duplicates(subset=[x for x, _ in SPACE]).reset_index(drop=True)
+    results['pareto'] = pareto_front(results[list(OBJECTIVES)].to_numpy())
+    directory = os.path.dirname(args.output)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    results.to_csv(args.output, index=False)
+    print('Pareto front (%d of %d configurations), written to %s:' % (
+        results['pareto'].sum(), len(results), args.output))
+    print(results[results['pareto']].sort_values('energy').to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
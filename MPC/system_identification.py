@@ -0,0 +1,266 @@
+"""
+Vehicle parameter identification from collected logs.
+
+Fits the road-load parameters of config.ini and the throttle/brake map of
+plant_sim on the telemetry of the collectors, so the MPC model and the plant
+simulator match the simulated vehicle. Every moving sample of a log gives
+one equation of the longitudinal dynamics, per unit of mass:
+
+    a + g sin(grade) = drive * throttle + drive_speed * throttle * v
+                       - brake_decel * brake
+                       - rolling_coefficient * g cos(grade)
+                       - 0.5 * air_density * (Cd A / m) * v^2
+
+with the acceleration derived from the logged speed and the grade from the
+logged altitude. The equations are linear in the five unknowns: every log
+file is reduced to its normal equations in a process pool, they are summed
+and solved as a bounded least squares problem (the parameters are physical,
+so non-negative).
+
+The kinematics only determine forces per unit of mass: the mass is taken
+from --mass, from a 'Mass (kg)' column of the logs or kept from the config,
+and only the product Cd A is identified, the frontal area is kept. Logs
+without Throttle and Braking columns (SUMO) carry no actuator input and are
+skipped.
+
+The calibrated config is written next to --config as *_identified.ini, the
+shared config.ini only when it is given as -o. A fit explaining little of the
+logs (R^2 below --min-r2) or giving non-physical values is not written
+without --force.
+
+    python MPC/system_identification.py LOG.xlsx [LOG.csv ...] --mass 2800 -o MPC/config.ini
+"""
+
+import argparse
+import configparser
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.linalg import solve_triangular
+from scipy.optimize import lsq_linear
+
+from plant_sim import CONFIG_FILE, ThrottleMap, read_log
+from utils import read_config_file
+
+UNKNOWNS = ('drive', 'drive_speed', 'brake_decel', 'rolling_coefficient', 'drag_area_per_mass')
+# drive_speed may be negative, the others are physical
+LOWER_BOUNDS = (0.0, -np.inf, 0.0, 0.0, 0.0)
+# Beyond these the fit is not a road vehicle, the logs do not determine it
+MAX_ROLLING_COEFFICIENT = 0.05
+MAX_DRAG_COEFFICIENT = 1.5
+DEFAULT_MIN_R2 = 0.5
+
+
+def log_equations(data, air_density, g, min_speed=0.5, max_step=0.5):
+    """
+    Rows and right-hand side of the identification equations of one log,
+    None if it has no actuator columns
+    """
+    if 'Throttle' not in data or 'Braking' not in data:
+        return None
+    t = data['Time'].to_numpy(dtype=float)
+    v = data['Speed (m/s)'].to_numpy(dtype=float)
+    dt = np.diff(t)
+    step = np.where(dt > 0.0, dt, 1.0)
+    # The control of a row acts until the next one
+    speed = v[:-1]
+    throttle = data['Throttle'].to_numpy(dtype=float)[:-1]
+    brake = data['Braking'].to_numpy(dtype=float)[:-1]
+    accel = np.diff(v) / step
+    grade = np.zeros(len(speed))
+    if 'Altitude' in data:
+        distance = 0.5 * (v[:-1] + v[1:]) * dt
+        climb = np.diff(data['Altitude'].to_numpy(dtype=float))
+        grade = np.where(distance > 0.2, np.arctan2(climb, np.maximum(distance, 0.2)), 0.0)
+    valid = (dt > 0.0) & (dt < max_step) & (speed > min_speed)
+    rows = np.column_stack([
+        throttle, throttle * speed, -brake, -g * np.cos(grade), -0.5 * air_density * speed ** 2])
+    rhs = accel + g * np.sin(grade)
+    return rows[valid], rhs[valid]
+
+
+def _file_statistics(filename, air_density, g, min_speed, max_step):
+    try:
+        data = read_log(filename)
+    except Exception as error:  # pylint: disable=broad-except
+        return filename, None, 'cannot read: %s' % error
+    equations = log_equations(data, air_density, g, min_speed, max_step)
+    if equations is None:
+        return filename, None, 'no Throttle/Braking columns'
+    rows, rhs = equations
+    mass = None
+    if 'Mass (kg)' in data:
+        mass = float(np.nanmedian(data['Mass (kg)'].to_numpy(dtype=float)))
+    # Normal equations, they add up across files
+    return filename, (rows.T.dot(rows), rows.T.dot(rhs), rhs.dot(rhs), rhs.sum(), len(rhs), mass), None
+
+
+def bounded_least_squares(gram, moment, lower_bounds):
+    """
+    Solution of min |A x - b|^2 subject to x >= lower_bounds, from the
+    normal equations gram = A^T A and moment = A^T b
+    """
+    # min |A x - b|^2 with A^T A = R^T R is min |R x - R^-T A^T b|^2
+    scale = np.sqrt(np.maximum(np.diag(gram), 1e-12))
+    gram_scaled = gram / np.outer(scale, scale)
+    factor = np.linalg.cholesky(gram_scaled + 1e-10 * np.eye(len(gram))).T
+    target = solve_triangular(factor, moment / scale, trans='T')
+    result = lsq_linear(factor, target, bounds=(np.array(lower_bounds) * scale, np.inf))
+    return result.x / scale
+
+
+def identify(filenames, parameters, workers=None, min_speed=0.5, max_step=0.5):
+    """
+    Fits the unknowns on the logs, returns a dict with them, the number of
+    samples, the R^2 of the fit and the mass found in the logs (or None)
+    """
+    gram = np.zeros((len(UNKNOWNS), len(UNKNOWNS)))
+    moment = np.zeros(len(UNKNOWNS))
+    total_square, total, samples = 0.0, 0.0, 0
+    masses = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_file_statistics, x, parameters["air_density"], parameters["g"],
+                                   min_speed, max_step) for x in filenames]
+        for future in futures:
+            filename, statistics, error = future.result()
+            if error is not None:
+                logging.warning('%s skipped: %s', filename, error)
+                continue
+            file_gram, file_moment, file_square, file_total, file_samples, mass = statistics
+            gram += file_gram
+            moment += file_moment
+            total_square += file_square
+            total += file_total
+            samples += file_samples
+            if mass is not None:
+                masses.append((mass, file_samples))
+    if samples < 2 * len(UNKNOWNS):
+        raise ValueError('only %d moving samples in the logs, not enough to identify the vehicle' % samples)
+
+    solution = bounded_least_squares(gram, moment, LOWER_BOUNDS)
+
+    residual = total_square - 2.0 * solution.dot(moment) + solution.dot(gram).dot(solution)
+    variance = total_square - total ** 2 / samples
+    fit = dict(zip(UNKNOWNS, solution))
+    fit['samples'] = samples
+    fit['r2'] = 1.0 - residual / variance if variance > 0.0 else 0.0
+    fit['mass'] = None
+    if masses:
+        weights = np.array([x[1] for x in masses], dtype=float)
+        fit['mass'] = float(np.average([x[0] for x in masses], weights=weights))
+    return fit
+
+
+def fit_mass(fit, parameters, mass=None):
+    """Mass (kg) the fit is scaled with: mass, else the one of the logs, else the config one"""
+    if mass is not None:
+        return mass
+    return fit['mass'] if fit['mass'] is not None else parameters["mass"]
+
+
+def check_fit(fit, parameters, mass=None, min_r2=DEFAULT_MIN_R2):
+    """Reasons not to trust a fit, empty if it is plausible"""
+    mass = fit_mass(fit, parameters, mass)
+    drag_coefficient = fit['drag_area_per_mass'] * mass / parameters["frontal_area"]
+    problems = []
+    if fit['r2'] < min_r2:
+        problems.append('R^2 %.3f below %.2f' % (fit['r2'], min_r2))
+    if fit['rolling_coefficient'] > MAX_ROLLING_COEFFICIENT:
+        problems.append('rolling coefficient %.4f above %.2f' % (fit['rolling_coefficient'], MAX_ROLLING_COEFFICIENT))
+    if drag_coefficient > MAX_DRAG_COEFFICIENT:
+        problems.append('drag coefficient %.3f above %.1f' % (drag_coefficient, MAX_DRAG_COEFFICIENT))
+    if fit['drive'] <= 0.0 or fit['brake_decel'] <= 0.0:
+        problems.append('throttle or brake with no effect (drive %.3f, brake %.3f)' % (
+            fit['drive'], fit['brake_decel']))
+    return problems
+
+
+def write_config(fit, parameters, source, output, mass=None):
+    """Writes the calibrated parameters and throttle map to a config file"""
+    mass = fit_mass(fit, parameters, mass)
+    config = configparser.ConfigParser()
+    config.read(source)
+    section = config['simulation_parameters']
+    section['mass'] = '%.6g' % mass
+    section['rolling_coefficient'] = '%.6g' % fit['rolling_coefficient']
+    # Only Cd A is identified, keep the frontal area
+    section['drag_coefficient'] = '%.6g' % (fit['drag_area_per_mass'] * mass / parameters["frontal_area"])
+    with open(output, 'w') as config_file:
+        config.write(config_file)
+    ThrottleMap(fit['drive'], fit['drive_speed'], fit['brake_decel']).save(output)
+    return mass
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Vehicle parameter identification from collected logs')
+    argparser.add_argument(
+        'logs',
+        metavar='LOG',
+        nargs='+',
+        help='Collected logs (.xlsx, .csv or .parquet)')
+    argparser.add_argument(
+        '--config',
+        default=CONFIG_FILE,
+        help='Config the air density, g and frontal area are read from (default: %(default)s)')
+    argparser.add_argument(
+        '-o', '--output',
+        default=None,
+        help='Calibrated config written, the other sections of --config are kept '
+             '(default: --config with an _identified suffix)')
+    argparser.add_argument(
+        '--mass',
+        type=float,
+        default=None,
+        help='Vehicle mass in kg (default: the Mass (kg) column of the logs, else the config mass)')
+    argparser.add_argument(
+        '--min-speed',
+        type=float,
+        default=0.5,
+        help='Samples slower than this (m/s) are ignored (default: 0.5)')
+    argparser.add_argument(
+        '--max-step',
+        type=float,
+        default=0.5,
+        help='Samples further apart than this (s) are ignored (default: 0.5)')
+    argparser.add_argument(
+        '-j', '--workers',
+        type=int,
+        default=None,
+        help='Worker processes (default: one per CPU)')
+    argparser.add_argument(
+        '--min-r2',
+        type=float,
+        default=DEFAULT_MIN_R2,
+        help='Fits explaining less of the logs are not written without --force (default: %(default)s)')
+    argparser.add_argument(
+        '--force',
+        action='store_true',
+        help='Write the fit even if it is implausible')
+    args = argparser.parse_args()
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+    parameters = read_config_file(args.config)
+    fit = identify(args.logs, parameters, args.workers, args.min_speed, args.max_step)
+    output = args.output or '%s_identified%s' % os.path.splitext(args.config)
+    mass = fit_mass(fit, parameters, args.mass)
+    print('%d samples, R^2 %.3f' % (fit['samples'], fit['r2']))
+    print('  mass %.0f kg, rolling coefficient %.4f, drag coefficient %.3f (frontal area %.2f m^2)' % (
+        mass, fit['rolling_coefficient'], fit['drag_area_per_mass'] * mass / parameters["frontal_area"],
+        parameters["frontal_area"]))
+    print('  drive %.3f m/s^2 %+.3f 1/s x speed, brake %.3f m/s^2 (x%.0f kg for forces)' % (
+        fit['drive'], fit['drive_speed'], fit['brake_decel'], mass))
+    problems = check_fit(fit, parameters, mass, args.min_r2)
+    if problems and not args.force:
+        print('Implausible fit, %s not written (--force to write it anyway):' % output)
+        for problem in problems:
+            print('  %s' % problem)
+        sys.exit(1)
+    write_config(fit, parameters, args.config, output, mass)
+    print('Written to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
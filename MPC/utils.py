@@ -2,6 +2,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import configparser
 import os
+import numpy as np
 
 class Vehicle:
     def __init__(self, excel_file):
@@ -32,17 +33,19 @@ class Vehicle:
     def get_time(self):
         return self.data.iloc[self.time_index]["Time"]
 
-def calculate_forces(velocity, acceleration, parameters):
+def calculate_forces(velocity, acceleration, parameters, grade=0.0):
+    # grade is the road slope angle in radians, positive uphill, scalars or arrays
     F_mass = acceleration * parameters["mass"]
-    F_rolling = 0.01 * parameters["mass"] * parameters["g"]
+    F_rolling = parameters["rolling_coefficient"] * parameters["mass"] * parameters["g"] * np.cos(grade)
     F_air = 0.5 * parameters["air_density"] * parameters["frontal_area"] * parameters["drag_coefficient"] *velocity**2
-    F_total = F_mass + F_rolling + F_air
+    F_grade = parameters["mass"] * parameters["g"] * np.sin(grade)
+    F_total = F_mass + F_rolling + F_air + F_grade
     return F_total    
 
-def read_config_file():
+def read_config_file(filename="./MPC/config.ini"):
     # Load configuration from INI file
     config = configparser.ConfigParser()
-    config.read("./MPC/config.ini")
+    config.read(filename)
 
     # Convert the section into a dictionary
     parameters = {key: float(value) for key, value in config["simulation_parameters"].items()}
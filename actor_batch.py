@@ -0,0 +1,52 @@
+"""
+Batched actor spawning and destruction.
+
+Spawning the hero and its sensor rig one spawn_actor() call at a time costs a
+round trip to the server per actor, and so does destroying them. These helpers
+send all the SpawnActor / DestroyActor commands of a step in a single
+client.apply_batch_sync() call instead:
+
+    commands = [SpawnActor(blueprint, transform, parent.id) for ...]
+    actors, errors = spawn_actors(client, world, commands)
+    ...
+    destroy_actors(client, actors)
+
+Sensors attached to a parent are spawned in a second batch once the parent
+exists, the id of an actor spawned in the same batch cannot be used as parent.
+"""
+
+import logging
+
+import carla
+
+SpawnActor = carla.command.SpawnActor
+DestroyActor = carla.command.DestroyActor
+
+
+def spawn_actors(client, world, commands, do_tick=False):
+    """
+    Applies SpawnActor commands in one batch. Returns the spawned actors, in
+    the order of the commands with None for those that failed, and the error
+    messages.
+    """
+    if not commands:
+        return [], []
+    responses = client.apply_batch_sync(commands, do_tick)
+    ids = [response.actor_id for response in responses if not response.error]
+    # One more call to get the actor handles of all of them
+    found = dict((actor.id, actor) for actor in world.get_actors(ids)) if ids else {}
+    actors = [None if response.error else found.get(response.actor_id) for response in responses]
+    errors = [response.error for response in responses if response.error]
+    for error in errors:
+        logging.debug('spawn failed: %s', error)
+    return actors, errors
+
+
+def destroy_actors(client, actors):
+    """Stops the sensors among the actors and destroys them all in one batch"""
+    actors = [actor for actor in actors if actor is not None]
+    for actor in actors:
+        if getattr(actor, 'is_listening', False):
+            actor.stop()
+    if actors:
+        client.apply_batch_sync([DestroyActor(actor) for actor in actors])
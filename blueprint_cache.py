@@ -0,0 +1,104 @@
+"""
+Per-map cache of blueprints and spawn points.
+
+The blueprint library is fetched from the server once per world and the
+results of blueprint filters and the map spawn points are persisted to disk,
+keyed by map name and CARLA version, so restarts and respawns do not go back
+to the server for them.
+"""
+
+import json
+import os
+
+import carla
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+_caches = {}
+
+
+def get_cache(world, carla_map=None, version=None):
+    """Returns the cache of a world, creating it on first use"""
+    cache = _caches.get(world.id)
+    if cache is None:
+        cache = BlueprintCache(world, carla_map, version)
+        _caches[world.id] = cache
+    return cache
+
+
+class BlueprintCache(object):
+    """Blueprint library, filtered blueprint lists and spawn points of one map"""
+
+    def __init__(self, world, carla_map=None, version=None, cache_dir=CACHE_DIR):
+        """Constructor method"""
+        self._world = world
+        self._map = carla_map if carla_map is not None else world.get_map()
+        self._library = None
+        self._map_name = self._map.name.split('/')[-1]
+        self._filename = os.path.join(
+            cache_dir, 'blueprints_%s_%s.json' % (self._map_name, version or 'unknown'))
+        self._filters = {}
+        self._spawn_points = None
+        self._spawn_point_values = None
+        self._load()
+
+    @property
+    def library(self):
+        """Blueprint library of the world, fetched once"""
+        if self._library is None:
+            self._library = self._world.get_blueprint_library()
+        return self._library
+
+    def find(self, blueprint_id):
+        """Returns a fresh copy of a blueprint, setting its attributes does not affect the cache"""
+        return self.library.find(blueprint_id)
+
+    def filter(self, pattern):
+        """Returns fresh copies of the blueprints matching a wildcard pattern"""
+        ids = self._filters.get(pattern)
+        if ids is None:
+            ids = [x.id for x in self.library.filter(pattern)]
+            self._filters[pattern] = ids
+            self._save()
+        return [self.library.find(x) for x in ids]
+
+    def spawn_points(self):
+        """Spawn points of the map"""
+        if self._spawn_points is None:
+            if self._spawn_point_values is not None:
+                self._spawn_points = [
+                    carla.Transform(
+                        carla.Location(x=v[0], y=v[1], z=v[2]),
+                        carla.Rotation(pitch=v[3], yaw=v[4], roll=v[5]))
+                    for v in self._spawn_point_values]
+            else:
+                self._spawn_points = self._map.get_spawn_points()
+                self._spawn_point_values = [
+                    (t.location.x, t.location.y, t.location.z,
+                     t.rotation.pitch, t.rotation.yaw, t.rotation.roll)
+                    for t in self._spawn_points]
+                self._save()
+        # The transforms are mutable, hand out copies
+        return [carla.Transform(t.location, t.rotation) for t in self._spawn_points]
+
+    def _load(self):
+        if not os.path.exists(self._filename):
+            return
+        try:
+            with open(self._filename) as cache_file:
+                content = json.load(cache_file)
+        except (IOError, ValueError):
+            return
+        self._filters = content.get('filters', {})
+        self._spawn_point_values = content.get('spawn_points')
+
+    def _save(self):
+        directory = os.path.dirname(self._filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        content = {
+            'map': self._map_name,
+            'filters': self._filters,
+            'spawn_points': self._spawn_point_values}
+        with open(self._filename, 'w') as cache_file:
+            json.dump(content, cache_file)
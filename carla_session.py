@@ -0,0 +1,101 @@
+"""
+Reusable CARLA session.
+
+Connecting a client, fetching the world, the map, the blueprint library and
+building the route planner graph takes several seconds. A CarlaSession does it
+once and keeps the handles alive across consecutive scenarios, so between runs
+only the actors have to be reset.
+"""
+
+import sys
+
+import carla
+
+from agents.navigation.global_route_planner import GlobalRoutePlanner  # pylint: disable=import-error
+
+import blueprint_cache
+
+
+class CarlaSession(object):
+    """Client, world, map and route planner shared by consecutive scenarios"""
+
+    def __init__(self, host, port, tm_port=8000, timeout=60.0, sampling_resolution=2.0,
+                 eco_routing=False, vehicle_parameters=None):
+        """
+        Constructor method. With eco_routing the agents are given an
+        EcoGlobalRoutePlanner optimizing the routes for vehicle_parameters,
+        road-load parameters as in MPC/config.ini (the default).
+        """
+        self.client = carla.Client(host, port)
+        self.client.set_timeout(timeout)
+        self.world = self.client.get_world()
+        try:
+            self.map = self.world.get_map()
+        except RuntimeError as error:
+            print('RuntimeError: {}'.format(error))
+            print('  The server could not send the OpenDRIVE (.xodr) file:')
+            print('  Make sure it exists, has the same name of your town, and is correct.')
+            sys.exit(1)
+        self.traffic_manager = self.client.get_trafficmanager(tm_port)
+        self.blueprints = blueprint_cache.get_cache(
+            self.world, self.map, self.client.get_server_version())
+        self._sampling_resolution = sampling_resolution
+        self._eco_routing = eco_routing
+        self._vehicle_parameters = vehicle_parameters
+        self._synchronous = False
+        self._topology = None
+        self._route_planner = None
+
+    @property
+    def blueprint_library(self):
+        """Blueprint library of the world, fetched once"""
+        return self.blueprints.library
+
+    @property
+    def spawn_points(self):
+        """Spawn points of the map, cached on disk"""
+        return self.blueprints.spawn_points()
+
+    @property
+    def topology(self):
+        """Topology of the map, fetched once"""
+        if self._topology is None:
+            self._topology = self.map.get_topology()
+        return self._topology
+
+    @property
+    def route_planner(self):
+        """Global route planner shared by the agents of every scenario"""
+        if self._route_planner is None:
+            if self._eco_routing:
+                from eco_route_planner import EcoGlobalRoutePlanner
+                self._route_planner = EcoGlobalRoutePlanner(
+                    self.map, self._sampling_resolution, self._vehicle_parameters)
+            else:
+                self._route_planner = GlobalRoutePlanner(self.map, self._sampling_resolution)
+        return self._route_planner
+
+    def set_synchronous_mode(self, fixed_delta_seconds):
+        """Switches the world and the traffic manager to synchronous mode"""
+        settings = self.world.get_settings()
+        settings.synchronous_mode = True
+        settings.fixed_delta_seconds = fixed_delta_seconds
+        self.world.apply_settings(settings)
+        self.traffic_manager.set_synchronous_mode(True)
+        self._synchronous = True
+
+    def tick(self):
+        """Advances the world, blocking until the next frame"""
+        if self._synchronous:
+            return self.world.tick()
+        return self.world.wait_for_tick().frame
+
+    def close(self):
+        """Puts the world and the traffic manager back in asynchronous mode"""
+        if self._synchronous:
+            settings = self.world.get_settings()
+            settings.synchronous_mode = False
+            settings.fixed_delta_seconds = None
+            self.world.apply_settings(settings)
+            self.traffic_manager.set_synchronous_mode(False)
+            self._synchronous = False
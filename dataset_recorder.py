@@ -0,0 +1,176 @@
+"""
+Frame-aligned recording of every sensor of the ego vehicle.
+
+In synchronous mode all the sensors measure the same simulation frame, but
+their listen() callbacks arrive independently on the client threads. Each
+sensor pushes its values into a channel of the DatasetRecorder, tagged with
+the frame they belong to, and after every world.tick() the client calls
+record(frame, values), which waits (with a timeout) until every continuous
+sensor has reported that frame and appends one row merging all of them.
+
+    recorder = DatasetRecorder('dataset.parquet', payload_dir='dataset_payloads')
+    gnss.record = recorder.channel('gnss')
+    collision.record = recorder.channel('collision', wait=False)
+    ...
+    frame = world.tick()
+    recorder.record(frame, {'Speed (m/s)': speed})
+    ...
+    recorder.close()
+
+Continuous sensors (GNSS, IMU, camera, radar) are waited for; event sensors
+(collision, lane invasion) are not, their values are summed over the frame
+and are 0 when nothing happened. Bulk payloads (images, point clouds) go
+through a FrameRecorder per sensor into <payload_dir>/<sensor>, indexed by the
+same frame ids as the rows. Rows are written as Parquet when the file name ends
+with .parquet (pyarrow or fastparquet has to be installed, checked when the
+recorder is created rather than when the rows are written at the end), as CSV
+otherwise.
+"""
+
+import importlib
+import os
+import threading
+import time
+
+import pandas as pd
+
+from frame_recorder import FrameRecorder
+
+
+def parquet_engine():
+    """Parquet engine pandas can write with, None if none is installed"""
+    for name in ('pyarrow', 'fastparquet'):
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        return name
+    return None
+
+
+class DatasetRecorder(object):
+    """Merges the sensor outputs of each frame into one row"""
+
+    def __init__(self, filename, payload_dir=None, timeout=1.0):
+        """Constructor method"""
+        self.engine = None
+        if filename.endswith('.parquet'):
+            self.engine = parquet_engine()
+            if self.engine is None:
+                raise ValueError('writing %s needs pyarrow or fastparquet, install one or record to .csv' % filename)
+        self.filename = filename
+        self.payload_dir = payload_dir
+        self.timeout = timeout
+        self.incomplete = 0  # Rows written without every sensor
+        self.late = 0  # Continuous sensor data arriving after its row was written
+        self._waited = set()
+        self._pending = {}  # frame -> {sensor: values}
+        self._last_frame = None
+        self._rows = []
+        self._payloads = {}
+        self._event_columns = set()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def channel(self, name, wait=True):
+        """
+        Returns the callback a sensor pushes its data into, as
+        push(frame, values, payload=None). record() waits for the sensors
+        registered with wait=True, the values of the others are summed.
+        """
+        with self._cond:
+            if wait:
+                self._waited.add(name)
+            else:
+                self._waited.discard(name)
+
+        def push(frame, values, payload=None):
+            self._push(name, wait, frame, values, payload)
+        return push
+
+    def remove(self, name):
+        """Stops waiting for a sensor that was destroyed"""
+        with self._cond:
+            self._waited.discard(name)
+            self._cond.notify_all()
+
+    def _push(self, name, wait, frame, values, payload):
+        if payload is not None and self.payload_dir is not None:
+            self._payload_recorder(name).submit(frame, payload)
+        with self._cond:
+            if self._last_frame is not None and frame <= self._last_frame:
+                if wait:
+                    self.late += 1
+                    return
+                # Events are not lost, they are written with the next row
+                frame = self._last_frame + 1
+            sensors = self._pending.setdefault(frame, {})
+            if wait:
+                sensors[name] = values
+            else:
+                totals = sensors.setdefault(name, {})
+                for key, value in values.items():
+                    totals[key] = totals.get(key, 0) + value
+                    self._event_columns.add('%s %s' % (name, key))
+            self._cond.notify_all()
+
+    def _payload_recorder(self, name):
+        recorder = self._payloads.get(name)
+        if recorder is None:
+            with self._cond:
+                recorder = self._payloads.get(name)
+                if recorder is None:
+                    recorder = FrameRecorder(os.path.join(self.payload_dir, name))
+                    self._payloads[name] = recorder
+        return recorder
+
+    def record(self, frame, values=None):
+        """
+        Waits for every continuous sensor to report a frame and appends its
+        row, returns False if some of them timed out.
+        """
+        deadline = time.time() + self.timeout
+        complete = True
+        with self._cond:
+            while not self._waited.issubset(self._pending.get(frame, ())):
+                remaining = deadline - time.time()
+                if remaining <= 0.0:
+                    complete = False
+                    self.incomplete += 1
+                    break
+                self._cond.wait(remaining)
+            sensors = self._pending.pop(frame, {})
+            # Anything older belongs to a frame that was never recorded
+            for old in [x for x in self._pending if x < frame]:
+                del self._pending[old]
+            self._last_frame = frame
+        row = {'Frame': frame}
+        if values:
+            row.update(values)
+        for name, sensor_values in sensors.items():
+            for key, value in sensor_values.items():
+                row['%s %s' % (name, key)] = value
+        self._rows.append(row)
+        return complete
+
+    def save(self):
+        """Writes the rows recorded so far"""
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        data = pd.DataFrame(self._rows)
+        # No event during a frame is a 0, not a missing value
+        events = [x for x in data.columns if x in self._event_columns]
+        data[events] = data[events].fillna(0)
+        if self.filename.endswith('.parquet'):
+            data.to_parquet(self.filename, engine=self.engine, index=False)
+        else:
+            data.to_csv(self.filename, index=False)
+
+    def close(self):
+        """Writes the rows and waits for the payloads to be written"""
+        self.save()
+        for recorder in self._payloads.values():
+            recorder.close()
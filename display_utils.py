@@ -0,0 +1,236 @@
+"""
+Pygame display helpers shared by the clients.
+
+The render loop only pushes what changed to the screen: the HUD info lines are
+drawn into a persistent InfoPanel overlay, re-rendering only the lines whose
+content changed (from a TextCache of line surfaces), and when no new camera
+frame arrived the clients restore the camera image under the changed regions
+and update just those (update_display), instead of flipping the whole window.
+"""
+
+import threading
+
+import numpy as np
+import pygame
+
+
+class FrameBuffer(object):
+    """
+    Double-buffered surface the sensor frames are converted into in place.
+
+    The sensor callback writes into the back surface and swaps it with the front
+    one, the render loop only ever blits the front surface. Surfaces and the
+    uint8 canvas used for point clouds are allocated once, so converting a frame
+    does not allocate a new image.
+    """
+
+    def __init__(self, width, height):
+        """Constructor method"""
+        self._lock = threading.Lock()
+        self._front = None
+        self._version = 0  # Incremented on every new frame
+        self._shown = None  # Version blitted by the last full render
+        self._allocate(width, height)
+
+    def _allocate(self, width, height):
+        self.dim = (width, height)
+        self._surfaces = [pygame.Surface(self.dim), pygame.Surface(self.dim)]
+        self._back = 0
+        # (width, height, 3) like pygame.surfarray
+        self.canvas = np.zeros((width, height, 3), dtype=np.uint8)
+
+    def clear(self):
+        """Nothing is rendered until the next frame arrives"""
+        with self._lock:
+            self._front = None
+            self._version += 1
+
+    def clear_canvas(self):
+        """Returns the canvas, blacked out, to draw the next frame into"""
+        self.canvas.fill(0)
+        return self.canvas
+
+    def present_canvas(self):
+        """Shows the content of the canvas"""
+        with self._lock:
+            surface = self._surfaces[self._back]
+            pygame.surfarray.blit_array(surface, self.canvas)
+            self._swap(surface)
+
+    def present_bgra(self, raw_data, width, height):
+        """Shows a BGRA image buffer, as sent by the CARLA cameras"""
+        if (width, height) != self.dim:
+            with self._lock:
+                self._front = None
+                self._allocate(width, height)
+        array = np.frombuffer(raw_data, dtype=np.uint8).reshape((height, width, 4))
+        with self._lock:
+            surface = self._surfaces[self._back]
+            pixels = pygame.surfarray.pixels3d(surface)
+            # BGRA (height, width) -> RGB (width, height), strided copy, no temporaries
+            pixels[...] = array.swapaxes(0, 1)[:, :, 2::-1]
+            del pixels  # Unlocks the surface
+            self._swap(surface)
+
+    def _swap(self, surface):
+        self._front = surface
+        self._back ^= 1
+        self._version += 1
+
+    def changed(self):
+        """True if the frame changed since the last full render"""
+        return self._version != self._shown
+
+    def render(self, display, area=None):
+        """Blits the last frame, or only an area of it, returns False if there is none"""
+        with self._lock:
+            if self._front is None:
+                return False
+            if area is None:
+                display.blit(self._front, (0, 0))
+                self._shown = self._version
+            else:
+                display.blit(self._front, area.topleft, area)
+            return True
+
+
+def update_display(rects):
+    """Pushes the changed regions of the display to the screen, all of it if rects is None"""
+    if rects is None:
+        pygame.display.flip()
+    elif rects:
+        pygame.display.update(rects)
+
+
+class TextCache(object):
+    """Surfaces of the lines rendered with a font, keyed on their text"""
+
+    def __init__(self, font, color=(255, 255, 255), max_size=512):
+        """Constructor method"""
+        self.font = font
+        self.color = color
+        self.max_size = max_size
+        self._surfaces = {}
+
+    def render(self, text):
+        """Returns the surface of a line, rendering it only the first time"""
+        surface = self._surfaces.get(text)
+        if surface is None:
+            if len(self._surfaces) >= self.max_size:
+                # Lines with changing numbers never repeat, start over
+                self._surfaces.clear()
+            surface = self.font.render(text, True, self.color)
+            self._surfaces[text] = surface
+        return surface
+
+
+class InfoPanel(object):
+    """
+    Translucent overlay of the HUD info lines, kept between frames.
+
+    An item is a string, a (label, value) boolean, a (label, value, min, max)
+    bar or an array of values in [0, 1] plotted over two lines. update() only
+    redraws the lines whose item changed and returns their rectangles.
+    """
+
+    BACKGROUND = (0, 0, 0, 100)
+    LINE_HEIGHT = 18
+    PLOT_HEIGHT = 30
+
+    def __init__(self, font, size, bar_h_offset=100, bar_width=106):
+        """Constructor method"""
+        self.surface = pygame.Surface(size, pygame.SRCALPHA)
+        self.rect = self.surface.get_rect()
+        self._text = TextCache(font)
+        self._bar_h_offset = bar_h_offset
+        self._bar_width = bar_width
+        self._slots = []  # (key, item, extent) of the drawn lines
+        self.invalidate()
+
+    def invalidate(self):
+        """Redraws the whole panel on the next update"""
+        self._slots = []
+        self.surface.fill(self.BACKGROUND)
+        self._redraw_all = True
+
+    def update(self, items):
+        """Draws the items, returns the rectangles of the panel that changed"""
+        slots = self._layout(items)
+        if self._redraw_all:
+            self._redraw_all = False
+            dirty = [self.rect]
+        else:
+            dirty = []
+            for i in range(max(len(slots), len(self._slots))):
+                old = self._slots[i] if i < len(self._slots) else None
+                new = slots[i] if i < len(slots) else None
+                if old is not None and new is not None and old[0] == new[0]:
+                    continue
+                if old is not None:
+                    dirty.append(old[2])
+                if new is not None and (old is None or new[2] != old[2]):
+                    dirty.append(new[2])
+        for rect in dirty:
+            # Plots overlap the next line, redraw every line touching the
+            # region, clipped to it so nothing is drawn twice
+            self.surface.set_clip(rect)
+            self.surface.fill(self.BACKGROUND)
+            for _, item, extent in slots:
+                if extent.colliderect(rect):
+                    self._draw(item, extent.top)
+            self.surface.set_clip(None)
+        self._slots = slots
+        return dirty
+
+    def _layout(self, items):
+        slots = []
+        v_offset = 4
+        width, height = self.rect.size
+        for item in items:
+            if v_offset + self.LINE_HEIGHT > height:
+                break
+            if isinstance(item, (list, np.ndarray)):
+                key = (v_offset, np.asarray(item).tobytes())
+                # The plot goes down to its line width below the second line
+                extent = pygame.Rect(0, v_offset, width, self.PLOT_HEIGHT + 10)
+                slots.append((key, np.array(item), extent))
+                v_offset += 2 * self.LINE_HEIGHT
+            else:
+                slots.append(((v_offset, item), item, pygame.Rect(0, v_offset, width, self.LINE_HEIGHT)))
+                v_offset += self.LINE_HEIGHT
+        return slots
+
+    def _draw(self, item, v_offset):
+        surface = self.surface
+        if isinstance(item, np.ndarray):
+            if len(item) > 1:
+                points = [(x + 8, v_offset + 8 + (1.0 - y) * self.PLOT_HEIGHT) for x, y in enumerate(item)]
+                pygame.draw.lines(surface, (255, 136, 0), False, points, 2)
+            return
+        if isinstance(item, tuple):
+            bar_h_offset, bar_width = self._bar_h_offset, self._bar_width
+            if isinstance(item[1], bool):
+                rect = pygame.Rect((bar_h_offset, v_offset + 8), (6, 6))
+                pygame.draw.rect(surface, (255, 255, 255), rect, 0 if item[1] else 1)
+            else:
+                rect_border = pygame.Rect((bar_h_offset, v_offset + 8), (bar_width, 6))
+                pygame.draw.rect(surface, (255, 255, 255), rect_border, 1)
+                fig = (item[1] - item[2]) / (item[3] - item[2])
+                if item[2] < 0.0:
+                    rect = pygame.Rect((bar_h_offset + fig * (bar_width - 6), v_offset + 8), (6, 6))
+                else:
+                    rect = pygame.Rect((bar_h_offset, v_offset + 8), (fig * bar_width, 6))
+                pygame.draw.rect(surface, (255, 255, 255), rect)
+            item = item[0]
+        if item:  # At this point has to be a str.
+            surface.blit(self._text.render(item), (8, v_offset))
+
+    def render(self, display, rects=None):
+        """Blits the panel, or only the parts of it within rects"""
+        if rects is None:
+            display.blit(self.surface, (0, 0))
+            return
+        for rect in rects:
+            area = rect.clip(self.rect)
+            if area.width and area.height:
+                display.blit(self.surface, area.topleft, area)
@@ -1,25 +1,131 @@
-import pickle
+import os
 import carla
 import argparse
 import matplotlib.pyplot as plt
-import random
+from matplotlib.collections import LineCollection
+import numpy as np
+
+from blueprint_cache import CACHE_DIR
+from map_geometry import MapGeometry
+
+# Distance between two sampled waypoints along a lane (m)
+PRECISION = 0.1
+
+# Minimum distance between two spawn point labels on screen (pixels)
+LABEL_SPACING = 18
+# Labels drawn at most, whatever the zoom
+MAX_LABELS = 300
+
+def waypoint_cache_path(map_name, precision=PRECISION):
+    """Path of the cached waypoint sampling of a map"""
+    return os.path.join(CACHE_DIR, 'waypoints_%s_%s.npz' % (map_name, precision))
+
+
+def sample_waypoints(carla_map, precision=PRECISION):
+    """
+    Samples every topology segment of a map every `precision` meters until its
+    road changes. Returns a dictionary of flat arrays (x, y, z, pitch, yaw,
+    lane_width, road_id) with `offsets`, the start of every segment in them, and the
+    spawn points as (x, y, z, pitch, yaw, roll) rows.
+    """
+    topology = carla_map.get_topology()  # Get road topology
+
+    # Sort topology by Z-coordinate of their locations
+    topology = [x[0] for x in topology]
+    topology = sorted(topology, key=lambda w: w.transform.location.z)
+
+    values = []
+    offsets = [0]
+    for waypoint in topology:
+        waypoints = [waypoint]
+        nxt = waypoint.next(precision)  # Get next waypoint with the specified precision
+        if len(nxt) > 0:
+            nxt = nxt[0]
+            while nxt.road_id == waypoint.road_id:  # Continue until road ID changes
+                waypoints.append(nxt)
+                nxt = nxt.next(precision)
+                if len(nxt) > 0:
+                    nxt = nxt[0]
+                else:
+                    break
+        for w in waypoints:
+            location = w.transform.location
+            rotation = w.transform.rotation
+            values.append((location.x, location.y, location.z, rotation.pitch, rotation.yaw, w.lane_width, w.road_id))
+        offsets.append(len(values))
+
+    values = np.array(values, dtype=np.float64).reshape(-1, 7)
+    spawn_points = np.array([
+        (t.location.x, t.location.y, t.location.z, t.rotation.pitch, t.rotation.yaw, t.rotation.roll)
+        for t in carla_map.get_spawn_points()], dtype=np.float64).reshape(-1, 6)
+    return {
+        'x': values[:, 0], 'y': values[:, 1], 'z': values[:, 2],
+        'pitch': values[:, 3], 'yaw': values[:, 4], 'lane_width': values[:, 5],
+        'road_id': values[:, 6].astype(np.int32),
+        'offsets': np.array(offsets, dtype=np.int64),
+        'spawn_points': spawn_points}
+
+
+def load_waypoints(map_name, precision=PRECISION):
+    """Returns the cached sampling of a map, None if there is none"""
+    filename = waypoint_cache_path(map_name, precision)
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as archive:
+        return dict((key, archive[key]) for key in archive.files)
+
+
+def save_waypoints(map_name, waypoints, precision=PRECISION):
+    """Caches the sampling of a map"""
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    np.savez(waypoint_cache_path(map_name, precision), **waypoints)
+
+
+def road_edges(waypoints):
+    """
+    Left and right road edges of every sampled waypoint, shifted by half the
+    lane width along its forward vector rotated by 90 degrees of yaw, as
+    carla.Transform.get_forward_vector() would. Returns two (N, 2) arrays.
+    """
+    yaw = np.radians(waypoints['yaw'] + 90.0)
+    half_width = waypoints['lane_width'] * 0.5 * np.cos(np.radians(waypoints['pitch']))
+    shift = np.stack((np.cos(yaw) * half_width, np.sin(yaw) * half_width), axis=1)
+    center = np.stack((waypoints['x'], waypoints['y']), axis=1)
+    return center - shift, center + shift
 
-# Define a class to store line data
-class Line:
-    x = []  # X-coordinates of the line
-    y = []  # Y-coordinates of the line
 
 # Class to handle map visualization in CARLA
 class MapVisualization:
     def __init__(self, args):
-        # Initialize CARLA client and map
+        self.map_name = args.map
+        self.carla_client = None
+        self.world = None
+        self.map = None
+
+        # The sampling is cached per map, the server is only needed the first time
+        self.waypoints = load_waypoints(args.map)
+        if self.waypoints is None:
+            self.connect(args)
+            self.waypoints = sample_waypoints(self.map)
+            save_waypoints(args.map, self.waypoints)
+
+        # Setup Matplotlib figure and axis
+        self.fig, self.ax = plt.subplots()
+        self.line_list = []  # Points of the lines drawn, world coordinates
+        self.line_road_ids = []  # Road id of each line
+        self._label_points = None  # (indices, plot coordinates) of the spawn points that can be labeled
+        self._labels = []
+        self._updating = False
+
+    def connect(self, args):
+        # Initialize CARLA client and map, loading the requested one if needed
         self.carla_client = carla.Client(args.host, args.port, worker_threads=1)
         self.world = self.carla_client.get_world()
         self.map = self.world.get_map()
-        
-        # Setup Matplotlib figure and axis
-        self.fig, self.ax = plt.subplots()
-        self.line_list = []  # List to store lines for visualization
+        if self.map.name.split('/')[-1] != args.map:
+            self.world = self.carla_client.load_world(args.map)
+            self.map = self.world.get_map()
 
     def destroy(self):
         # Clean up CARLA client and related resources
@@ -27,85 +133,109 @@ class MapVisualization:
         self.world = None
         self.map = None
 
-    @staticmethod
-    def lateral_shift(transform, shift):
-        """Makes a lateral shift of the forward vector of a transform."""
-        transform.rotation.yaw += 90  # Rotate the yaw by 90 degrees
-        return transform.location + shift * transform.get_forward_vector()
-
-    def draw_line(self, points: list):
-        """Draws a line on the map using the given points."""
-        x = []
-        y = []
-        for p in points:
-            x.append(p.x)  # Append X-coordinate
-            y.append(-p.y)  # Append inverted Y-coordinate for correct orientation
-
-        # Create a Line object and store coordinates
-        line = Line()
-        line.x = x
-        line.y = y
-        self.line_list.append(line)
-
-        # Plot the line using Matplotlib
-        self.ax.plot(x, y, color='darkslategrey', markersize=2)
+    def draw_line(self, points, road_id=-1):
+        """Adds a line, given as an (N, 2) array of points, to the road layer."""
+        self.line_list.append(points)
+        self.line_road_ids.append(road_id)
         return True
 
+    def geometry(self):
+        """Lines drawn and spawn points as a MapGeometry"""
+        return MapGeometry.from_lines(
+            self.map_name, self.line_list, self.line_road_ids, self.waypoints['spawn_points'])
+
     def draw_spawn_points(self, step=5):
-        """Draws spawn points on the map."""
-        spawn_points = self.map.get_spawn_points()
-        
-        # Only display every 'step'-th spawn point to avoid overlap
-        for i in range(0, len(spawn_points), step):
-            p = spawn_points[i]
-            x = p.location.x  # X-coordinate of spawn point
-            y = -p.location.y  # Inverted Y-coordinate for correct orientation
-            
-            # Add a small random offset to reduce overlap of text labels
-            offset_x = random.uniform(-5, 5)
-            offset_y = random.uniform(-5, 5)
-
-            # Annotate spawn points with their indices
-            self.ax.text(x + offset_x, y + offset_y, str(i),
-                         fontsize=6,
-                         color='darkorange',
-                         va='center',
-                         ha='center',
-                         weight='bold')
+        """Draws spawn points on the map, labeling every 'step'-th one."""
+        spawn_points = self.waypoints['spawn_points']
+        # Inverted Y-coordinates for correct orientation
+        points = np.stack((spawn_points[:, 0], -spawn_points[:, 1]), axis=1)
+
+        # All the points in a single scatter layer
+        self.ax.scatter(points[:, 0], points[:, 1], s=4, color='darkorange', zorder=3)
+
+        # Labels are culled to the view and spaced out, and redone on zoom
+        indices = np.arange(0, len(points), step)
+        self._label_points = (indices, points[indices])
+        # Apply the pending autoscale now, reading the limits in update_labels()
+        # would apply it there and fire the callbacks again
+        self.ax.autoscale_view()
+        self.ax.callbacks.connect('xlim_changed', self.update_labels)
+        self.ax.callbacks.connect('ylim_changed', self.update_labels)
+        self.update_labels()
+
+    def update_labels(self, ax=None):
+        """Labels the spawn points in view keeping at most one per LABEL_SPACING pixels."""
+        if self._updating or self._label_points is None:
+            return
+        self._updating = True
+        try:
+            for label in self._labels:
+                label.remove()
+            self._labels = self._make_labels()
+        finally:
+            self._updating = False
+
+    def _make_labels(self):
+        """Text artists of the spawn points to label in the current view"""
+        indices, points = self._label_points
+        (x_min, x_max), (y_min, y_max) = sorted(self.ax.get_xlim()), sorted(self.ax.get_ylim())
+        visible = ((points[:, 0] >= x_min) & (points[:, 0] <= x_max) &
+                   (points[:, 1] >= y_min) & (points[:, 1] <= y_max))
+        indices, points = indices[visible], points[visible]
+        if len(points) == 0:
+            return []
+
+        # One label per screen cell, the first spawn point falling in it
+        cells = np.floor(self.ax.transData.transform(points) / LABEL_SPACING).astype(np.int64)
+        _, first = np.unique(cells, axis=0, return_index=True)
+        first = np.sort(first)[:MAX_LABELS]
+
+        # Annotate spawn points with their indices
+        labels = []
+        for i, (x, y) in zip(indices[first], points[first]):
+            labels.append(self.ax.text(x, y, str(i),
+                                       fontsize=6,
+                                       color='darkorange',
+                                       va='bottom',
+                                       ha='center',
+                                       weight='bold'))
+        return labels
 
     def draw_roads(self):
         """Draws road edges on the map."""
-        precision = 0.1  # Precision for waypoints along the road
-        topology = self.map.get_topology()  # Get road topology
-
-        # Sort topology by Z-coordinate of their locations
-        topology = [x[0] for x in topology]
-        topology = sorted(topology, key=lambda w: w.transform.location.z)
-
-        set_waypoints = []
-        for waypoint in topology:
-            waypoints = [waypoint]
-            nxt = waypoint.next(precision)  # Get next waypoint with the specified precision
-            if len(nxt) > 0:
-                nxt = nxt[0]
-                while nxt.road_id == waypoint.road_id:  # Continue until road ID changes
-                    waypoints.append(nxt)
-                    nxt = nxt.next(precision)
-                    if len(nxt) > 0:
-                        nxt = nxt[0]
-                    else:
-                        break
-            set_waypoints.append(waypoints)
-
-        # Draw the left and right sides of the roads
-        for waypoints in set_waypoints:
-            road_left_side = [self.lateral_shift(w.transform, -w.lane_width * 0.5) for w in waypoints]
-            road_right_side = [self.lateral_shift(w.transform, w.lane_width * 0.5) for w in waypoints]
-
-            if len(road_left_side) > 2:
-                self.draw_line(points=road_left_side)  # Draw left side of the road
-            if len(road_right_side) > 2:
-                self.draw_line(points=road_right_side)  # Draw right side of the road
+        left, right = road_edges(self.waypoints)
+        offsets = self.waypoints['offsets']
+        road_ids = self.waypoints['road_id']
+
+        # Collect the left and right sides of the roads
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            if end - start > 2:
+                road_id = int(road_ids[start])
+                self.draw_line(points=left[start:end], road_id=road_id)  # Left side of the road
+                self.draw_line(points=right[start:end], road_id=road_id)  # Right side of the road
+
+        # Draw them all as one artist, inverted Y-coordinates for correct orientation
+        segments = [line * (1.0, -1.0) for line in self.line_list]
+        self.ax.add_collection(LineCollection(segments, colors='darkslategrey'))
+        self.ax.autoscale_view()
+
+    def export_tiles(self, directory, tiles=4, dpi=200):
+        """Saves the map as a tiles x tiles grid of PNG images, tile_<row>_<column>.png."""
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        (x_min, y_min), (x_max, y_max) = self.geometry().bounds()
+        # Plot coordinates, Y is inverted
+        y_min, y_max = -y_max, -y_min
+        size = max(x_max - x_min, y_max - y_min) / tiles
+        self.ax.set_aspect('equal', adjustable='box')
+        self.fig.set_size_inches(8, 8)
+        for row in range(tiles):
+            for column in range(tiles):
+                x = x_min + column * size
+                y = y_max - (row + 1) * size
+                self.ax.set_xlim(x, x + size)
+                self.ax.set_ylim(y, y + size)
+                self.fig.savefig(os.path.join(directory, 'tile_%d_%d.png' % (row, column)), dpi=dpi)
 
 # Main function to run the map visualization
 def main():
@@ -125,7 +255,21 @@ def main():
     argparser.add_argument(
         '-m', '--map',
         default='Town04',
-        help='Load a new map to visualize')
+        help='Map to visualize, loaded on the server if its sampling is not cached (default: Town04)')
+    argparser.add_argument(
+        '--export-tiles',
+        metavar='DIR',
+        default=None,
+        help='Save the map as a grid of PNG tiles into DIR instead of displaying it')
+    argparser.add_argument(
+        '--tiles',
+        default=4,
+        type=int,
+        help='Number of tiles per side of the grid exported by --export-tiles (default: 4)')
+    argparser.add_argument(
+        '-o', '--output',
+        default='/tmp/map_geometry.bin',
+        help='Map geometry file written for other tools, see map_geometry.py (default: /tmp/map_geometry.bin)')
 
     args = argparser.parse_args()
 
@@ -134,7 +278,7 @@ def main():
 
     # Draw roads and spawn points on the map
     viz.draw_roads()
-    viz.draw_spawn_points(step=10)  # Display every 10th spawn point (adjust step as needed)
+    viz.draw_spawn_points(step=1)  # Labels are thinned out by zoom, every spawn point can get one
 
     # Clean up visualization resources
     viz.destroy()
@@ -142,12 +286,14 @@ def main():
     # Adjust plot to have equal axis scaling
     plt.axis('equal')
 
-    # Save map visualization information to a pickle file
-    with open('/tmp/map_info.pkl', 'wb') as pickle_file:
-        pickle.dump(viz.line_list, pickle_file)
+    # Save the road lines, road ids and spawn points in the binary geometry format
+    viz.geometry().save(args.output)
 
-    # Display the plot
-    plt.show()
+    if args.export_tiles:
+        viz.export_tiles(args.export_tiles, args.tiles)
+    else:
+        # Display the plot
+        plt.show()
 
 # Execute the script
 if __name__ == "__main__":
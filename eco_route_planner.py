@@ -0,0 +1,170 @@
+"""
+Energy-aware global route planner.
+
+EcoGlobalRoutePlanner is a drop-in GlobalRoutePlanner whose route search
+minimizes the predicted energy instead of the distance. It can be handed to
+BasicAgent / BehaviorAgent through their grp_inst argument and is then used by
+set_destination():
+
+    planner = EcoGlobalRoutePlanner(world.get_map(), 2.0, parameters)
+    agent = BehaviorAgent(vehicle, behavior='normal', grp_inst=planner)
+    agent.set_destination(destination)
+
+The weight of each edge of the planner graph is the energy of cruising along
+its waypoints at the expected speed (speed limit, capped at max_speed) with
+the road-load model of route_energy, plus, on intersection edges, the
+expected energy of accelerating again after a stop. The weights only depend on
+the map and on the vehicle profile, they are computed once per profile and
+cached in memory and on disk. The search is an A*. Downhill stretches
+recover at most the potential energy they lose, so every edge costs at least
+its potential energy change plus a road load proportional to its
+straight-line length. The heuristic is this bound to the destination, with
+the largest per-meter road load every edge satisfies. It never overestimates
+the remaining energy. When no non-negative per-meter load exists, the
+search falls back to Dijkstra.
+"""
+
+import json
+import logging
+import os
+import zlib
+
+import networkx as nx
+import numpy as np
+
+from agents.navigation.global_route_planner import GlobalRoutePlanner  # pylint: disable=import-error
+
+from route_energy import CACHE_DIR, CONFIG_FILE, DEFAULT_SPEED_LIMIT, get_speed_limits, read_config_file, segment_energy
+
+
+class EcoGlobalRoutePlanner(GlobalRoutePlanner):
+    """GlobalRoutePlanner searching for the minimum-energy route"""
+
+    def __init__(self, wmap, sampling_resolution, parameters=None, max_speed=None,
+                 regen_efficiency=0.0, stop_probability=0.5):
+        """Constructor method"""
+        super(EcoGlobalRoutePlanner, self).__init__(wmap, sampling_resolution)
+        self._map_name = wmap.name.split('/')[-1]
+        self._speed_limits = get_speed_limits(wmap)
+        self._edges = list(self._graph.edges())
+        self._weights = {}  # Profile key -> edge energies, in self._edges order
+        self._energy_per_meter = None  # None when the search falls back to Dijkstra
+        self.profile = None
+        self.set_profile(parameters, max_speed, regen_efficiency, stop_probability)
+
+    def set_profile(self, parameters=None, max_speed=None, regen_efficiency=0.0, stop_probability=0.5):
+        """
+        Sets the vehicle profile the routes are optimized for: road-load
+        parameters (MPC/config.ini by default), speed cap (m/s), fraction of
+        the downhill energy recovered and probability of stopping at an
+        intersection.
+        """
+        if parameters is None:
+            parameters = read_config_file(CONFIG_FILE)
+        self.profile = {
+            'parameters': dict(parameters),
+            'max_speed': max_speed,
+            'regen_efficiency': regen_efficiency,
+            'stop_probability': stop_probability}
+        key = json.dumps([self._map_name, self._sampling_resolution, sorted(parameters.items()),
+                          max_speed, regen_efficiency, stop_probability])
+        key = '%08x' % (zlib.crc32(key.encode('utf-8')) & 0xffffffff)
+        weights = self._weights.get(key)
+        if weights is None:
+            weights = self._load_weights(key)
+            if weights is None:
+                weights = self._compute_weights()
+                self._save_weights(key, weights)
+            self._weights[key] = weights
+        self._apply_weights(weights)
+
+    def _edge_speed(self, data):
+        road_id = data['entry_waypoint'].road_id
+        speed = self._speed_limits.get(road_id, DEFAULT_SPEED_LIMIT) / 3.6
+        if self.profile['max_speed'] is not None:
+            speed = min(speed, self.profile['max_speed'])
+        return speed
+
+    def _compute_weights(self):
+        parameters = self.profile['parameters']
+        weights = np.empty(len(self._edges))
+        for i, (u, v) in enumerate(self._edges):
+            data = self._graph.edges[u, v]
+            waypoints = [data['entry_waypoint']] + list(data['path']) + [data['exit_waypoint']]
+            xyz = np.array([[w.transform.location.x, w.transform.location.y, w.transform.location.z]
+                            for w in waypoints])
+            speed = self._edge_speed(data)
+            energy, _ = segment_energy(xyz, speed, parameters, self.profile['regen_efficiency'])
+            weight = energy[-1]
+            if data.get('intersection'):
+                weight += self.profile['stop_probability'] * 0.5 * parameters['mass'] * speed ** 2
+            # A* needs non-negative weights, downhill recovery does not make an edge free
+            weights[i] = weight if weight > 0.0 else 0.0
+        return weights
+
+    def _climb_energy(self, n1, n2):
+        """Potential energy gained from node n1 to node n2, negative downhill"""
+        parameters = self.profile['parameters']
+        climb = self._graph.nodes[n2]['vertex'][2] - self._graph.nodes[n1]['vertex'][2]
+        return parameters['mass'] * parameters['g'] * climb
+
+    def _apply_weights(self, weights):
+        # Largest energy per meter such that every edge costs at least its
+        # straight-line length times it plus its climb energy
+        energy_per_meter = np.inf
+        for (u, v), weight in zip(self._edges, weights):
+            self._graph.edges[u, v]['energy'] = weight
+            distance = self._distance_heuristic(u, v)
+            if distance > 0.0:
+                energy_per_meter = min(energy_per_meter, (weight - self._climb_energy(u, v)) / distance)
+        if energy_per_meter < 0.0:
+            logging.warning('%s: no lower bound of the edge energies, the route search falls back to Dijkstra',
+                            self._map_name)
+            self._energy_per_meter = None
+        else:
+            self._energy_per_meter = energy_per_meter if np.isfinite(energy_per_meter) else 0.0
+
+    def _weights_path(self, key):
+        return os.path.join(CACHE_DIR, 'eco_weights_%s_%s.npz' % (self._map_name, key))
+
+    def _load_weights(self, key):
+        filename = self._weights_path(key)
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as archive:
+            edges = archive['edges']
+            weights = archive['weights']
+        # The graph is rebuilt from the map in the same order, but check it
+        if len(edges) != len(self._edges) or not np.array_equal(edges, np.array(self._edges).reshape(-1, 2)):
+            return None
+        return weights
+
+    def _save_weights(self, key, weights):
+        if not os.path.exists(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        np.savez(self._weights_path(key), edges=np.array(self._edges).reshape(-1, 2), weights=weights)
+
+    def _energy_heuristic(self, n1, n2):
+        """Lower bound of the energy between two nodes"""
+        bound = self._distance_heuristic(n1, n2) * self._energy_per_meter + self._climb_energy(n1, n2)
+        return max(bound, 0.0)
+
+    def _path_search(self, origin, destination):
+        """
+        Finds the minimum-energy path between two locations, as the list of
+        graph nodes GlobalRoutePlanner.trace_route() expects.
+        """
+        start, end = self._localize(origin), self._localize(destination)
+        if self._energy_per_meter is None:
+            route = nx.dijkstra_path(self._graph, source=start[0], target=end[0], weight='energy')
+        else:
+            route = nx.astar_path(
+                self._graph, source=start[0], target=end[0],
+                heuristic=self._energy_heuristic, weight='energy')
+        route.append(end[1])
+        return route
+
+    def route_energy(self, origin, destination):
+        """Predicted energy (J) of the route between two locations"""
+        route = self._path_search(origin, destination)
+        return sum(self._graph.edges[u, v]['energy'] for u, v in zip(route[:-1], route[1:]))
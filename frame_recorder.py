@@ -0,0 +1,122 @@
+"""
+Asynchronous recording of sensor frames.
+
+Sensor callbacks hand a frame to a FrameRecorder, which only copies the buffer
+(CARLA reuses it once the callback returns) and queues it. Frames are grouped
+into chunks that a pool of worker threads compresses and writes as .npz
+archives, one array per frame, and every written frame is listed in an
+index.csv (frame, chunk, key) next to them. When the writers fall behind,
+frames are dropped and counted instead of stalling the simulation, as are the
+frames arriving after close(). A chunk that fails to be written is logged and
+its frames counted as failed.
+
+    recorder = FrameRecorder('_out')
+    recorder.submit(image.frame, array)
+    ...
+    recorder.close()
+
+    frame = load_frame('_out', 1234)
+"""
+
+import csv
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+INDEX_FILE = 'index.csv'
+
+
+class FrameRecorder(object):
+    """Writes frames into compressed chunks from a worker pool"""
+
+    def __init__(self, directory='_out', chunk_size=32, workers=2, max_pending=96):
+        """Constructor method"""
+        self.directory = directory
+        self.chunk_size = chunk_size
+        # A chunk has to fit in the queue to ever be written
+        self.max_pending = max(max_pending, chunk_size)
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0  # Frames of the chunks that could not be written
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._chunk = []
+        self._pending = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, frame, array):
+        """Queues a copy of a frame, returns False if it had to be dropped"""
+        with self._lock:
+            if self._closed or self._pending >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending += 1
+            self._chunk.append((frame, np.array(array, copy=True)))
+            if len(self._chunk) >= self.chunk_size:
+                self._flush()
+        return True
+
+    def _flush(self):
+        if not self._chunk:
+            return
+        chunk, self._chunk = self._chunk, []
+        self._executor.submit(self._write_chunk, chunk)
+
+    def _write_chunk(self, chunk):
+        name = 'frames_%08d.npz' % chunk[0][0]
+        written = False
+        try:
+            arrays = dict(('%08d' % frame, array) for frame, array in chunk)
+            np.savez_compressed(os.path.join(self.directory, name), **arrays)
+            self._append_index([(frame, name, '%08d' % frame) for frame, _ in chunk])
+            written = True
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Frames %d to %d could not be written', chunk[0][0], chunk[-1][0])
+        finally:
+            # Whatever happened the chunk leaves the queue, or it stays full
+            with self._lock:
+                self._pending -= len(chunk)
+                if written:
+                    self.written += len(chunk)
+                else:
+                    self.failed += len(chunk)
+
+    def _append_index(self, rows):
+        filename = os.path.join(self.directory, INDEX_FILE)
+        with self._index_lock:
+            new_file = not os.path.exists(filename)
+            with open(filename, 'a', newline='') as index_file:
+                writer = csv.writer(index_file)
+                if new_file:
+                    writer.writerow(['frame', 'chunk', 'key'])
+                writer.writerows(rows)
+
+    def close(self):
+        """Writes the frames still queued and waits for the workers"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._flush()
+        self._executor.shutdown(wait=True)
+
+
+def read_index(directory):
+    """Returns a {frame: (chunk, key)} dictionary of the recorded frames"""
+    with open(os.path.join(directory, INDEX_FILE), newline='') as index_file:
+        return dict((int(row['frame']), (row['chunk'], row['key'])) for row in csv.DictReader(index_file))
+
+
+def load_frame(directory, frame, index=None):
+    """Loads one recorded frame"""
+    if index is None:
+        index = read_index(directory)
+    chunk, key = index[frame]
+    with np.load(os.path.join(directory, chunk)) as archive:
+        return archive[key]
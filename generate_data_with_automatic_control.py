@@ -11,7 +11,6 @@
 from __future__ import print_function
 
 import argparse
-import collections
 import datetime
 import glob
 import logging
@@ -20,6 +19,7 @@ import os
 import numpy.random as random
 import re
 import sys
+import threading
 import weakref
 
 ## added
@@ -38,6 +38,15 @@ drag_coefficient = 0.38
 mass = 2800  
 time_step = 0.1  # in seconds
 
+# Same vehicle, as road-load parameters for the energy-aware route planner
+VEHICLE_PARAMETERS = {
+    'rolling_coefficient': rolling_coefficient,
+    'air_density': air_density,
+    'g': g,
+    'frontal_area': frontal_area,
+    'drag_coefficient': drag_coefficient,
+    'mass': mass}
+
 try:
     import pygame
     from pygame.locals import KMOD_CTRL
@@ -78,6 +87,23 @@ from agents.navigation.behavior_agent import BehaviorAgent  # pylint: disable=im
 from agents.navigation.basic_agent import BasicAgent  # pylint: disable=import-error
 from agents.navigation.constant_velocity_agent import ConstantVelocityAgent  # pylint: disable=import-error
 
+import actor_batch
+import blueprint_cache
+from carla_session import CarlaSession
+from display_utils import FrameBuffer, InfoPanel, update_display
+from frame_recorder import FrameRecorder
+from route_energy import DEFAULT_SPEED_LIMIT, get_speed_limits
+from sensor_buffers import CollisionHistory
+from spatial_index import VehicleIndex
+from traffic import DEFAULT_HYBRID_RADIUS, BackgroundTraffic
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MPC'))
+from async_mpc import AsyncMPCController  # pylint: disable=import-error
+from closed_loop import FALLBACKS, ClosedLoopMPC  # pylint: disable=import-error
+from MPC_Controller import MPCController  # pylint: disable=import-error
+from route_profile import PreviewSnapshot, RouteProfile, get_profile  # pylint: disable=import-error
+from utils import read_config_file  # pylint: disable=import-error
+
 
 # ==============================================================================
 # -- Global functions ----------------------------------------------------------
@@ -98,7 +124,7 @@ def get_actor_display_name(actor, truncate=250):
     return (name[:truncate - 1] + u'\u2026') if len(name) > truncate else name
 
 def get_actor_blueprints(world, filter, generation):
-    bps = world.get_blueprint_library().filter(filter)
+    bps = blueprint_cache.get_cache(world).filter(filter)
 
     if generation.lower() == "all":
         return bps
@@ -128,17 +154,12 @@ def get_actor_blueprints(world, filter, generation):
 class World(object):
     """ Class representing the surrounding environment """
 
-    def __init__(self, carla_world, hud, args):
+    def __init__(self, session, hud, args, spawn_point):
         """Constructor method"""
         self._args = args
-        self.world = carla_world
-        try:
-            self.map = self.world.get_map()
-        except RuntimeError as error:
-            print('RuntimeError: {}'.format(error))
-            print('  The server could not send the OpenDRIVE (.xodr) file:')
-            print('  Make sure it exists, has the same name of your town, and is correct.')
-            sys.exit(1)
+        self.session = session
+        self.world = session.world
+        self.map = session.map
         self.hud = hud
         self.player = None
         self.collision_sensor = None
@@ -149,6 +170,7 @@ class World(object):
         self._weather_index = 0
         self._actor_filter = args.filter
         self._actor_generation = args.generation
+        self._spawn_point = spawn_point
         self.restart(args)
         self.world.on_tick(hud.on_world_tick)
         self.recording_enabled = False
@@ -177,17 +199,17 @@ class World(object):
             spawn_point.rotation.roll = 0.0
             spawn_point.rotation.pitch = 0.0
             self.destroy()
-            self.player = self.world.try_spawn_actor(blueprint, spawn_point)
+            self.player = self._spawn_player(blueprint, spawn_point)
             self.modify_vehicle_physics(self.player)
         while self.player is None:
-            if not self.map.get_spawn_points():
+            spawn_points = self.session.spawn_points
+            if not spawn_points:
                 print('There are no spawn points available in your map/town.')
                 print('Please add some Vehicle Spawn Point to your UE4 scene.')
                 sys.exit(1)
-            spawn_points = self.map.get_spawn_points()
             # spawn_point = random.choice(spawn_points) if spawn_points else carla.Transform()
-            spawn_point = spawn_points[SPAWN_POINT]
-            self.player = self.world.try_spawn_actor(blueprint, spawn_point)
+            spawn_point = spawn_points[self._spawn_point]
+            self.player = self._spawn_player(blueprint, spawn_point)
             self.modify_vehicle_physics(self.player)
 
         if self._args.sync:
@@ -195,16 +217,41 @@ class World(object):
         else:
             self.world.wait_for_tick()
 
-        # Set up the sensors.
-        self.collision_sensor = CollisionSensor(self.player, self.hud)
-        self.lane_invasion_sensor = LaneInvasionSensor(self.player, self.hud)
-        self.gnss_sensor = GnssSensor(self.player)
+        # Set up the sensors, spawned in a single batch.
         self.camera_manager = CameraManager(self.player, self.hud)
         self.camera_manager.transform_index = cam_pos_id
-        self.camera_manager.set_sensor(cam_index, notify=False)
+        blueprints = blueprint_cache.get_cache(self.world)
+        commands = [
+            actor_batch.SpawnActor(blueprints.find(x.blueprint_id), x.transform, self.player.id)
+            for x in (CollisionSensor, LaneInvasionSensor, GnssSensor)]
+        camera_command = self.camera_manager.spawn_command(cam_index)
+        if camera_command is not None:
+            commands.append(camera_command)
+        sensors, errors = actor_batch.spawn_actors(self.session.client, self.world, commands)
+        if errors:
+            actor_batch.destroy_actors(self.session.client, sensors)
+            raise RuntimeError('Could not spawn the sensors: %s' % '; '.join(errors))
+        self.collision_sensor = CollisionSensor(self.player, self.hud, sensors[0])
+        self.lane_invasion_sensor = LaneInvasionSensor(self.player, self.hud, sensors[1])
+        self.gnss_sensor = GnssSensor(self.player, sensors[2])
+        self.camera_manager.set_sensor(
+            cam_index, notify=False, sensor=sensors[3] if camera_command is not None else None)
         actor_type = get_actor_display_name(self.player)
         self.hud.notification(actor_type)
 
+    def _spawn_player(self, blueprint, spawn_point):
+        """Spawns the hero, returns None if the spawn point is occupied"""
+        actors, _ = actor_batch.spawn_actors(
+            self.session.client, self.world, [actor_batch.SpawnActor(blueprint, spawn_point)])
+        return actors[0]
+
+    def reset(self, spawn_point):
+        """Respawns the hero and its sensors at a new spawn point, keeping the world as is"""
+        self.destroy()
+        self.player = None
+        self._spawn_point = spawn_point
+        self.restart(self._args)
+
     def next_weather(self, reverse=False):
         """Get next weather setting"""
         self._weather_index += -1 if reverse else 1
@@ -237,9 +284,20 @@ class World(object):
         self.hud.tick(self, clock)
 
     def render(self, display):
-        """Render world"""
-        self.camera_manager.render(display)
-        self.hud.render(display)
+        """
+        Render world, returns the regions of the display that changed, None if
+        all of it did
+        """
+        rects = self.hud.dirty_rects()
+        if rects is None or self.camera_manager.frame_changed():
+            self.camera_manager.render(display)
+            self.hud.render(display)
+            return None
+        # Same camera frame, only restore it under the changed HUD regions
+        for rect in rects:
+            self.camera_manager.render(display, rect)
+        self.hud.render(display, rects)
+        return rects
 
     def destroy_sensors(self):
         """Destroy sensors"""
@@ -248,16 +306,15 @@ class World(object):
         self.camera_manager.index = None
 
     def destroy(self):
-        """Destroys all actors"""
+        """Destroys all actors, in a single batch"""
+        self.camera_manager.stop_recording()
         actors = [
             self.camera_manager.sensor,
             self.collision_sensor.sensor,
             self.lane_invasion_sensor.sensor,
             self.gnss_sensor.sensor,
             self.player]
-        for actor in actors:
-            if actor is not None:
-                actor.destroy()
+        actor_batch.destroy_actors(self.session.client, actors)
 
 
 # ==============================================================================
@@ -300,14 +357,21 @@ class HUD(object):
         mono = default_font if default_font in fonts else fonts[0]
         mono = pygame.font.match_font(mono)
         self._font_mono = pygame.font.Font(mono, 12 if os.name == 'nt' else 14)
+        self._info_panel = InfoPanel(self._font_mono, (220, height))
+        self._dirty = []  # Regions of the info panel changed by the last tick
+        self._redraw = True  # Everything has to be drawn again
+        self._notification_shown = False
         self._notifications = FadingText(font, (width, 40), (0, height - 40))
         self.help = HelpText(pygame.font.Font(mono, 24), width, height)
         self.server_fps = 0
         self.frame = 0
         self.simulation_time = 0
+        self.sim_speed_ratio = None
         self._show_info = True
         self._info_text = []
         self._server_clock = pygame.time.Clock()
+        self._vehicle_index = None
+        self._collision_plot = np.zeros(200)
 
     def on_world_tick(self, timestamp):
         """Gets informations from the world at every tick"""
@@ -319,6 +383,7 @@ class HUD(object):
     def tick(self, world, clock):
         """HUD method for every tick"""
         self._notifications.tick(world, clock)
+        self._dirty = []
         if not self._show_info:
             return
         transform = world.player.get_transform()
@@ -328,11 +393,13 @@ class HUD(object):
         heading += 'S' if abs(transform.rotation.yaw) > 90.5 else ''
         heading += 'E' if 179.5 > transform.rotation.yaw > 0.5 else ''
         heading += 'W' if -0.5 > transform.rotation.yaw > -179.5 else ''
-        colhist = world.collision_sensor.get_collision_history()
-        collision = [colhist[x + self.frame - 200] for x in range(0, 200)]
-        max_col = max(1.0, max(collision))
-        collision = [x / max_col for x in collision]
-        vehicles = world.world.get_actors().filter('vehicle.*')
+        collision = world.collision_sensor.get_collision_history(self.frame, len(self._collision_plot))
+        max_col = max(1.0, collision.max())
+        collision = np.divide(collision, max_col, out=self._collision_plot)
+        if self._vehicle_index is None:
+            self._vehicle_index = VehicleIndex(world.world)
+        vehicles = self._vehicle_index
+        vehicles.update()
 
         self._info_text = [
             'Server:  % 16.0f FPS' % self.server_fps,
@@ -340,7 +407,11 @@ class HUD(object):
             '',
             'Vehicle: % 20s' % get_actor_display_name(world.player, truncate=20),
             'Map:     % 20s' % world.map.name.split('/')[-1],
-            'Simulation time: % 12s' % datetime.timedelta(seconds=int(self.simulation_time)),
+            'Simulation time: % 12s' % datetime.timedelta(seconds=int(self.simulation_time))]
+        if self.sim_speed_ratio is not None:
+            self._info_text += [
+                'Sim speed: % 17.1fx' % self.sim_speed_ratio]
+        self._info_text += [
             '',
             'Speed:   % 15.0f km/h' % (3.6 * math.sqrt(vel.x**2 + vel.y**2 + vel.z**2)),
             u'Heading:% 16.0f\N{DEGREE SIGN} % 2s' % (transform.rotation.yaw, heading),
@@ -371,20 +442,36 @@ class HUD(object):
         if len(vehicles) > 1:
             self._info_text += ['Nearby vehicles:']
 
-        def dist(l):
-            return math.sqrt((l.x - transform.location.x)**2 + (l.y - transform.location.y)
-                             ** 2 + (l.z - transform.location.z)**2)
-        vehicles = [(dist(x.get_location()), x) for x in vehicles if x.id != world.player.id]
-
-        for dist, vehicle in sorted(vehicles):
-            if dist > 200.0:
-                break
+        location = (transform.location.x, transform.location.y, transform.location.z)
+        distances, indices = vehicles.query_radius(location, 200.0)
+        for dist, index in zip(distances, indices):
+            vehicle = vehicles.actors[index]
+            if vehicle.id == world.player.id:
+                continue
             vehicle_type = get_actor_display_name(vehicle, truncate=22)
             self._info_text.append('% 4dm %s' % (dist, vehicle_type))
+        self._dirty = self._info_panel.update(self._info_text)
 
     def toggle_info(self):
         """Toggle info on or off"""
         self._show_info = not self._show_info
+        self._info_panel.invalidate()
+        self._redraw = True
+
+    def dirty_rects(self):
+        """
+        Regions of the display changed since the last render, None if
+        everything has to be drawn again
+        """
+        if self._redraw or self.help.visible:
+            self._redraw = self.help.visible
+            return None
+        rects = list(self._dirty)
+        shown = self._notifications.seconds_left > 0.0
+        if shown or self._notification_shown:
+            rects.append(self._notifications.rect)
+        self._notification_shown = shown
+        return rects
 
     def notification(self, text, seconds=2.0):
         """Notification text"""
@@ -394,43 +481,10 @@ class HUD(object):
         """Error text"""
         self._notifications.set_text('Error: %s' % text, (255, 0, 0))
 
-    def render(self, display):
-        """Render for HUD class"""
+    def render(self, display, rects=None):
+        """Render for HUD class, only the regions in rects if given"""
         if self._show_info:
-            info_surface = pygame.Surface((220, self.dim[1]))
-            info_surface.set_alpha(100)
-            display.blit(info_surface, (0, 0))
-            v_offset = 4
-            bar_h_offset = 100
-            bar_width = 106
-            for item in self._info_text:
-                if v_offset + 18 > self.dim[1]:
-                    break
-                if isinstance(item, list):
-                    if len(item) > 1:
-                        points = [(x + 8, v_offset + 8 + (1 - y) * 30) for x, y in enumerate(item)]
-                        pygame.draw.lines(display, (255, 136, 0), False, points, 2)
-                    item = None
-                    v_offset += 18
-                elif isinstance(item, tuple):
-                    if isinstance(item[1], bool):
-                        rect = pygame.Rect((bar_h_offset, v_offset + 8), (6, 6))
-                        pygame.draw.rect(display, (255, 255, 255), rect, 0 if item[1] else 1)
-                    else:
-                        rect_border = pygame.Rect((bar_h_offset, v_offset + 8), (bar_width, 6))
-                        pygame.draw.rect(display, (255, 255, 255), rect_border, 1)
-                        fig = (item[1] - item[2]) / (item[3] - item[2])
-                        if item[2] < 0.0:
-                            rect = pygame.Rect(
-                                (bar_h_offset + fig * (bar_width - 6), v_offset + 8), (6, 6))
-                        else:
-                            rect = pygame.Rect((bar_h_offset, v_offset + 8), (fig * bar_width, 6))
-                        pygame.draw.rect(display, (255, 255, 255), rect)
-                    item = item[0]
-                if item:  # At this point has to be a str.
-                    surface = self._font_mono.render(item, True, (255, 255, 255))
-                    display.blit(surface, (8, v_offset))
-                v_offset += 18
+            self._info_panel.render(display, rects)
         self._notifications.render(display)
         self.help.render(display)
 
@@ -447,6 +501,7 @@ class FadingText(object):
         self.font = font
         self.dim = dim
         self.pos = pos
+        self.rect = pygame.Rect(pos, dim)
         self.seconds_left = 0
         self.surface = pygame.Surface(self.dim)
 
@@ -466,7 +521,8 @@ class FadingText(object):
 
     def render(self, display):
         """Render fading text method"""
-        display.blit(self.surface, self.pos)
+        if self.seconds_left > 0.0:
+            display.blit(self.surface, self.pos)
 
 # ==============================================================================
 # -- HelpText ------------------------------------------------------------------
@@ -495,6 +551,11 @@ class HelpText(object):
         """Toggle on or off the render help"""
         self._render = not self._render
 
+    @property
+    def visible(self):
+        """True if the help is shown"""
+        return self._render
+
     def render(self, display):
         """Render help text method"""
         if self._render:
@@ -508,26 +569,28 @@ class HelpText(object):
 class CollisionSensor(object):
     """ Class for collision sensors"""
 
-    def __init__(self, parent_actor, hud):
-        """Constructor method"""
+    blueprint_id = 'sensor.other.collision'
+    transform = carla.Transform()
+
+    def __init__(self, parent_actor, hud, sensor=None):
+        """Constructor method, sensor is the sensor actor when it is already spawned"""
         self.sensor = None
-        self.history = []
+        self.history = CollisionHistory(4000)
         self._parent = parent_actor
         self.hud = hud
-        world = self._parent.get_world()
-        blueprint = world.get_blueprint_library().find('sensor.other.collision')
-        self.sensor = world.spawn_actor(blueprint, carla.Transform(), attach_to=self._parent)
+        if sensor is None:
+            world = self._parent.get_world()
+            blueprint = blueprint_cache.get_cache(world).find(self.blueprint_id)
+            sensor = world.spawn_actor(blueprint, self.transform, attach_to=self._parent)
+        self.sensor = sensor
         # We need to pass the lambda a weak reference to
         # self to avoid circular reference.
         weak_self = weakref.ref(self)
         self.sensor.listen(lambda event: CollisionSensor._on_collision(weak_self, event))
 
-    def get_collision_history(self):
-        """Gets the history of collisions"""
-        history = collections.defaultdict(int)
-        for frame, intensity in self.history:
-            history[frame] += intensity
-        return history
+    def get_collision_history(self, frame, length=200):
+        """Gets the collision intensity of the last frames up to frame, as a read-only view"""
+        return self.history.window(length, frame)
 
     @staticmethod
     def _on_collision(weak_self, event):
@@ -539,9 +602,7 @@ class CollisionSensor(object):
         self.hud.notification('Collision with %r' % actor_type)
         impulse = event.normal_impulse
         intensity = math.sqrt(impulse.x ** 2 + impulse.y ** 2 + impulse.z ** 2)
-        self.history.append((event.frame, intensity))
-        if len(self.history) > 4000:
-            self.history.pop(0)
+        self.history.add(event.frame, intensity)
 
 # ==============================================================================
 # -- LaneInvasionSensor --------------------------------------------------------
@@ -551,14 +612,19 @@ class CollisionSensor(object):
 class LaneInvasionSensor(object):
     """Class for lane invasion sensors"""
 
-    def __init__(self, parent_actor, hud):
-        """Constructor method"""
+    blueprint_id = 'sensor.other.lane_invasion'
+    transform = carla.Transform()
+
+    def __init__(self, parent_actor, hud, sensor=None):
+        """Constructor method, sensor is the sensor actor when it is already spawned"""
         self.sensor = None
         self._parent = parent_actor
         self.hud = hud
-        world = self._parent.get_world()
-        bp = world.get_blueprint_library().find('sensor.other.lane_invasion')
-        self.sensor = world.spawn_actor(bp, carla.Transform(), attach_to=self._parent)
+        if sensor is None:
+            world = self._parent.get_world()
+            bp = blueprint_cache.get_cache(world).find(self.blueprint_id)
+            sensor = world.spawn_actor(bp, self.transform, attach_to=self._parent)
+        self.sensor = sensor
         # We need to pass the lambda a weak reference to self to avoid circular
         # reference.
         weak_self = weakref.ref(self)
@@ -582,16 +648,20 @@ class LaneInvasionSensor(object):
 class GnssSensor(object):
     """ Class for GNSS sensors"""
 
-    def __init__(self, parent_actor):
-        """Constructor method"""
+    blueprint_id = 'sensor.other.gnss'
+    transform = carla.Transform(carla.Location(x=1.0, z=2.8))
+
+    def __init__(self, parent_actor, sensor=None):
+        """Constructor method, sensor is the sensor actor when it is already spawned"""
         self.sensor = None
         self._parent = parent_actor
         self.lat = 0.0
         self.lon = 0.0
-        world = self._parent.get_world()
-        blueprint = world.get_blueprint_library().find('sensor.other.gnss')
-        self.sensor = world.spawn_actor(blueprint, carla.Transform(carla.Location(x=1.0, z=2.8)),
-                                        attach_to=self._parent)
+        if sensor is None:
+            world = self._parent.get_world()
+            blueprint = blueprint_cache.get_cache(world).find(self.blueprint_id)
+            sensor = world.spawn_actor(blueprint, self.transform, attach_to=self._parent)
+        self.sensor = sensor
         # We need to pass the lambda a weak reference to
         # self to avoid circular reference.
         weak_self = weakref.ref(self)
@@ -617,10 +687,11 @@ class CameraManager(object):
     def __init__(self, parent_actor, hud):
         """Constructor method"""
         self.sensor = None
-        self.surface = None
+        self._frame_buffer = FrameBuffer(hud.dim[0], hud.dim[1])
         self._parent = parent_actor
         self.hud = hud
         self.recording = False
+        self._recorder = None
         bound_x = 0.5 + self._parent.bounding_box.extent.x
         bound_y = 0.5 + self._parent.bounding_box.extent.y
         bound_z = 0.5 + self._parent.bounding_box.extent.z
@@ -643,9 +714,9 @@ class CameraManager(object):
              'Camera Semantic Segmentation (CityScapes Palette)'],
             ['sensor.lidar.ray_cast', None, 'Lidar (Ray-Cast)']]
         world = self._parent.get_world()
-        bp_library = world.get_blueprint_library()
+        blueprints = blueprint_cache.get_cache(world)
         for item in self.sensors:
-            blp = bp_library.find(item[0])
+            blp = blueprints.find(item[0])
             if item[0].startswith('sensor.camera'):
                 blp.set_attribute('image_size_x', str(hud.dim[0]))
                 blp.set_attribute('image_size_y', str(hud.dim[1]))
@@ -659,20 +730,32 @@ class CameraManager(object):
         self.transform_index = (self.transform_index + 1) % len(self._camera_transforms)
         self.set_sensor(self.index, notify=False, force_respawn=True)
 
-    def set_sensor(self, index, notify=True, force_respawn=False):
-        """Set a sensor"""
+    def spawn_command(self, index):
+        """
+        SpawnActor command of a sensor for a batch, None if its attachment
+        cannot be batched (only rigid attachments can)
+        """
+        transform, attachment_type = self._camera_transforms[self.transform_index]
+        if attachment_type != carla.AttachmentType.Rigid:
+            return None
+        return actor_batch.SpawnActor(self.sensors[index % len(self.sensors)][-1], transform, self._parent.id)
+
+    def set_sensor(self, index, notify=True, force_respawn=False, sensor=None):
+        """Set a sensor, sensor is the sensor actor when it is already spawned"""
         index = index % len(self.sensors)
         needs_respawn = True if self.index is None else (
             force_respawn or (self.sensors[index][0] != self.sensors[self.index][0]))
         if needs_respawn:
             if self.sensor is not None:
                 self.sensor.destroy()
-                self.surface = None
-            self.sensor = self._parent.get_world().spawn_actor(
-                self.sensors[index][-1],
-                self._camera_transforms[self.transform_index][0],
-                attach_to=self._parent,
-                attachment_type=self._camera_transforms[self.transform_index][1])
+                self._frame_buffer.clear()
+            if sensor is None:
+                sensor = self._parent.get_world().spawn_actor(
+                    self.sensors[index][-1],
+                    self._camera_transforms[self.transform_index][0],
+                    attach_to=self._parent,
+                    attachment_type=self._camera_transforms[self.transform_index][1])
+            self.sensor = sensor
 
             # We need to pass the lambda a weak reference to
             # self to avoid circular reference.
@@ -689,12 +772,27 @@ class CameraManager(object):
     def toggle_recording(self):
         """Toggle recording on or off"""
         self.recording = not self.recording
+        if self.recording:
+            self._recorder = FrameRecorder('_out')
+        else:
+            self.stop_recording()
         self.hud.notification('Recording %s' % ('On' if self.recording else 'Off'))
 
-    def render(self, display):
-        """Render method"""
-        if self.surface is not None:
-            display.blit(self.surface, (0, 0))
+    def stop_recording(self):
+        """Stop recording, the frames already queued are still written"""
+        self.recording = False
+        if self._recorder is not None:
+            # Let the workers finish the last chunks without blocking the loop
+            threading.Thread(target=self._recorder.close).start()
+            self._recorder = None
+
+    def frame_changed(self):
+        """True if a new frame arrived since the last full render"""
+        return self._frame_buffer.changed()
+
+    def render(self, display, area=None):
+        """Render method, only the area of the frame if given"""
+        self._frame_buffer.render(display, area)
 
     @staticmethod
     def _parse_image(weak_self, image):
@@ -704,25 +802,24 @@ class CameraManager(object):
         if self.sensors[self.index][0].startswith('sensor.lidar'):
             points = np.frombuffer(image.raw_data, dtype=np.dtype('f4'))
             points = np.reshape(points, (int(points.shape[0] / 4), 4))
-            lidar_data = np.array(points[:, :2])
-            lidar_data *= min(self.hud.dim) / 100.0
+            lidar_data = points[:, :2] * (min(self.hud.dim) / 100.0)
             lidar_data += (0.5 * self.hud.dim[0], 0.5 * self.hud.dim[1])
-            lidar_data = np.fabs(lidar_data)  # pylint: disable=assignment-from-no-return
+            np.fabs(lidar_data, out=lidar_data)
             lidar_data = lidar_data.astype(np.int32)
-            lidar_data = np.reshape(lidar_data, (-1, 2))
-            lidar_img_size = (self.hud.dim[0], self.hud.dim[1], 3)
-            lidar_img = np.zeros(lidar_img_size)
+            # Drawn into the reusable uint8 canvas instead of a new image
+            lidar_img = self._frame_buffer.clear_canvas()
             lidar_img[tuple(lidar_data.T)] = (255, 255, 255)
-            self.surface = pygame.surfarray.make_surface(lidar_img)
+            self._frame_buffer.present_canvas()
+            record = points
         else:
             image.convert(self.sensors[self.index][1])
+            self._frame_buffer.present_bgra(image.raw_data, image.width, image.height)
             array = np.frombuffer(image.raw_data, dtype=np.dtype("uint8"))
-            array = np.reshape(array, (image.height, image.width, 4))
-            array = array[:, :, :3]
-            array = array[:, :, ::-1]
-            self.surface = pygame.surfarray.make_surface(array.swapaxes(0, 1))
-        if self.recording:
-            image.save_to_disk('_out/%08d' % image.frame)
+            record = np.reshape(array, (image.height, image.width, 4))[:, :, :3]
+        recorder = self._recorder
+        if recorder is not None:
+            # Encoded and written by the recorder workers, off the sensor thread
+            recorder.submit(image.frame, record)
 
 
 
@@ -758,7 +855,8 @@ class DataCollector:
         F_total = F_mass + F_rolling + F_air
         return F_total    
 
-    def collect_data(self, vehicle, world, elapsed_time):
+    def collect_data(self, vehicle, world, elapsed_time, extra=None):
+        # extra holds additional columns, e.g. the closed-loop MPC record
         # Collecting data from the vehicle
         speed = round(self.get_speed(vehicle), 2)
         acceleration = round(self.get_acceleration(vehicle), 2)
@@ -805,6 +903,8 @@ class DataCollector:
             'Sun Azimuth Angle (°)': sun_azimuth_angle,
             'Sun Altitude Angle (°)': sun_altitude_angle,
         }
+        if extra:
+            data_row.update(extra)
          # Convert data_row to a DataFrame
         new_data = pd.DataFrame([data_row])
 
@@ -840,88 +940,155 @@ class DataCollector:
         self.time_accumulated = 0            
 
 # ==============================================================================
-# -- Game Loop ---------------------------------------------------------
+# -- SimulationSpeedMeter ------------------------------------------------------
 # ==============================================================================
 
+class SimulationSpeedMeter(object):
+    """Tracks how fast simulated time advances compared to wall-clock time"""
 
-def game_loop(args):
-    """
-    Main loop of the simulation. It handles updating all the HUD information,
-    ticking the agent and, if needed, the world.
-    """
-
-    pygame.init()
-    pygame.font.init()
-    world = None
-    data_collector = DataCollector()
-
-    try:
-        if args.seed:
-            random.seed(args.seed)
-
-        client = carla.Client(args.host, args.port)
-        client.set_timeout(60.0)
+    def __init__(self, sim_start, report_interval=10.0):
+        """Constructor method"""
+        self._sim_start = sim_start
+        self._wall_start = time.time()
+        self._last_report = self._wall_start
+        self._report_interval = report_interval
+        self.sim_elapsed = 0.0
+        self.wall_elapsed = 0.0
+        self.ratio = 0.0
+
+    def update(self, sim_time):
+        """Update the meter with the current simulation time, returns the simulated elapsed time"""
+        now = time.time()
+        self.sim_elapsed = sim_time - self._sim_start
+        self.wall_elapsed = now - self._wall_start
+        if self.wall_elapsed > 0:
+            self.ratio = self.sim_elapsed / self.wall_elapsed
+        return self.sim_elapsed
+
+    def should_report(self):
+        """Returns True once every report interval of wall-clock time"""
+        now = time.time()
+        if now - self._last_report >= self._report_interval:
+            self._last_report = now
+            return True
+        return False
+
+    def summary(self):
+        """Human readable summary of the achieved speed"""
+        return 'Simulated %.1f s in %.1f s of wall-clock time (%.2fx real time)' % (
+            self.sim_elapsed, self.wall_elapsed, self.ratio)
 
-        traffic_manager = client.get_trafficmanager()
-        sim_world = client.get_world()
+# ==============================================================================
+# -- Game Loop ---------------------------------------------------------
+# ==============================================================================
 
-        if args.sync:
-            settings = sim_world.get_settings()
-            settings.synchronous_mode = True
-            settings.fixed_delta_seconds = 0.05
-            sim_world.apply_settings(settings)
 
-            traffic_manager.set_synchronous_mode(True)
+def create_agent(args, world, session):
+    """Creates the agent driving the hero, reusing the map and route planner of the session"""
+    if args.agent == "Basic":
+        agent = BasicAgent(world.player, 35, map_inst=session.map, grp_inst=session.route_planner)
+        agent.follow_speed_limits(False)
+        agent.ignore_vehicles(active=False)
+    elif args.agent == "Constant":
+        agent = ConstantVelocityAgent(world.player, 40, map_inst=session.map, grp_inst=session.route_planner)
+        ground_loc = world.world.ground_projection(world.player.get_location(), 5)
+        if ground_loc:
+            world.player.set_location(ground_loc.location + carla.Location(z=0.01))
+        agent.follow_speed_limits(True)
+    elif args.agent == "Behavior":
+        agent = BehaviorAgent(world.player, behavior=args.behavior,
+                              map_inst=session.map, grp_inst=session.route_planner)
+        agent.ignore_vehicles(active=False)
+        agent.follow_speed_limits(False)
+        agent.set_target_speed(40)
+    return agent
+
+
+def route_output(filename, route, n_routes):
+    """Output file of a route, suffixed with the route when several are run"""
+    if n_routes == 1:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return '%s_%d_%d%s' % (root, route[0], route[1], ext)
+
+
+def mpc_snapshot(vehicle):
+    """State (speed, acceleration) and throttle of the hero the MPC solves from"""
+    velocity = vehicle.get_velocity()
+    accel = vehicle.get_acceleration()
+    speed = math.sqrt(velocity.x**2 + velocity.y**2 + velocity.z**2)
+    acceleration = math.sqrt(accel.x**2 + accel.y**2 + accel.z**2)
+    return (speed, acceleration), vehicle.get_control().throttle
+
+
+def create_closed_loop(args):
+    """Closed-loop MPC driving the throttle of the hero"""
+    parameters = read_config_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MPC', 'config.ini'))
+    # The hero is the vehicle the energy is computed for, keep the MPC limits
+    parameters.update(VEHICLE_PARAMETERS)
+    controller = MPCController(parameters, steps_ahead=10, dt=time_step)
+    mpc = AsyncMPCController(controller, processes=args.mpc_process)
+    return ClosedLoopMPC(mpc, mpc_snapshot, budget=args.mpc_budget / 1000.0, fallback=args.mpc_fallback)
+
+
+def route_profile(args, session, route):
+    """Road profile of the route the agent plans from spawn point to destination point, cached per map"""
+    def build():
+        spawn_points = session.spawn_points
+        trace = session.route_planner.trace_route(spawn_points[route[0]].location, spawn_points[route[1]].location)
+        speed_limits = get_speed_limits(session.map)
+        xyz = [(x.transform.location.x, x.transform.location.y, x.transform.location.z) for x, _ in trace]
+        limits = [speed_limits.get(x.road_id, DEFAULT_SPEED_LIMIT) / 3.6 for x, _ in trace]
+        return RouteProfile.from_points(xyz, limits)
+    name = '%s_%d_%d_%s' % (
+        session.map.name.split('/')[-1], route[0], route[1], 'eco' if args.eco_routing else 'shortest')
+    return get_profile(name, build)
+
+
+def run_scenario(args, session, world, controller, display, clock, destination_point, output, closed_loop=None):
+    """
+    Drives the hero to the destination collecting data.
+    Returns True if the user asked to quit.
 
-        display = pygame.display.set_mode(
-            (args.width, args.height),
-            pygame.HWSURFACE | pygame.DOUBLEBUF)
+    With a closed_loop the agent only steers and brakes, the throttle is the MPC's.
+    """
+    data_collector = DataCollector()
+    agent = create_agent(args, world, session)
 
-        hud = HUD(args.width, args.height)
-        world = World(client.get_world(), hud, args)
-        controller = KeyboardControl(world)
-        if args.agent == "Basic":
-            agent = BasicAgent(world.player, 35)
-            agent.follow_speed_limits(False)
-            agent.ignore_vehicles(active=False)
-        elif args.agent == "Constant":
-            agent = ConstantVelocityAgent(world.player, 40)
-            ground_loc = world.world.ground_projection(world.player.get_location(), 5)
-            if ground_loc:
-                world.player.set_location(ground_loc.location + carla.Location(z=0.01))
-            agent.follow_speed_limits(True)
-        elif args.agent == "Behavior":
-            agent = BehaviorAgent(world.player, behavior=args.behavior)
-            agent.ignore_vehicles(active=False)
-            agent.follow_speed_limits(False)
-            agent.set_target_speed(40)
-
-
-        # Set the agent destination
-        spawn_points = world.map.get_spawn_points()
-
-        ## destination = random.choice(spawn_points).location
-        destination = spawn_points[DESTINATION_POINT].location
-        agent.set_destination(destination)
+    # Set the agent destination
+    spawn_points = session.spawn_points
 
-        clock = pygame.time.Clock()
+    ## destination = random.choice(spawn_points).location
+    destination = spawn_points[destination_point].location
+    agent.set_destination(destination)
 
-        start_time = time.time()
+    start_time = time.time()
+    speed_meter = SimulationSpeedMeter(world.world.get_snapshot().timestamp.elapsed_seconds)
 
+    try:
         while True:
             clock.tick()
-            if args.sync:
-                world.world.tick()
-            else:
-                world.world.wait_for_tick()
+            session.tick()
             if controller.parse_events():
-                return
+                return True
+
+            sim_elapsed = speed_meter.update(world.world.get_snapshot().timestamp.elapsed_seconds)
+            if args.fast:
+                world.hud.sim_speed_ratio = speed_meter.ratio
+                if speed_meter.should_report():
+                    print(speed_meter.summary())
 
             world.tick(clock)
-            world.render(display)
-            pygame.display.flip()
-            elapsed_time = round(time.time() - start_time, 2)
-            data_collector.collect_data(world.player, sim_world, elapsed_time)
+            update_display(world.render(display))
+            if args.fast:
+                # Stamp rows with simulated time, wall-clock time is meaningless here
+                elapsed_time = round(sim_elapsed, 2)
+            else:
+                elapsed_time = round(time.time() - start_time, 2)
+            # The MPC record of the control applied at the previous tick, the
+            # one get_control() reports in this row
+            data_collector.collect_data(
+                world.player, session.world, elapsed_time, closed_loop.last if closed_loop is not None else None)
 
             if agent.done():
                 if args.loop:
@@ -930,30 +1097,113 @@ def game_loop(args):
                     # print("The target has been reached, searching for another target")
                     world.hud.notification("Target reached", seconds=4.0)
                     print("The target has been reached")
+                    if closed_loop is not None and closed_loop.snapshot is not mpc_snapshot:
+                        # The agent drives on past the route, its profile no longer describes the road ahead
+                        closed_loop.snapshot = mpc_snapshot
+                        print("MPC road preview off until the next route")
                 else:
                     print("The target has been reached, stopping the simulation")
-                    break
+                    data_collector.save_to_excel(output)
+                    return False
 
             control = agent.run_step()
             control.manual_gear_shift = False
             # control.throttle= 0.5
-            world.player.apply_control(control)
+            if closed_loop is not None:
+                closed_loop.apply(world.player, control, world.hud.simulation_time)
+            else:
+                world.player.apply_control(control)
             data_collector.time_accumulated += clock.get_time()  # Add the time since the last frame (ms)
             if data_collector.time_accumulated >= 1000:  # Every 1 seconds
-                data_collector.save_to_excel()
+                data_collector.save_to_excel(output)
                 data_collector.time_accumulated = 0  # Reset the accumulator
-            time.sleep(time_step)  # Sleep for time_step
+            if not args.fast:
+                time.sleep(time_step)  # Sleep for time_step
     finally:
+        if args.fast:
+            print(speed_meter.summary())
+        if closed_loop is not None:
+            print(closed_loop.summary())
 
-        if world is not None:
-            settings = world.world.get_settings()
-            settings.synchronous_mode = False
-            settings.fixed_delta_seconds = None
-            world.world.apply_settings(settings)
-            traffic_manager.set_synchronous_mode(True)
 
+def game_loop(args):
+    """
+    Main loop of the simulation. It handles updating all the HUD information,
+    ticking the agent and, if needed, the world.
+
+    The client, world, map and route planner are set up once and shared by all
+    the routes, between routes only the actors are reset.
+    """
+
+    pygame.init()
+    pygame.font.init()
+    session = None
+    world = None
+    traffic = None
+    closed_loop = None
+
+    try:
+        if args.seed:
+            random.seed(args.seed)
+
+        session = CarlaSession(
+            args.host, args.port, args.tm_port, timeout=60.0,
+            eco_routing=args.eco_routing, vehicle_parameters=VEHICLE_PARAMETERS)
+
+        if args.weather:
+            session.world.set_weather(getattr(carla.WeatherParameters, args.weather))
+
+        if args.sync:
+            # In accelerated mode every tick produces one row, so the step has
+            # to match the time step used to integrate the energy.
+            session.set_synchronous_mode(time_step if args.fast else 0.05)
+
+        display = pygame.display.set_mode(
+            (args.width, args.height),
+            pygame.HWSURFACE | pygame.DOUBLEBUF)
+
+        routes = args.routes or [(args.spawn_point, args.destination_point)]
+
+        hud = HUD(args.width, args.height)
+        world = World(session, hud, args, routes[0][0])
+        controller = KeyboardControl(world)
+        clock = pygame.time.Clock()
+        if args.npc > 0:
+            traffic = BackgroundTraffic(session, args.hybrid_radius or None)
+        if args.mpc:
+            closed_loop = create_closed_loop(args)
+
+        for index, route in enumerate(routes):
+            if index > 0:
+                if traffic is not None:
+                    # The NPCs may be parked on the next spawn point
+                    traffic.destroy()
+                world.reset(route[0])
+            if traffic is not None:
+                print("Spawned %d NPC vehicles" % traffic.spawn(args.npc, exclude=[route[0]], seed=args.seed))
+            print("Route %d/%d: spawn point %d -> destination point %d" % (
+                index + 1, len(routes), route[0], route[1]))
+            if closed_loop is not None and args.mpc_preview:
+                # The road preview of the horizon travels with every snapshot
+                closed_loop.snapshot = PreviewSnapshot(
+                    route_profile(args, session, route), mpc_snapshot, closed_loop.mpc.steps_ahead, closed_loop.mpc.dt)
+            output = route_output(args.output, route, len(routes))
+            if run_scenario(args, session, world, controller, display, clock, route[1], output, closed_loop):
+                return
+    finally:
+
+        if closed_loop is not None:
+            closed_loop.close()
+
+        if traffic is not None:
+            traffic.destroy()
+
+        if world is not None:
             world.destroy()
 
+        if session is not None:
+            session.close()
+
         pygame.quit()
 
 
@@ -962,6 +1212,15 @@ def game_loop(args):
 # ==============================================================================
 
 
+def parse_route(text):
+    """Parses a SPAWN:DESTINATION pair of spawn point indices"""
+    try:
+        spawn, destination = text.split(':')
+        return int(spawn), int(destination)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected SPAWN:DESTINATION, got %r' % text)
+
+
 def main():
     """Main method"""
 
@@ -983,6 +1242,12 @@ def main():
         default=2000,
         type=int,
         help='TCP port to listen to (default: 2000)')
+    argparser.add_argument(
+        '--tm-port',
+        metavar='P',
+        default=8000,
+        type=int,
+        help='Port to communicate with the traffic manager (default: 8000)')
     argparser.add_argument(
         '--res',
         metavar='WIDTHxHEIGHT',
@@ -992,6 +1257,12 @@ def main():
         '--sync',
         action='store_true',
         help='Synchronous mode execution')
+    argparser.add_argument(
+        '--fast',
+        action='store_true',
+        help='Accelerated synchronous mode: step the simulation as fast as the client '
+             'allows, stamp rows with simulated time and report the achieved '
+             'simulation speed (implies --sync)')
     argparser.add_argument(
         '--filter',
         metavar='PATTERN',
@@ -1017,6 +1288,79 @@ def main():
         choices=["cautious", "normal", "aggressive"],
         help='Choose one of the possible agent behaviors (default: normal) ',
         default='normal')
+    argparser.add_argument(
+        '--spawn-point',
+        metavar='I',
+        default=SPAWN_POINT,
+        type=int,
+        help='Index of the map spawn point used for the hero (default: %d)' % SPAWN_POINT)
+    argparser.add_argument(
+        '--destination-point',
+        metavar='I',
+        default=DESTINATION_POINT,
+        type=int,
+        help='Index of the map spawn point used as destination (default: %d)' % DESTINATION_POINT)
+    argparser.add_argument(
+        '--routes',
+        metavar='SPAWN:DESTINATION',
+        nargs='+',
+        type=parse_route,
+        default=None,
+        help='Run several routes one after the other reusing the same connection '
+             '(overrides --spawn-point and --destination-point)')
+    argparser.add_argument(
+        '--eco-routing',
+        action='store_true',
+        help='Plan the routes to the destinations minimizing the predicted energy instead of the distance')
+    argparser.add_argument(
+        '--mpc',
+        action='store_true',
+        help='Closed loop: apply the MPC throttle to the hero, the agent only steers and brakes')
+    argparser.add_argument(
+        '--mpc-budget',
+        metavar='MS',
+        default=50.0,
+        type=float,
+        help='Time a tick waits for the MPC solve of its state before falling back (default: 50)')
+    argparser.add_argument(
+        '--mpc-fallback',
+        choices=FALLBACKS,
+        default='plan',
+        help='Throttle applied when the solve misses the budget: the latest older plan, the '
+             'agent throttle or the last applied throttle (default: plan)')
+    argparser.add_argument(
+        '--mpc-process',
+        action='store_true',
+        help='Solve the MPC in a worker process instead of a thread')
+    argparser.add_argument(
+        '--mpc-preview',
+        action='store_true',
+        help='Plan the MPC on the grade, speed limits and curves ahead on the route (cached per route, '
+             'off once a --loop route is done)')
+    argparser.add_argument(
+        '--npc',
+        metavar='N',
+        default=0,
+        type=int,
+        help='Number of background vehicles driven by the traffic manager (default: 0)')
+    argparser.add_argument(
+        '--hybrid-radius',
+        metavar='M',
+        default=DEFAULT_HYBRID_RADIUS,
+        type=float,
+        help='Radius around the hero within which the background vehicles get full physics, '
+             '0 to simulate all of them (default: %.0f)' % DEFAULT_HYBRID_RADIUS)
+    argparser.add_argument(
+        '--weather',
+        metavar='PRESET',
+        default=None,
+        help='carla.WeatherParameters preset to apply, e.g. "ClearNoon" (default: keep current)')
+    argparser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        default='vehicle_energy_data_automatic_control.xlsx',
+        help='Excel file the collected data is written to '
+             '(default: vehicle_energy_data_automatic_control.xlsx)')
     argparser.add_argument(
         '-s', '--seed',
         default=2,
@@ -1026,6 +1370,8 @@ def main():
     args = argparser.parse_args()
 
     args.width, args.height = [int(x) for x in args.res.split('x')]
+    if args.fast:
+        args.sync = True
 
     log_level = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(format='%(levelname)s: %(message)s', level=log_level)
@@ -87,13 +87,25 @@ import carla
 
 from carla import ColorConverter as cc
 
+import actor_batch
+import blueprint_cache
+from dataset_recorder import DatasetRecorder
+from display_utils import FrameBuffer, InfoPanel, update_display
+from frame_recorder import FrameRecorder
+from sensor_buffers import CollisionHistory
+from spatial_index import VehicleIndex
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MPC'))
+from async_mpc import AsyncMPCController  # pylint: disable=import-error
+from closed_loop import FALLBACKS, ClosedLoopMPC  # pylint: disable=import-error
+
 import argparse
-import collections
 import datetime
 import logging
 import math
 import random
 import re
+import threading
 import weakref
 
 try:
@@ -170,8 +182,12 @@ def get_actor_display_name(actor, truncate=250):
 
 
 class World(object):
-    def __init__(self, carla_world, hud, args):
-        self.world = carla_world
+    def __init__(self, client, hud, args, data_collector=None, dataset_recorder=None):
+        self.client = client
+        self.world = client.get_world()
+        self.data_collector = data_collector
+        self.dataset_recorder = dataset_recorder
+        self._radar_draw_interval = args.radar_draw_interval
         self.actor_role_name = args.rolename
         try:
             self.map = self.world.get_map()
@@ -180,6 +196,7 @@ class World(object):
             print('  The server could not send the OpenDRIVE (.xodr) file:')
             print('  Make sure it exists, has the same name of your town, and is correct.')
             sys.exit(1)
+        self.blueprints = blueprint_cache.get_cache(self.world, self.map, args.carla_version)
         self.hud = hud
         self.player = None
         self.collision_sensor = None
@@ -219,7 +236,7 @@ class World(object):
         cam_index = self.camera_manager.index if self.camera_manager is not None else 0
         cam_pos_index = self.camera_manager.transform_index if self.camera_manager is not None else 0
         # Get a random blueprint.
-        blueprint = random.choice(self.world.get_blueprint_library().filter(self._actor_filter))
+        blueprint = random.choice(self.blueprints.filter(self._actor_filter))
         blueprint.set_attribute('role_name', self.actor_role_name)
         if blueprint.has_attribute('color'):
             color = random.choice(blueprint.get_attribute('color').recommended_values)
@@ -242,26 +259,49 @@ class World(object):
             spawn_point.rotation.roll = 0.0
             spawn_point.rotation.pitch = 0.0
             self.destroy()
-            self.player = self.world.try_spawn_actor(blueprint, spawn_point)
+            self.player = self._spawn_player(blueprint, spawn_point)
         while self.player is None:
-            if not self.map.get_spawn_points():
+            spawn_points = self.blueprints.spawn_points()
+            if not spawn_points:
                 print('There are no spawn points available in your map/town.')
                 print('Please add some Vehicle Spawn Point to your UE4 scene.')
                 sys.exit(1)
-            spawn_points = self.map.get_spawn_points()
             spawn_point = random.choice(spawn_points) if spawn_points else carla.Transform()
-            self.player = self.world.try_spawn_actor(blueprint, spawn_point)
-        # Set up the sensors.
-        self.collision_sensor = CollisionSensor(self.player, self.hud)
-        self.lane_invasion_sensor = LaneInvasionSensor(self.player, self.hud)
-        self.gnss_sensor = GnssSensor(self.player)
-        self.imu_sensor = IMUSensor(self.player)
+            self.player = self._spawn_player(blueprint, spawn_point)
+        # Set up the sensors, spawned in a single batch.
         self.camera_manager = CameraManager(self.player, self.hud, self._gamma)
         self.camera_manager.transform_index = cam_pos_index
-        self.camera_manager.set_sensor(cam_index, notify=False)
+        commands = [
+            actor_batch.SpawnActor(self.blueprints.find(x.blueprint_id), x.transform, self.player.id)
+            for x in (CollisionSensor, LaneInvasionSensor, GnssSensor, IMUSensor)]
+        camera_command = self.camera_manager.spawn_command(cam_index)
+        if camera_command is not None:
+            commands.append(camera_command)
+        sensors, errors = actor_batch.spawn_actors(self.client, self.world, commands)
+        if errors:
+            actor_batch.destroy_actors(self.client, sensors)
+            raise RuntimeError('Could not spawn the sensors: %s' % '; '.join(errors))
+        self.collision_sensor = CollisionSensor(self.player, self.hud, sensors[0])
+        self.lane_invasion_sensor = LaneInvasionSensor(self.player, self.hud, sensors[1])
+        self.gnss_sensor = GnssSensor(self.player, sensors[2])
+        self.imu_sensor = IMUSensor(self.player, sensors[3])
+        self.camera_manager.set_sensor(
+            cam_index, notify=False, sensor=sensors[4] if camera_command is not None else None)
+        if self.dataset_recorder is not None:
+            recorder = self.dataset_recorder
+            self.collision_sensor.dataset_channel = recorder.channel('Collision', wait=False)
+            self.lane_invasion_sensor.dataset_channel = recorder.channel('Lane Invasion', wait=False)
+            self.gnss_sensor.dataset_channel = recorder.channel('GNSS')
+            self.imu_sensor.dataset_channel = recorder.channel('IMU')
+            self.camera_manager.dataset_channel = recorder.channel('Camera')
         actor_type = get_actor_display_name(self.player)
         self.hud.notification(actor_type)
 
+    def _spawn_player(self, blueprint, spawn_point):
+        # None if the spawn point is occupied
+        actors, _ = actor_batch.spawn_actors(self.client, self.world, [actor_batch.SpawnActor(blueprint, spawn_point)])
+        return actors[0]
+
     def next_weather(self, reverse=False):
         self._weather_index += -1 if reverse else 1
         self._weather_index %= len(self._weather_presets)
@@ -286,17 +326,32 @@ class World(object):
 
     def toggle_radar(self):
         if self.radar_sensor is None:
-            self.radar_sensor = RadarSensor(self.player)
+            self.radar_sensor = RadarSensor(self.player, self.data_collector, self._radar_draw_interval)
+            if self.dataset_recorder is not None:
+                self.radar_sensor.dataset_channel = self.dataset_recorder.channel('Radar')
         elif self.radar_sensor.sensor is not None:
             self.radar_sensor.sensor.destroy()
             self.radar_sensor = None
+            if self.dataset_recorder is not None:
+                self.dataset_recorder.remove('Radar')
+            if self.data_collector is not None:
+                self.data_collector.update_radar(None, None)
 
     def tick(self, clock):
         self.hud.tick(self, clock)
 
     def render(self, display):
-        self.camera_manager.render(display)
-        self.hud.render(display)
+        # Returns the regions of the display that changed, None if all of it did
+        rects = self.hud.dirty_rects()
+        if rects is None or self.camera_manager.frame_changed():
+            self.camera_manager.render(display)
+            self.hud.render(display)
+            return None
+        # Same camera frame, only restore it under the changed HUD regions
+        for rect in rects:
+            self.camera_manager.render(display, rect)
+        self.hud.render(display, rects)
+        return rects
 
     def destroy_sensors(self):
         self.camera_manager.sensor.destroy()
@@ -304,20 +359,18 @@ class World(object):
         self.camera_manager.index = None
 
     def destroy(self):
+        self.camera_manager.stop_recording()
         if self.radar_sensor is not None:
             self.toggle_radar()
-        sensors = [
+        # Sensors and player in a single batch
+        actors = [
             self.camera_manager.sensor,
             self.collision_sensor.sensor,
             self.lane_invasion_sensor.sensor,
             self.gnss_sensor.sensor,
-            self.imu_sensor.sensor]
-        for sensor in sensors:
-            if sensor is not None:
-                sensor.stop()
-                sensor.destroy()
-        if self.player is not None:
-            self.player.destroy()
+            self.imu_sensor.sensor,
+            self.player]
+        actor_batch.destroy_actors(self.client, actors)
 
 
 # ==============================================================================
@@ -343,6 +396,8 @@ class KeyboardControl(object):
         else:
             raise NotImplementedError("Actor type not supported")
         self._steer_cache = 0.0
+        # ClosedLoopMPC replacing the throttle of the keys, None to drive by hand
+        self.closed_loop = None
         world.hud.notification("Press 'H' or '?' for help.", seconds=4.0)
 
     def parse_events(self, client, world, clock):
@@ -514,7 +569,10 @@ class KeyboardControl(object):
                     world.player.set_light_state(carla.VehicleLightState(self._lights))
             elif isinstance(self._control, carla.WalkerControl):
                 self._parse_walker_keys(pygame.key.get_pressed(), clock.get_time(), world)
-            world.player.apply_control(self._control)
+            if self.closed_loop is not None and isinstance(self._control, carla.VehicleControl):
+                self.closed_loop.apply(world.player, self._control, world.hud.simulation_time)
+            else:
+                world.player.apply_control(self._control)
 
     def _parse_vehicle_keys(self, keys, milliseconds):
         if keys[K_UP] or keys[K_w]:
@@ -580,6 +638,10 @@ class HUD(object):
         mono = default_font if default_font in fonts else fonts[0]
         mono = pygame.font.match_font(mono)
         self._font_mono = pygame.font.Font(mono, 12 if os.name == 'nt' else 14)
+        self._info_panel = InfoPanel(self._font_mono, (220, height))
+        self._dirty = []  # Regions of the info panel changed by the last tick
+        self._redraw = True  # Everything has to be drawn again
+        self._notification_shown = False
         self._notifications = FadingText(font, (width, 40), (0, height - 40))
         self.help = HelpText(pygame.font.Font(mono, 16), width, height)
         self.server_fps = 0
@@ -588,6 +650,8 @@ class HUD(object):
         self._show_info = True
         self._info_text = []
         self._server_clock = pygame.time.Clock()
+        self._vehicle_index = None
+        self._collision_plot = np.zeros(200)
 
     def on_world_tick(self, timestamp):
         self._server_clock.tick()
@@ -597,6 +661,7 @@ class HUD(object):
 
     def tick(self, world, clock):
         self._notifications.tick(world, clock)
+        self._dirty = []
         if not self._show_info:
             return
         t = world.player.get_transform()
@@ -607,11 +672,13 @@ class HUD(object):
         heading += 'S' if 90.5 < compass < 269.5 else ''
         heading += 'E' if 0.5 < compass < 179.5 else ''
         heading += 'W' if 180.5 < compass < 359.5 else ''
-        colhist = world.collision_sensor.get_collision_history()
-        collision = [colhist[x + self.frame - 200] for x in range(0, 200)]
-        max_col = max(1.0, max(collision))
-        collision = [x / max_col for x in collision]
-        vehicles = world.world.get_actors().filter('vehicle.*')
+        collision = world.collision_sensor.get_collision_history(self.frame, len(self._collision_plot))
+        max_col = max(1.0, collision.max())
+        collision = np.divide(collision, max_col, out=self._collision_plot)
+        if self._vehicle_index is None:
+            self._vehicle_index = VehicleIndex(world.world)
+        vehicles = self._vehicle_index
+        vehicles.update()
         self._info_text = [
             'Server:  % 16.0f FPS' % self.server_fps,
             'Client:  % 16.0f FPS' % clock.get_fps(),
@@ -649,16 +716,32 @@ class HUD(object):
             'Number of vehicles: % 8d' % len(vehicles)]
         if len(vehicles) > 1:
             self._info_text += ['Nearby vehicles:']
-            distance = lambda l: math.sqrt((l.x - t.location.x)**2 + (l.y - t.location.y)**2 + (l.z - t.location.z)**2)
-            vehicles = [(distance(x.get_location()), x) for x in vehicles if x.id != world.player.id]
-            for d, vehicle in sorted(vehicles, key=lambda vehicles: vehicles[0]):
-                if d > 200.0:
-                    break
+            distances, indices = vehicles.query_radius((t.location.x, t.location.y, t.location.z), 200.0)
+            for d, index in zip(distances, indices):
+                vehicle = vehicles.actors[index]
+                if vehicle.id == world.player.id:
+                    continue
                 vehicle_type = get_actor_display_name(vehicle, truncate=22)
                 self._info_text.append('% 4dm %s' % (d, vehicle_type))
+        self._dirty = self._info_panel.update(self._info_text)
 
     def toggle_info(self):
         self._show_info = not self._show_info
+        self._info_panel.invalidate()
+        self._redraw = True
+
+    def dirty_rects(self):
+        # Regions of the display changed since the last render, None if
+        # everything has to be drawn again
+        if self._redraw or self.help.visible:
+            self._redraw = self.help.visible
+            return None
+        rects = list(self._dirty)
+        shown = self._notifications.seconds_left > 0.0
+        if shown or self._notification_shown:
+            rects.append(self._notifications.rect)
+        self._notification_shown = shown
+        return rects
 
     def notification(self, text, seconds=2.0):
         self._notifications.set_text(text, seconds=seconds)
@@ -666,41 +749,9 @@ class HUD(object):
     def error(self, text):
         self._notifications.set_text('Error: %s' % text, (255, 0, 0))
 
-    def render(self, display):
+    def render(self, display, rects=None):
         if self._show_info:
-            info_surface = pygame.Surface((220, self.dim[1]))
-            info_surface.set_alpha(100)
-            display.blit(info_surface, (0, 0))
-            v_offset = 4
-            bar_h_offset = 100
-            bar_width = 106
-            for item in self._info_text:
-                if v_offset + 18 > self.dim[1]:
-                    break
-                if isinstance(item, list):
-                    if len(item) > 1:
-                        points = [(x + 8, v_offset + 8 + (1.0 - y) * 30) for x, y in enumerate(item)]
-                        pygame.draw.lines(display, (255, 136, 0), False, points, 2)
-                    item = None
-                    v_offset += 18
-                elif isinstance(item, tuple):
-                    if isinstance(item[1], bool):
-                        rect = pygame.Rect((bar_h_offset, v_offset + 8), (6, 6))
-                        pygame.draw.rect(display, (255, 255, 255), rect, 0 if item[1] else 1)
-                    else:
-                        rect_border = pygame.Rect((bar_h_offset, v_offset + 8), (bar_width, 6))
-                        pygame.draw.rect(display, (255, 255, 255), rect_border, 1)
-                        f = (item[1] - item[2]) / (item[3] - item[2])
-                        if item[2] < 0.0:
-                            rect = pygame.Rect((bar_h_offset + f * (bar_width - 6), v_offset + 8), (6, 6))
-                        else:
-                            rect = pygame.Rect((bar_h_offset, v_offset + 8), (f * bar_width, 6))
-                        pygame.draw.rect(display, (255, 255, 255), rect)
-                    item = item[0]
-                if item:  # At this point has to be a str.
-                    surface = self._font_mono.render(item, True, (255, 255, 255))
-                    display.blit(surface, (8, v_offset))
-                v_offset += 18
+            self._info_panel.render(display, rects)
         self._notifications.render(display)
         self.help.render(display)
 
@@ -715,6 +766,7 @@ class FadingText(object):
         self.font = font
         self.dim = dim
         self.pos = pos
+        self.rect = pygame.Rect(pos, dim)
         self.seconds_left = 0
         self.surface = pygame.Surface(self.dim)
 
@@ -731,7 +783,8 @@ class FadingText(object):
         self.surface.set_alpha(500.0 * self.seconds_left)
 
     def render(self, display):
-        display.blit(self.surface, self.pos)
+        if self.seconds_left > 0.0:
+            display.blit(self.surface, self.pos)
 
 
 # ==============================================================================
@@ -759,6 +812,10 @@ class HelpText(object):
     def toggle(self):
         self._render = not self._render
 
+    @property
+    def visible(self):
+        return self._render
+
     def render(self, display):
         if self._render:
             display.blit(self.surface, self.pos)
@@ -770,24 +827,28 @@ class HelpText(object):
 
 
 class CollisionSensor(object):
-    def __init__(self, parent_actor, hud):
+    blueprint_id = 'sensor.other.collision'
+    transform = carla.Transform()
+
+    def __init__(self, parent_actor, hud, sensor=None):
+        # sensor is the sensor actor when it is already spawned
         self.sensor = None
-        self.history = []
+        self.dataset_channel = None
+        self.history = CollisionHistory(4000)
         self._parent = parent_actor
         self.hud = hud
-        world = self._parent.get_world()
-        bp = world.get_blueprint_library().find('sensor.other.collision')
-        self.sensor = world.spawn_actor(bp, carla.Transform(), attach_to=self._parent)
+        if sensor is None:
+            world = self._parent.get_world()
+            bp = blueprint_cache.get_cache(world).find(self.blueprint_id)
+            sensor = world.spawn_actor(bp, self.transform, attach_to=self._parent)
+        self.sensor = sensor
         # We need to pass the lambda a weak reference to self to avoid circular
         # reference.
         weak_self = weakref.ref(self)
         self.sensor.listen(lambda event: CollisionSensor._on_collision(weak_self, event))
 
-    def get_collision_history(self):
-        history = collections.defaultdict(int)
-        for frame, intensity in self.history:
-            history[frame] += intensity
-        return history
+    def get_collision_history(self, frame, length=200):
+        return self.history.window(length, frame)
 
     @staticmethod
     def _on_collision(weak_self, event):
@@ -798,9 +859,9 @@ class CollisionSensor(object):
         self.hud.notification('Collision with %r' % actor_type)
         impulse = event.normal_impulse
         intensity = math.sqrt(impulse.x**2 + impulse.y**2 + impulse.z**2)
-        self.history.append((event.frame, intensity))
-        if len(self.history) > 4000:
-            self.history.pop(0)
+        self.history.add(event.frame, intensity)
+        if self.dataset_channel is not None:
+            self.dataset_channel(event.frame, {'Intensity': intensity, 'Count': 1})
 
 
 # ==============================================================================
@@ -809,13 +870,20 @@ class CollisionSensor(object):
 
 
 class LaneInvasionSensor(object):
-    def __init__(self, parent_actor, hud):
+    blueprint_id = 'sensor.other.lane_invasion'
+    transform = carla.Transform()
+
+    def __init__(self, parent_actor, hud, sensor=None):
+        # sensor is the sensor actor when it is already spawned
         self.sensor = None
+        self.dataset_channel = None
         self._parent = parent_actor
         self.hud = hud
-        world = self._parent.get_world()
-        bp = world.get_blueprint_library().find('sensor.other.lane_invasion')
-        self.sensor = world.spawn_actor(bp, carla.Transform(), attach_to=self._parent)
+        if sensor is None:
+            world = self._parent.get_world()
+            bp = blueprint_cache.get_cache(world).find(self.blueprint_id)
+            sensor = world.spawn_actor(bp, self.transform, attach_to=self._parent)
+        self.sensor = sensor
         # We need to pass the lambda a weak reference to self to avoid circular
         # reference.
         weak_self = weakref.ref(self)
@@ -829,6 +897,8 @@ class LaneInvasionSensor(object):
         lane_types = set(x.type for x in event.crossed_lane_markings)
         text = ['%r' % str(x).split()[-1] for x in lane_types]
         self.hud.notification('Crossed line %s' % ' and '.join(text))
+        if self.dataset_channel is not None:
+            self.dataset_channel(event.frame, {'Count': 1})
 
 
 # ==============================================================================
@@ -837,14 +907,21 @@ class LaneInvasionSensor(object):
 
 
 class GnssSensor(object):
-    def __init__(self, parent_actor):
+    blueprint_id = 'sensor.other.gnss'
+    transform = carla.Transform(carla.Location(x=1.0, z=2.8))
+
+    def __init__(self, parent_actor, sensor=None):
+        # sensor is the sensor actor when it is already spawned
         self.sensor = None
+        self.dataset_channel = None
         self._parent = parent_actor
         self.lat = 0.0
         self.lon = 0.0
-        world = self._parent.get_world()
-        bp = world.get_blueprint_library().find('sensor.other.gnss')
-        self.sensor = world.spawn_actor(bp, carla.Transform(carla.Location(x=1.0, z=2.8)), attach_to=self._parent)
+        if sensor is None:
+            world = self._parent.get_world()
+            bp = blueprint_cache.get_cache(world).find(self.blueprint_id)
+            sensor = world.spawn_actor(bp, self.transform, attach_to=self._parent)
+        self.sensor = sensor
         # We need to pass the lambda a weak reference to self to avoid circular
         # reference.
         weak_self = weakref.ref(self)
@@ -857,6 +934,9 @@ class GnssSensor(object):
             return
         self.lat = event.latitude
         self.lon = event.longitude
+        if self.dataset_channel is not None:
+            self.dataset_channel(event.frame, {
+                'Latitude': event.latitude, 'Longitude': event.longitude, 'Altitude': event.altitude})
 
 
 # ==============================================================================
@@ -865,16 +945,23 @@ class GnssSensor(object):
 
 
 class IMUSensor(object):
-    def __init__(self, parent_actor):
+    blueprint_id = 'sensor.other.imu'
+    transform = carla.Transform()
+
+    def __init__(self, parent_actor, sensor=None):
+        # sensor is the sensor actor when it is already spawned
         self.sensor = None
+        self.dataset_channel = None
         self._parent = parent_actor
         self.accelerometer = (0.0, 0.0, 0.0)
         self.gyroscope = (0.0, 0.0, 0.0)
         self.compass = 0.0
-        world = self._parent.get_world()
-        bp = world.get_blueprint_library().find('sensor.other.imu')
-        self.sensor = world.spawn_actor(
-            bp, carla.Transform(), attach_to=self._parent)
+        if sensor is None:
+            world = self._parent.get_world()
+            bp = blueprint_cache.get_cache(world).find(self.blueprint_id)
+            sensor = world.spawn_actor(
+                bp, self.transform, attach_to=self._parent)
+        self.sensor = sensor
         # We need to pass the lambda a weak reference to self to avoid circular
         # reference.
         weak_self = weakref.ref(self)
@@ -896,6 +983,14 @@ class IMUSensor(object):
             max(limits[0], min(limits[1], math.degrees(sensor_data.gyroscope.y))),
             max(limits[0], min(limits[1], math.degrees(sensor_data.gyroscope.z))))
         self.compass = math.degrees(sensor_data.compass)
+        if self.dataset_channel is not None:
+            # Raw SI values, the clamping above is only for the HUD
+            accelerometer, gyroscope = sensor_data.accelerometer, sensor_data.gyroscope
+            self.dataset_channel(sensor_data.frame, {
+                'Accel X (m/s^2)': accelerometer.x, 'Accel Y (m/s^2)': accelerometer.y,
+                'Accel Z (m/s^2)': accelerometer.z, 'Gyro X (rad/s)': gyroscope.x,
+                'Gyro Y (rad/s)': gyroscope.y, 'Gyro Z (rad/s)': gyroscope.z,
+                'Compass (rad)': sensor_data.compass})
 
 
 # ==============================================================================
@@ -904,14 +999,22 @@ class IMUSensor(object):
 
 
 class RadarSensor(object):
-    def __init__(self, parent_actor,data_collector):
+    def __init__(self, parent_actor, data_collector, draw_interval=0.1, max_draw_points=200):
         self.sensor = None
         self._parent = parent_actor
         self.velocity_range = 7.5 # m/s
-        self.data_collector=data_collector
+        self.data_collector = data_collector
+        self.dataset_channel = None
+        # Debug drawing costs one RPC per point, it is throttled to one frame
+        # every draw_interval seconds of simulation and max_draw_points points
+        self.draw_interval = draw_interval
+        self.max_draw_points = max_draw_points
+        self._last_draw = None
+        self.nearest_distance = None
+        self.closing_speed = None
         world = self._parent.get_world()
         self.debug = world.debug
-        bp = world.get_blueprint_library().find('sensor.other.radar')
+        bp = blueprint_cache.get_cache(world).find('sensor.other.radar')
         bp.set_attribute('horizontal_fov', str(35))
         bp.set_attribute('vertical_fov', str(20))
         self.sensor = world.spawn_actor(
@@ -930,35 +1033,59 @@ class RadarSensor(object):
         self = weak_self()
         if not self:
             return
-        # To get a numpy [[vel, altitude, azimuth, depth],...[,,,]]:
-        # points = np.frombuffer(radar_data.raw_data, dtype=np.dtype('f4'))
-        # points = np.reshape(points, (len(radar_data), 4))
+        # A numpy [[vel, altitude, azimuth, depth],...[,,,]]
+        points = np.frombuffer(radar_data.raw_data, dtype=np.dtype('f4'))
+        points = np.reshape(points, (len(radar_data), 4))
+
+        # Nearest obstacle, the radar velocity is negative when approaching
+        if len(points) > 0:
+            nearest = np.argmin(points[:, 3])
+            self.nearest_distance = float(points[nearest, 3])
+            self.closing_speed = float(-points[nearest, 0])
+        else:
+            self.nearest_distance = None
+            self.closing_speed = None
+        if self.data_collector is not None:
+            self.data_collector.update_radar(self.nearest_distance, self.closing_speed)
+        if self.dataset_channel is not None:
+            self.dataset_channel(radar_data.frame, {
+                'Detections': len(points),
+                'Distance (m)': self.nearest_distance,
+                'Closing Speed (m/s)': self.closing_speed}, points)
+
+        if not self.draw_interval or len(points) == 0:
+            return
+        if self._last_draw is not None and radar_data.timestamp - self._last_draw < self.draw_interval:
+            return
+        self._last_draw = radar_data.timestamp
+        if len(points) > self.max_draw_points:
+            points = points[::int(math.ceil(len(points) / float(self.max_draw_points)))]
 
+        velocity, altitude, azimuth, depth = points[:, 0], points[:, 1], points[:, 2], points[:, 3]
         current_rot = radar_data.transform.rotation
-        for detect in radar_data:
-            azi = math.degrees(detect.azimuth)
-            alt = math.degrees(detect.altitude)
-            # The 0.25 adjusts a bit the distance so the dots can
-            # be properly seen
-            fw_vec = carla.Vector3D(x=detect.depth - 0.25)
-            carla.Transform(
-                carla.Location(),
-                carla.Rotation(
-                    pitch=current_rot.pitch + alt,
-                    yaw=current_rot.yaw + azi,
-                    roll=current_rot.roll)).transform(fw_vec)
-
-            def clamp(min_v, max_v, value):
-                return max(min_v, min(value, max_v))
-
-            norm_velocity = detect.velocity / self.velocity_range # range [-1, 1]
-            r = int(clamp(0.0, 1.0, 1.0 - norm_velocity) * 255.0)
-            g = int(clamp(0.0, 1.0, 1.0 - abs(norm_velocity)) * 255.0)
-            b = int(abs(clamp(- 1.0, 0.0, - 1.0 - norm_velocity)) * 255.0)
+        pitch = math.radians(current_rot.pitch) + altitude
+        yaw = math.radians(current_rot.yaw) + azimuth
+        # The 0.25 adjusts a bit the distance so the dots can
+        # be properly seen
+        distance = depth - 0.25
+        location = radar_data.transform.location
+        positions = np.empty((len(points), 3))
+        positions[:, 0] = location.x + distance * np.cos(pitch) * np.cos(yaw)
+        positions[:, 1] = location.y + distance * np.cos(pitch) * np.sin(yaw)
+        positions[:, 2] = location.z + distance * np.sin(pitch)
+
+        norm_velocity = velocity / self.velocity_range # range [-1, 1]
+        colors = np.empty((len(points), 3), dtype=np.int32)
+        colors[:, 0] = np.clip(1.0 - norm_velocity, 0.0, 1.0) * 255.0
+        colors[:, 1] = np.clip(1.0 - np.abs(norm_velocity), 0.0, 1.0) * 255.0
+        colors[:, 2] = np.abs(np.clip(-1.0 - norm_velocity, -1.0, 0.0)) * 255.0
+
+        life_time = max(0.06, self.draw_interval)
+        for (x, y, z), (r, g, b) in zip(positions.tolist(), colors.tolist()):
             self.debug.draw_point(
-                radar_data.transform.location + fw_vec,
+                carla.Location(x=x, y=y, z=z),
                 size=0.075,
-                life_time=0.06,
+                life_time=life_time,
                 persistent_lines=False,
                 color=carla.Color(r, g, b))
 
@@ -970,10 +1097,12 @@ class RadarSensor(object):
 class CameraManager(object):
     def __init__(self, parent_actor, hud, gamma_correction):
         self.sensor = None
-        self.surface = None
+        self._frame_buffer = FrameBuffer(hud.dim[0], hud.dim[1])
         self._parent = parent_actor
         self.hud = hud
         self.recording = False
+        self._recorder = None
+        self.dataset_channel = None
         bound_y = 0.5 + self._parent.bounding_box.extent.y
         Attachment = carla.AttachmentType
         self._camera_transforms = [
@@ -999,9 +1128,9 @@ class CameraManager(object):
                 'chromatic_aberration_intensity': '0.5',
                 'chromatic_aberration_offset': '0'}]]
         world = self._parent.get_world()
-        bp_library = world.get_blueprint_library()
+        blueprints = blueprint_cache.get_cache(world)
         for item in self.sensors:
-            bp = bp_library.find(item[0])
+            bp = blueprints.find(item[0])
             if item[0].startswith('sensor.camera'):
                 bp.set_attribute('image_size_x', str(hud.dim[0]))
                 bp.set_attribute('image_size_y', str(hud.dim[1]))
@@ -1024,19 +1153,30 @@ class CameraManager(object):
         self.transform_index = (self.transform_index + 1) % len(self._camera_transforms)
         self.set_sensor(self.index, notify=False, force_respawn=True)
 
-    def set_sensor(self, index, notify=True, force_respawn=False):
+    def spawn_command(self, index):
+        # SpawnActor command of a sensor for a batch, None if its attachment
+        # cannot be batched (only rigid attachments can)
+        transform, attachment_type = self._camera_transforms[self.transform_index]
+        if attachment_type != carla.AttachmentType.Rigid:
+            return None
+        return actor_batch.SpawnActor(self.sensors[index % len(self.sensors)][-1], transform, self._parent.id)
+
+    def set_sensor(self, index, notify=True, force_respawn=False, sensor=None):
+        # sensor is the sensor actor when it is already spawned
         index = index % len(self.sensors)
         needs_respawn = True if self.index is None else \
             (force_respawn or (self.sensors[index][2] != self.sensors[self.index][2]))
         if needs_respawn:
             if self.sensor is not None:
                 self.sensor.destroy()
-                self.surface = None
-            self.sensor = self._parent.get_world().spawn_actor(
-                self.sensors[index][-1],
-                self._camera_transforms[self.transform_index][0],
-                attach_to=self._parent,
-                attachment_type=self._camera_transforms[self.transform_index][1])
+                self._frame_buffer.clear()
+            if sensor is None:
+                sensor = self._parent.get_world().spawn_actor(
+                    self.sensors[index][-1],
+                    self._camera_transforms[self.transform_index][0],
+                    attach_to=self._parent,
+                    attachment_type=self._camera_transforms[self.transform_index][1])
+            self.sensor = sensor
             # We need to pass the lambda a weak reference to self to avoid
             # circular reference.
             weak_self = weakref.ref(self)
@@ -1050,11 +1190,25 @@ class CameraManager(object):
 
     def toggle_recording(self):
         self.recording = not self.recording
+        if self.recording:
+            self._recorder = FrameRecorder('_out')
+        else:
+            self.stop_recording()
         self.hud.notification('Recording %s' % ('On' if self.recording else 'Off'))
 
-    def render(self, display):
-        if self.surface is not None:
-            display.blit(self.surface, (0, 0))
+    def stop_recording(self):
+        # Stop recording, the frames already queued are still written
+        self.recording = False
+        if self._recorder is not None:
+            # Let the workers finish the last chunks without blocking the loop
+            threading.Thread(target=self._recorder.close).start()
+            self._recorder = None
+
+    def frame_changed(self):
+        return self._frame_buffer.changed()
+
+    def render(self, display, area=None):
+        self._frame_buffer.render(display, area)
 
     @staticmethod
     def _parse_image(weak_self, image):
@@ -1064,34 +1218,36 @@ class CameraManager(object):
         if self.sensors[self.index][0].startswith('sensor.lidar'):
             points = np.frombuffer(image.raw_data, dtype=np.dtype('f4'))
             points = np.reshape(points, (int(points.shape[0] / 4), 4))
-            lidar_data = np.array(points[:, :2])
-            lidar_data *= min(self.hud.dim) / (2.0 * self.lidar_range)
+            lidar_data = points[:, :2] * (min(self.hud.dim) / (2.0 * self.lidar_range))
             lidar_data += (0.5 * self.hud.dim[0], 0.5 * self.hud.dim[1])
-            lidar_data = np.fabs(lidar_data)  # pylint: disable=E1111
+            np.fabs(lidar_data, out=lidar_data)
             lidar_data = lidar_data.astype(np.int32)
-            lidar_data = np.reshape(lidar_data, (-1, 2))
-            lidar_img_size = (self.hud.dim[0], self.hud.dim[1], 3)
-            lidar_img = np.zeros((lidar_img_size), dtype=np.uint8)
+            # Drawn into the reusable uint8 canvas instead of a new image
+            lidar_img = self._frame_buffer.clear_canvas()
             lidar_img[tuple(lidar_data.T)] = (255, 255, 255)
-            self.surface = pygame.surfarray.make_surface(lidar_img)
+            self._frame_buffer.present_canvas()
+            record = points
         elif self.sensors[self.index][0].startswith('sensor.camera.dvs'):
             # Example of converting the raw_data from a carla.DVSEventArray
             # sensor into a NumPy array and using it as an image
             dvs_events = np.frombuffer(image.raw_data, dtype=np.dtype([
-                ('x', np.uint16), ('y', np.uint16), ('t', np.int64), ('pol', np.bool)]))
-            dvs_img = np.zeros((image.height, image.width, 3), dtype=np.uint8)
-            # Blue is positive, red is negative
-            dvs_img[dvs_events[:]['y'], dvs_events[:]['x'], dvs_events[:]['pol'] * 2] = 255
-            self.surface = pygame.surfarray.make_surface(dvs_img.swapaxes(0, 1))
+                ('x', np.uint16), ('y', np.uint16), ('t', np.int64), ('pol', np.bool_)]))
+            # The canvas is (width, height, 3). Blue is positive, red is negative
+            dvs_img = self._frame_buffer.clear_canvas()
+            dvs_img[dvs_events[:]['x'], dvs_events[:]['y'], dvs_events[:]['pol'] * 2] = 255
+            self._frame_buffer.present_canvas()
+            record = dvs_events
         else:
             image.convert(self.sensors[self.index][1])
+            self._frame_buffer.present_bgra(image.raw_data, image.width, image.height)
             array = np.frombuffer(image.raw_data, dtype=np.dtype("uint8"))
-            array = np.reshape(array, (image.height, image.width, 4))
-            array = array[:, :, :3]
-            array = array[:, :, ::-1]
-            self.surface = pygame.surfarray.make_surface(array.swapaxes(0, 1))
-        if self.recording:
-            image.save_to_disk('_out/%08d' % image.frame)
+            record = np.reshape(array, (image.height, image.width, 4))[:, :, :3]
+        recorder = self._recorder
+        if recorder is not None:
+            # Encoded and written by the recorder workers, off the sensor thread
+            recorder.submit(image.frame, record)
+        if self.dataset_channel is not None:
+            self.dataset_channel(image.frame, {}, record)
 
 
 # Simulation parameters for energy consumption
@@ -1130,8 +1286,12 @@ class DataCollector:
             'Altitude', 'GPS X', 'GPS Y', 'Heading',
             'Energy Consumed (J)', 'Total Force (N)', 'Precipitation', 'Cloudiness', 
             'Fog Density', 'Wind Speed (m/s)', 'Sun Azimuth Angle (°)', 'Sun Altitude Angle (°)',
+            'Radar Distance (m)', 'Radar Closing Speed (m/s)',
         ])
         self.time_accumulated = 0  # To accumulate time for periodic saving
+        # Latest radar features, written from the radar callback
+        self.radar_distance = None
+        self.radar_closing_speed = None
 
         # Simulation parameters for energy consumption
         self.rolling_coefficient = rolling_coefficient  # Approximate rolling coefficient
@@ -1143,7 +1303,8 @@ class DataCollector:
         self.energy_consumed = 0
         self.time_step = 0.1  # in seconds
 
-    def collect_data(self, vehicle, world, elapsed_time):
+    def collect_data(self, vehicle, world, elapsed_time, extra=None):
+        # extra holds additional columns, e.g. the closed-loop MPC record
         # Collecting data from the vehicle
         speed = round(self.get_speed(vehicle), 2)
         acceleration = round(self.get_acceleration(vehicle), 2)
@@ -1189,11 +1350,21 @@ class DataCollector:
             'Wind Speed (m/s)': wind_speed,
             'Sun Azimuth Angle (°)': sun_azimuth_angle,
             'Sun Altitude Angle (°)': sun_altitude_angle,
+            'Radar Distance (m)': self.radar_distance,
+            'Radar Closing Speed (m/s)': self.radar_closing_speed,
         }
+        if extra:
+            data_row.update(extra)
          # Convert data_row to a DataFrame
         new_data = pd.DataFrame([data_row])
 
         self.data = pd.concat([self.data, new_data], ignore_index=True)
+        return data_row
+
+    def update_radar(self, distance, closing_speed):
+        # Nearest obstacle seen by the radar, None when there is none
+        self.radar_distance = round(distance, 2) if distance is not None else None
+        self.radar_closing_speed = round(closing_speed, 2) if closing_speed is not None else None
 
     def get_speed(self, vehicle):
         velocity = vehicle.get_velocity()
@@ -1232,47 +1403,107 @@ def game_loop(args):
     pygame.font.init()
     world = None
     data_collector = DataCollector()
+    dataset_recorder = None
+    original_settings = None
+    traffic_manager = None
+    mpc_controller = None
+    controller = None
 
     try:
         client = carla.Client(args.host, args.port)
         client.set_timeout(200.0)
         weatherWorld = client.get_world()
+        args.carla_version = client.get_server_version()
+
+        if args.sync:
+            # One tick per collected row, every sensor measures the same frame
+            original_settings = weatherWorld.get_settings()
+            settings = weatherWorld.get_settings()
+            settings.synchronous_mode = True
+            settings.fixed_delta_seconds = data_collector.time_step
+            weatherWorld.apply_settings(settings)
+            traffic_manager = client.get_trafficmanager()
+            traffic_manager.set_synchronous_mode(True)
+        if args.record_dataset:
+            dataset_recorder = DatasetRecorder(
+                args.record_dataset,
+                payload_dir=os.path.splitext(args.record_dataset)[0] + '_payloads')
 
         display = pygame.display.set_mode(
             (args.width, args.height),
             pygame.HWSURFACE | pygame.DOUBLEBUF)
 
         hud = HUD(args.width, args.height)
-        world = World(client.get_world(), hud, args)
+        world = World(client, hud, args, data_collector, dataset_recorder)
         controller = KeyboardControl(world, args.autopilot)
 
         clock = pygame.time.Clock()
         start_time = time.time()
-        mpc_controller = MPCController(steps_ahead=10, dt=0.1)
+        # Solved in the background, the loop only reads the latest plan
+        mpc = MPCController(steps_ahead=10, dt=0.1)
+        mpc_controller = AsyncMPCController(mpc, processes=args.mpc_process)
+        if args.mpc_closed_loop:
+            controller.closed_loop = ClosedLoopMPC(
+                mpc_controller, mpc.snapshot, budget=args.mpc_budget / 1000.0, fallback=args.mpc_fallback)
+
+        if args.sync:
+            world.world.tick()
+            start_time = world.world.get_snapshot().timestamp.elapsed_seconds
 
         while True:
-            clock.tick_busy_loop(60)
-            elapsed_time = round(time.time() - start_time, 2)
+            if args.sync:
+                frame = world.world.tick()
+                # Frame time of the key handling, the HUD fades and the Excel saves
+                clock.tick()
+                elapsed_time = round(world.world.get_snapshot().timestamp.elapsed_seconds - start_time, 2)
+            else:
+                clock.tick_busy_loop(60)
+                elapsed_time = round(time.time() - start_time, 2)
             if controller.parse_events(client, world, clock):
                 return
             world.tick(clock)
-            world.render(display)
-            pygame.display.flip()
-
-            data_collector.collect_data(world.player, weatherWorld, elapsed_time)
-            predictedThrottle = mpc_controller.control(world.player)
-            print("Current : ",world.player.get_control().throttle)
-            print("Predicted : ",predictedThrottle)
+            update_display(world.render(display))
+
+            closed_loop = controller.closed_loop
+            data_row = data_collector.collect_data(
+                world.player, weatherWorld, elapsed_time, closed_loop.last if closed_loop is not None else None)
+            if dataset_recorder is not None:
+                dataset_recorder.record(frame, data_row)
+            if closed_loop is None:
+                init_state, throttle = mpc.snapshot(world.player)
+                mpc_controller.submit(init_state, throttle, elapsed_time)
+                predictedThrottle = mpc_controller.throttle(elapsed_time)
+                print("Current : ", throttle)
+                print("Predicted : ", predictedThrottle)
             data_collector.time_accumulated += clock.get_time()  # Add the time since the last frame (ms)
 
             if data_collector.time_accumulated >= 3000:  # Every 3 seconds
                 data_collector.save_to_excel()
                 data_collector.time_accumulated = 0  # Reset the accumulator
-            time.sleep(0.1)  # Sleep for time_step
+            if not args.sync:
+                time.sleep(0.1)  # Sleep for time_step
     finally:
+        if not data_collector.data.empty:
+            # The rows since the last periodic save
+            data_collector.save_to_excel()
+
+        if mpc_controller is not None:
+            if controller is not None and controller.closed_loop is not None:
+                print(controller.closed_loop.summary())
+            mpc_controller.close()
+
+        if original_settings is not None:
+            weatherWorld.apply_settings(original_settings)
+            traffic_manager.set_synchronous_mode(False)
+
         if world is not None:
             world.destroy()
 
+        if dataset_recorder is not None:
+            dataset_recorder.close()
+            print('Dataset: %d rows written to %s (%d incomplete)' % (
+                len(dataset_recorder), args.record_dataset, dataset_recorder.incomplete))
+
         pygame.quit()
 
 
@@ -1282,9 +1513,12 @@ def game_loop(args):
 # ==============================================================================
 
 class MPCController:
-    def __init__(self, steps_ahead=10, dt=0.1):
+    def __init__(self, steps_ahead=10, dt=0.1, speed_weight=200.0, smoothness_weight=5.0):
         self.steps_ahead = steps_ahead
         self.dt = dt
+        # Cost weights of the low speed and throttle change penalties
+        self.speed_weight = speed_weight
+        self.smoothness_weight = smoothness_weight
         self.bounds = [(0, None)] * steps_ahead + [(0, 1)] * steps_ahead  # Acceleration >= 0, Throttle 0 to 1
 
     def objective(self, control_vars, init_state):
@@ -1302,21 +1536,24 @@ class MPCController:
             energy_cost = power * self.dt  # Fuel consumption cost
 
             # Penalty for very low speeds to encourage forward movement
-            min_speed_penalty = 200 / max(v, 0.1)
+            min_speed_penalty = self.speed_weight / max(v, 0.1)
 
             # Smooth throttle change penalty to prevent rapid changes
-            throttle_change_cost = abs(throttle - (control_vars[self.steps_ahead + t - 1] if t > 0 else 0.5)) * 5
+            throttle_change_cost = abs(throttle - (control_vars[self.steps_ahead + t - 1] if t > 0 else 0.5)) * self.smoothness_weight
 
             cost += energy_cost + min_speed_penalty + throttle_change_cost
 
         return cost
 
-    def control(self, vehicle):
-        # Initial state (position, speed, acceleration) of the vehicle
+    def snapshot(self, vehicle):
+        # Initial state (position, speed, acceleration) and current throttle of the vehicle
         init_state = (vehicle.get_location().x, get_speed(vehicle), get_acceleration(vehicle))
+        return init_state, vehicle.get_control().throttle
 
+    def solve(self, init_state, throttle):
+        # Optimized throttle sequence over the horizon, None if the optimization failed
         # Initial guess for control variables: moderate acceleration and throttle
-        control_vars = [get_acceleration(vehicle) + 0.02] * self.steps_ahead + [vehicle.get_control().throttle+ 0.05] * self.steps_ahead
+        control_vars = [init_state[2] + 0.02] * self.steps_ahead + [throttle + 0.05] * self.steps_ahead
 
         # Run the optimization
         result = minimize(self.objective, control_vars, args=(init_state,), bounds=self.bounds, method='SLSQP')
@@ -1324,9 +1561,15 @@ class MPCController:
         # Check optimization result
         if result.success:
             #print(f"Optimization Success: Cost={result.fun}, Throttle values={result.x[self.steps_ahead:self.steps_ahead*2]}")
-            return result.x[self.steps_ahead]  # Return the first optimized throttle value
+            return result.x[self.steps_ahead:]
+        #print(f"Optimization Failed: {result.message}")
+        return None
+
+    def control(self, vehicle):
+        throttles = self.solve(*self.snapshot(vehicle))
+        if throttles is not None:
+            return throttles[0]  # Return the first optimized throttle value
         else:
-            #print(f"Optimization Failed: {result.message}")
             return 0.5
 
 
@@ -1386,8 +1629,46 @@ def main():
         default=2.2,
         type=float,
         help='Gamma correction of the camera (default: 2.2)')
+    argparser.add_argument(
+        '--radar-draw-interval',
+        default=0.1,
+        type=float,
+        help='Seconds between two debug drawings of the radar detections, 0 disables them (default: 0.1)')
+    argparser.add_argument(
+        '--sync',
+        action='store_true',
+        help='Synchronous mode execution, one simulation step per collected row')
+    argparser.add_argument(
+        '--record-dataset',
+        metavar='FILE',
+        default=None,
+        help='Record every sensor aligned by frame into FILE (.parquet or .csv) and the '
+             'images and point clouds next to it, implies --sync')
+    argparser.add_argument(
+        '--mpc-process',
+        action='store_true',
+        help='Solve the MPC in a worker process instead of a thread, so it does not compete '
+             'with the render loop for the GIL')
+    argparser.add_argument(
+        '--mpc-closed-loop',
+        action='store_true',
+        help='Apply the MPC throttle to the vehicle, the keys only steer and brake')
+    argparser.add_argument(
+        '--mpc-budget',
+        metavar='MS',
+        default=50.0,
+        type=float,
+        help='Time a tick waits for the MPC solve of its state before falling back (default: 50)')
+    argparser.add_argument(
+        '--mpc-fallback',
+        choices=FALLBACKS,
+        default='plan',
+        help='Throttle applied when the solve misses the budget: the latest older plan, the '
+             'throttle of the keys or the last applied throttle (default: plan)')
     args = argparser.parse_args()
 
+    if args.record_dataset:
+        args.sync = True
     args.width, args.height = [int(x) for x in args.res.split('x')]
 
     log_level = logging.DEBUG if args.debug else logging.INFO
@@ -0,0 +1,125 @@
+"""
+Compact binary storage of the road geometry of a map.
+
+The road edges drawn by draw_spawnPoints are stored as one float32 (N, 2)
+array of world coordinates holding every polyline back to back, with an
+offsets array marking where each line starts, the road id of every line and
+the spawn points. The file is a small JSON header followed by the raw arrays,
+each aligned on 64 bytes, so they are memory-mapped on load instead of being
+parsed, and it does not depend on carla or on any class definition:
+
+    geometry = MapGeometry.load('/tmp/map_geometry.bin')
+    for road_id, line in zip(geometry.road_ids, geometry.lines()):
+        plot(line[:, 0], -line[:, 1])
+
+Layout: magic (8 bytes) | header length (uint32, little endian) | JSON header |
+padding | arrays. The header gives the map name and, for every array, its
+dtype, shape and byte offset from the start of the file.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'MAPGEO01'
+ALIGNMENT = 64
+
+# Array name -> dtype, as stored in the file
+ARRAYS = (
+    ('coords', '<f4'),  # (N, 2) x, y of every line point, world coordinates
+    ('offsets', '<i8'),  # (L + 1,) start of each line in coords
+    ('road_ids', '<i4'),  # (L,) road id of each line
+    ('spawn_points', '<f4'),  # (S, 6) x, y, z, pitch, yaw, roll
+)
+
+
+class MapGeometry(object):
+    """Road polylines, road ids and spawn points of a map"""
+
+    def __init__(self, map_name, coords, offsets, road_ids, spawn_points):
+        """Constructor method"""
+        self.map_name = map_name
+        self.coords = coords
+        self.offsets = offsets
+        self.road_ids = road_ids
+        self.spawn_points = spawn_points
+
+    @classmethod
+    def from_lines(cls, map_name, lines, road_ids, spawn_points):
+        """Builds the geometry from a list of (n, 2) point arrays"""
+        lengths = [len(line) for line in lines]
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if lines:
+            coords = np.concatenate(lines).astype(np.float32)
+        else:
+            coords = np.empty((0, 2), dtype=np.float32)
+        return cls(
+            map_name, coords, offsets,
+            np.asarray(road_ids, dtype=np.int32),
+            np.asarray(spawn_points, dtype=np.float32).reshape(-1, 6))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, index):
+        """(n, 2) view of the points of one line"""
+        return self.coords[self.offsets[index]:self.offsets[index + 1]]
+
+    def lines(self):
+        """Views of the points of every line"""
+        return [self.coords[start:end] for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def bounds(self):
+        """((min x, min y), (max x, max y)) of the road points"""
+        return self.coords.min(axis=0), self.coords.max(axis=0)
+
+    def save(self, filename):
+        """Writes the geometry to a file"""
+        arrays = [(name, np.ascontiguousarray(getattr(self, name), dtype=dtype)) for name, dtype in ARRAYS]
+        # The header size depends on the offsets it holds, lay the arrays out
+        # assuming a generous header and grow it until it fits
+        data_start = ALIGNMENT * 4
+        while True:
+            entries = {}
+            position = data_start
+            for name, array in arrays:
+                entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+                position = _align(position + array.nbytes)
+            header = json.dumps({'map': self.map_name, 'arrays': entries}).encode('utf-8')
+            if len(MAGIC) + 4 + len(header) <= data_start:
+                break
+            data_start = _align(len(MAGIC) + 4 + len(header))
+        with open(filename, 'wb') as geometry_file:
+            geometry_file.write(MAGIC)
+            geometry_file.write(struct.pack('<I', len(header)))
+            geometry_file.write(header)
+            for name, array in arrays:
+                geometry_file.write(b'\0' * (entries[name]['offset'] - geometry_file.tell()))
+                geometry_file.write(array.tobytes())
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """Reads a geometry file, memory-mapping its arrays unless mmap is False"""
+        with open(filename, 'rb') as geometry_file:
+            magic = geometry_file.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError('%s is not a map geometry file' % filename)
+            header_length, = struct.unpack('<I', geometry_file.read(4))
+            header = json.loads(geometry_file.read(header_length).decode('utf-8'))
+        arrays = {}
+        for name, entry in header['arrays'].items():
+            shape = tuple(entry['shape'])
+            if mmap and int(np.prod(shape)) > 0:
+                arrays[name] = np.memmap(
+                    filename, dtype=entry['dtype'], mode='r', offset=entry['offset'], shape=shape)
+            else:
+                count = int(np.prod(shape))
+                arrays[name] = np.fromfile(
+                    filename, dtype=entry['dtype'], count=count, offset=entry['offset']).reshape(shape)
+        return cls(header['map'], arrays['coords'], arrays['offsets'], arrays['road_ids'], arrays['spawn_points'])
+
+
+def _align(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+"""
+Route energy estimation on a cached road graph.
+
+The map topology is sampled once from the server into a networkx graph,
+one edge per lane segment holding its sampled points, road id and speed limit,
+and cached to disk per map, so later runs do not need a server. The energy of
+driving each segment is predicted with the road-load model shared with the MPC
+(MPC/utils.calculate_forces): cruising at the expected speed over the sampled
+grade, plus the kinetic energy needed to speed up between segments. All the
+spawn point to spawn point routes are precomputed in parallel into a lookup
+table, so picking an energy efficient spawn / destination pair is a table
+lookup:
+
+    python route_energy.py --map Town04                    # build the table
+    python route_energy.py --map Town04 --query 300 200    # routes between two spawn points
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import networkx as nx
+import numpy as np
+
+MPC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MPC')
+sys.path.append(MPC_DIR)
+
+from utils import calculate_forces, read_config_file  # pylint: disable=import-error
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+CONFIG_FILE = os.path.join(MPC_DIR, 'config.ini')
+
+# OpenDRIVE type of the speed limit signals
+SPEED_LIMIT_TYPE = '274'
+# Speed limit of the roads without a sign (km/h), the CARLA default
+DEFAULT_SPEED_LIMIT = 30.0
+
+
+# ==============================================================================
+# -- Road graph ----------------------------------------------------------------
+# ==============================================================================
+
+
+def get_speed_limits(carla_map):
+    """Speed limit (km/h) of the roads of a map that have a speed limit sign, by road id"""
+    return dict((landmark.road_id, landmark.value)
+                for landmark in carla_map.get_all_landmarks_of_type(SPEED_LIMIT_TYPE))
+
+
+def segment_energy(xyz, speed, parameters, regen_efficiency=0.0):
+    """
+    Energy (J) and distance (m) from the first point of a polyline, given as
+    an (n, 3) array, to each of its points, cruising at `speed` (m/s) over its
+    grade. The negative work of downhill stretches is recovered with
+    `regen_efficiency`.
+    """
+    steps = np.diff(xyz, axis=0)
+    horizontal = np.hypot(steps[:, 0], steps[:, 1])
+    lengths = np.sqrt(horizontal ** 2 + steps[:, 2] ** 2)
+    grades = np.arctan2(steps[:, 2], np.maximum(horizontal, 1e-6))
+    work = calculate_forces(speed, 0.0, parameters, grades) * lengths
+    work = np.where(work > 0.0, work, regen_efficiency * work)
+    return np.concatenate(([0.0], np.cumsum(work))), np.concatenate(([0.0], np.cumsum(lengths)))
+
+
+def build_road_graph(carla_map, sampling_resolution=2.0, default_speed_limit=DEFAULT_SPEED_LIMIT):
+    """
+    Samples the topology of a map into a directed graph. Nodes are the segment
+    ends (x, y, z), edges hold the points sampled every `sampling_resolution`
+    meters along the segment, its road id, whether it is in a junction and its
+    speed limit (km/h). The map spawn points are kept as (x, y, z, yaw) rows in
+    graph.graph['spawn_points'].
+    """
+    speed_limits = get_speed_limits(carla_map)
+
+    graph = nx.DiGraph(map=carla_map.name.split('/')[-1], sampling_resolution=sampling_resolution)
+    node_ids = {}
+
+    def get_node(location):
+        # Segment ends closer than a meter are the same node, like GlobalRoutePlanner
+        key = tuple(np.round([location.x, location.y, location.z], 0))
+        if key not in node_ids:
+            node_ids[key] = len(node_ids)
+            graph.add_node(node_ids[key], x=location.x, y=location.y, z=location.z)
+        return node_ids[key]
+
+    for entry, exit_waypoint in carla_map.get_topology():
+        end = exit_waypoint.transform.location
+        points = [entry.transform.location]
+        nxt = entry.next(sampling_resolution)
+        waypoint = nxt[0] if nxt else None
+        while waypoint is not None and waypoint.transform.location.distance(end) > sampling_resolution:
+            points.append(waypoint.transform.location)
+            nxt = waypoint.next(sampling_resolution)
+            waypoint = nxt[0] if nxt else None
+        points.append(end)
+        graph.add_edge(
+            get_node(entry.transform.location), get_node(end),
+            x=[round(p.x, 2) for p in points],
+            y=[round(p.y, 2) for p in points],
+            z=[round(p.z, 2) for p in points],
+            road_id=entry.road_id,
+            junction=entry.is_junction,
+            speed_limit=float(speed_limits.get(entry.road_id, default_speed_limit)))
+
+    graph.graph['spawn_points'] = [
+        [t.location.x, t.location.y, t.location.z, t.rotation.yaw] for t in carla_map.get_spawn_points()]
+    return graph
+
+
+def road_graph_path(map_name, sampling_resolution=2.0):
+    """Path of the cached road graph of a map"""
+    return os.path.join(CACHE_DIR, 'road_graph_%s_%s.json' % (map_name, sampling_resolution))
+
+
+def save_road_graph(graph):
+    """Caches a road graph"""
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    content = {
+        'graph': graph.graph,
+        'nodes': [[n, d['x'], d['y'], d['z']] for n, d in graph.nodes(data=True)],
+        'edges': [dict(data, u=u, v=v) for u, v, data in graph.edges(data=True)]}
+    with open(road_graph_path(graph.graph['map'], graph.graph['sampling_resolution']), 'w') as graph_file:
+        json.dump(content, graph_file)
+
+
+def load_road_graph(map_name, sampling_resolution=2.0):
+    """Returns the cached road graph of a map, None if there is none"""
+    filename = road_graph_path(map_name, sampling_resolution)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as graph_file:
+        content = json.load(graph_file)
+    graph = nx.DiGraph(**content['graph'])
+    for n, x, y, z in content['nodes']:
+        graph.add_node(n, x=x, y=y, z=z)
+    for data in content['edges']:
+        graph.add_edge(data.pop('u'), data.pop('v'), **data)
+    return graph
+
+
+def get_road_graph(carla_map, sampling_resolution=2.0):
+    """Road graph of a map, built from the server the first time only"""
+    graph = load_road_graph(carla_map.name.split('/')[-1], sampling_resolution)
+    if graph is None:
+        graph = build_road_graph(carla_map, sampling_resolution)
+        save_road_graph(graph)
+    return graph
+
+
+# ==============================================================================
+# -- RouteEnergyModel ----------------------------------------------------------
+# ==============================================================================
+
+
+class RouteEnergyModel(object):
+    """
+    Predicted energy (J) of the edges and routes of a road graph for one vehicle.
+
+    Each edge is driven at its speed limit (capped at `max_speed`, m/s), the
+    road load is integrated over its sampled grade and the negative work of
+    downhill stretches is recovered with `regen_efficiency`. A route also pays
+    the kinetic energy of every speed increase, starting from rest. The edge
+    energies are stored as the 'energy' edge attribute. With regen they can be
+    negative, which Dijkstra does not support, so the routes are searched on
+    'search_energy', the energy clamped at 0, and reported with their signed
+    energy.
+    """
+
+    def __init__(self, graph, parameters=None, max_speed=None, regen_efficiency=0.0):
+        """Constructor method"""
+        self.graph = graph
+        self.parameters = parameters if parameters is not None else read_config_file(CONFIG_FILE)
+        self.max_speed = max_speed
+        self.regen_efficiency = regen_efficiency
+        # Energy and length from the start of each edge to each of its points
+        self._cumulative = {}
+        self._cumulative_length = {}
+        locate_points = []
+        locate_edges = []
+        for u, v, data in graph.edges(data=True):
+            xyz = np.stack((data['x'], data['y'], data['z']), axis=1)
+            speed = self.edge_speed(data)
+            cumulative, cumulative_length = segment_energy(xyz, speed, self.parameters, self.regen_efficiency)
+            self._cumulative[(u, v)] = cumulative
+            self._cumulative_length[(u, v)] = cumulative_length
+            data['length'] = float(cumulative_length[-1])
+            data['speed'] = speed
+            data['energy'] = float(cumulative[-1])
+            # Downhill recovery does not make an edge free
+            data['search_energy'] = max(data['energy'], 0.0)
+            # Points with the heading of the step leaving them, to locate spawn points
+            steps = np.diff(xyz, axis=0)
+            yaw = np.degrees(np.arctan2(steps[:, 1], steps[:, 0]))
+            yaw = np.append(yaw, yaw[-1]) if len(yaw) else np.zeros(1)
+            locate_points.append(np.stack((xyz[:, 0], xyz[:, 1], yaw), axis=1))
+            locate_edges.extend((u, v, i) for i in range(len(xyz)))
+        self._locate_points = np.concatenate(locate_points) if locate_points else np.empty((0, 3))
+        self._locate_edges = locate_edges
+        self.spawn_points = np.asarray(graph.graph.get('spawn_points', []), dtype=np.float64).reshape(-1, 4)
+        # (u, v, index) of the edge point each spawn point is on
+        self.spawn_locations = [self.locate(x, y, yaw) for x, y, _, yaw in self.spawn_points]
+
+    def edge_speed(self, data):
+        """Expected speed on an edge (m/s)"""
+        speed = data['speed_limit'] / 3.6
+        if self.max_speed is not None:
+            speed = min(speed, self.max_speed)
+        return speed
+
+    def locate(self, x, y, yaw=None):
+        """
+        Returns (u, v, index), the edge point nearest to a location, among the
+        points heading within 90 degrees of `yaw` when it is given.
+        """
+        points = self._locate_points
+        distances = np.hypot(points[:, 0] - x, points[:, 1] - y)
+        if yaw is not None:
+            heading = np.abs((points[:, 2] - yaw + 180.0) % 360.0 - 180.0)
+            distances = np.where(heading < 90.0, distances, np.inf)
+        return self._locate_edges[int(np.argmin(distances))]
+
+    def partial_energy(self, u, v, start=0, end=None):
+        """Energy between two points of an edge"""
+        cumulative = self._cumulative[(u, v)]
+        return float(cumulative[-1 if end is None else end] - cumulative[start])
+
+    def partial_length(self, u, v, start=0, end=None):
+        """Distance between two points of an edge"""
+        cumulative = self._cumulative_length[(u, v)]
+        return float(cumulative[-1 if end is None else end] - cumulative[start])
+
+    def speed_change_energy(self, speeds):
+        """Kinetic energy of the speed increases along a sequence of speeds, starting from rest"""
+        speeds = np.concatenate(([0.0], speeds))
+        gains = np.diff(speeds ** 2)
+        return float(0.5 * self.parameters['mass'] * np.sum(gains[gains > 0.0]))
+
+    def spawn_route(self, origin, destination, path=None):
+        """
+        Returns (energy, length, path) of the route between two spawn point
+        indices, following `path` (graph nodes) or the minimum-energy path.
+        energy is inf when the destination cannot be reached.
+        """
+        u1, v1, k1 = self.spawn_locations[origin]
+        u2, v2, k2 = self.spawn_locations[destination]
+        if origin == destination:
+            # Staying put, no speed change to pay for
+            return 0.0, 0.0, [u1, v1]
+        if (u1, v1) == (u2, v2) and k1 <= k2:
+            data = self.graph[u1][v1]
+            energy = self.partial_energy(u1, v1, k1, k2) + self.speed_change_energy([data['speed']])
+            return energy, self.partial_length(u1, v1, k1, k2), [u1, v1]
+        if path is None:
+            try:
+                path = nx.shortest_path(self.graph, v1, u2, weight='search_energy')
+            except nx.NetworkXNoPath:
+                return float('inf'), float('inf'), []
+        return self.route_through(u1, v1, k1, path, u2, v2, k2)
+
+    def route_through(self, u1, v1, k1, path, u2, v2, k2):
+        """
+        Returns (energy, length, path) of the route from point k1 of edge
+        (u1, v1) to point k2 of edge (u2, v2) following `path`, the graph
+        nodes from v1 to u2.
+        """
+        edges = [(u1, v1)] + list(zip(path[:-1], path[1:])) + [(u2, v2)]
+        speeds = [self.graph[u][v]['speed'] for u, v in edges]
+        energy = self.partial_energy(u1, v1, k1) + self.partial_energy(u2, v2, 0, k2)
+        length = self.partial_length(u1, v1, k1) + self.partial_length(u2, v2, 0, k2)
+        for u, v in edges[1:-1]:
+            energy += self.graph[u][v]['energy']
+            length += self.graph[u][v]['length']
+        energy += self.speed_change_energy(speeds)
+        return energy, length, [u1] + list(path) + [v2]
+
+    def candidate_routes(self, origin, destination, k=3):
+        """
+        Up to k routes between two spawn points, the k shortest in distance
+        and the minimum-energy one, as (energy, length, path) sorted by energy.
+        """
+        _, v1, _ = self.spawn_locations[origin]
+        u2, _, _ = self.spawn_locations[destination]
+        routes = {}
+        try:
+            paths = nx.shortest_simple_paths(self.graph, v1, u2, weight='length')
+            for path in paths:
+                routes[tuple(path)] = self.spawn_route(origin, destination, path)
+                if len(routes) >= k:
+                    break
+            path = nx.shortest_path(self.graph, v1, u2, weight='search_energy')
+            routes[tuple(path)] = self.spawn_route(origin, destination, path)
+        except nx.NetworkXNoPath:
+            pass
+        if not routes:
+            # Same edge, or unreachable
+            routes[()] = self.spawn_route(origin, destination)
+        return sorted(routes.values(), key=lambda route: route[0])
+
+
+# ==============================================================================
+# -- Lookup table --------------------------------------------------------------
+# ==============================================================================
+
+
+_worker_model = None
+
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def _lookup_row(origin):
+    """Energies and lengths of the minimum-energy routes from one spawn point to all the others"""
+    model = _worker_model
+    count = len(model.spawn_points)
+    energies = np.full(count, np.inf)
+    lengths = np.full(count, np.inf)
+    u1, v1, k1 = model.spawn_locations[origin]
+    # One Dijkstra per origin gives the paths to every destination
+    _, paths = nx.single_source_dijkstra(model.graph, v1, weight='search_energy')
+    for destination in range(count):
+        u2, v2, k2 = model.spawn_locations[destination]
+        if (u1, v1) == (u2, v2) and k1 <= k2:
+            energies[destination], lengths[destination], _ = model.spawn_route(origin, destination)
+        elif u2 in paths:
+            energies[destination], lengths[destination], _ = model.route_through(
+                u1, v1, k1, paths[u2], u2, v2, k2)
+    return energies, lengths
+
+
+class EnergyLookup(object):
+    """Precomputed energy (J) and length (m) of the routes between every two spawn points"""
+
+    def __init__(self, energy, length):
+        """Constructor method"""
+        self.energy = energy
+        self.length = length
+
+    @classmethod
+    def build(cls, model, workers=None):
+        """Computes the table, one origin per task on a process pool"""
+        count = len(model.spawn_points)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model,)) as executor:
+            rows = list(executor.map(_lookup_row, range(count), chunksize=max(1, count // 64)))
+        energy = np.array([row[0] for row in rows]).reshape(count, count)
+        length = np.array([row[1] for row in rows]).reshape(count, count)
+        return cls(energy, length)
+
+    @staticmethod
+    def path(map_name, model):
+        """Cache file of a table, specific to the vehicle parameters and speed model"""
+        key = json.dumps([sorted(model.parameters.items()), model.max_speed, model.regen_efficiency,
+                          model.graph.graph['sampling_resolution'], 'search_energy'])
+        return os.path.join(CACHE_DIR, 'route_energy_%s_%08x.npz' % (map_name, zlib.crc32(key.encode('utf-8')) & 0xffffffff))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as archive:
+            energy, length = archive['energy'], archive['length']
+        # Tables cached before the diagonal was 0 charged the start from rest
+        np.fill_diagonal(energy, 0.0)
+        np.fill_diagonal(length, 0.0)
+        return cls(energy, length)
+
+    def save(self, filename):
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        np.savez(filename, energy=self.energy, length=self.length)
+
+    def route(self, origin, destination):
+        """(energy, length) of the route between two spawn points"""
+        return self.energy[origin, destination], self.length[origin, destination]
+
+    def best_destination(self, origin, candidates=None):
+        """Destination reachable with the least energy from a spawn point"""
+        candidates = np.arange(len(self.energy)) if candidates is None else np.asarray(candidates)
+        energies = self.energy[origin, candidates]
+        energies = np.where(candidates == origin, np.inf, energies)
+        return int(candidates[np.argmin(energies)])
+
+    def energy_per_km(self):
+        """Wh/km of every route, inf when unreachable"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.length > 0.0, self.energy / 3.6 / self.length, np.inf)
+
+
+def get_lookup(map_name, model, workers=None):
+    """Lookup table of a map and model, computed the first time only"""
+    filename = EnergyLookup.path(map_name, model)
+    if os.path.exists(filename):
+        return EnergyLookup.load(filename)
+    lookup = EnergyLookup.build(model, workers)
+    lookup.save(filename)
+    return lookup
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument(
+        '--host',
+        metavar='H',
+        default='127.0.0.1',
+        help='IP of the host server (default: 127.0.0.1)')
+    argparser.add_argument(
+        '-p', '--port',
+        metavar='P',
+        default=2000,
+        type=int,
+        help='TCP port to listen to (default: 2000)')
+    argparser.add_argument(
+        '-m', '--map',
+        default=None,
+        help='Map name, the server is not needed when its graph is cached (default: map loaded on the server)')
+    argparser.add_argument(
+        '-r', '--sampling-resolution',
+        default=2.0,
+        type=float,
+        help='Distance between the sampled points of the road graph in meters (default: 2.0)')
+    argparser.add_argument(
+        '--max-speed',
+        default=None,
+        type=float,
+        help='Cap of the expected speed in km/h (default: speed limits only)')
+    argparser.add_argument(
+        '--regen-efficiency',
+        default=0.0,
+        type=float,
+        help='Fraction of the downhill energy recovered (default: 0.0)')
+    argparser.add_argument(
+        '--workers',
+        default=None,
+        type=int,
+        help='Processes computing the lookup table (default: one per CPU)')
+    argparser.add_argument(
+        '--query',
+        nargs=2,
+        type=int,
+        metavar=('SPAWN', 'DEST'),
+        help='Print the candidate routes between two spawn point indices')
+    argparser.add_argument(
+        '--candidates',
+        default=3,
+        type=int,
+        help='Number of candidate routes printed by --query (default: 3)')
+    args = argparser.parse_args()
+
+    graph = load_road_graph(args.map, args.sampling_resolution) if args.map else None
+    if graph is None:
+        import carla  # pylint: disable=import-error
+        client = carla.Client(args.host, args.port)
+        client.set_timeout(60.0)
+        world = client.get_world()
+        if args.map and world.get_map().name.split('/')[-1] != args.map:
+            world = client.load_world(args.map)
+        graph = get_road_graph(world.get_map(), args.sampling_resolution)
+
+    max_speed = args.max_speed / 3.6 if args.max_speed else None
+    model = RouteEnergyModel(graph, max_speed=max_speed, regen_efficiency=args.regen_efficiency)
+    lookup = get_lookup(graph.graph['map'], model, args.workers)
+
+    if args.query:
+        origin, destination = args.query
+        energy, length = lookup.route(origin, destination)
+        print('Spawn point %d -> %d: %.1f kJ over %.2f km' % (origin, destination, energy / 1000.0, length / 1000.0))
+        for i, (energy, length, path) in enumerate(model.candidate_routes(origin, destination, args.candidates)):
+            print('  route %d: %.1f kJ, %.2f km, %d segments' % (
+                i, energy / 1000.0, length / 1000.0, max(len(path) - 1, 0)))
+    else:
+        reachable = np.isfinite(lookup.energy) & (lookup.length > 0.0)
+        print('%s: %d spawn points, %d reachable pairs' % (
+            graph.graph['map'], len(lookup.energy), np.count_nonzero(reachable)))
+        per_km = lookup.energy_per_km()
+        for origin, destination in zip(*np.unravel_index(
+                np.argsort(np.where(reachable, per_km, np.inf), axis=None)[:5], per_km.shape)):
+            print('  %d -> %d: %.0f Wh/km over %.2f km' % (
+                origin, destination, per_km[origin, destination], lookup.length[origin, destination] / 1000.0))
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""
+Scenario farm for the data generator.
+
+Runs a list of (spawn, destination, agent, behavior, weather, seed) jobs on a
+pool of CARLA servers in parallel. Every job is executed as its own
+generate_data_with_automatic_control.py process bound to one free server,
+retried on failure or timeout, and the per-job outputs are merged into a
+single table tagged with the job metadata.
+
+Jobs are read from a JSON list, e.g.
+
+    [{"spawn": 300, "destination": 200, "agent": "Behavior", "behavior": "normal",
+      "weather": "ClearNoon", "seed": 2},
+     {"spawn": 12, "destination": 87, "agent": "Basic", "seed": 7}]
+
+and servers are given as HOST:PORT:TM_PORT:
+
+    python scenario_farm.py --jobs jobs.json -s 127.0.0.1:2000:8000 -s 127.0.0.1:2002:8002
+
+The job runner is pluggable, so the farm can be exercised against a local
+stub collector (--collector) or a stub runner without any CARLA server.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+COLLECTOR_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'generate_data_with_automatic_control.py')
+
+# Grace period given to a timed out collector to destroy its actors
+SHUTDOWN_GRACE = 30.0
+
+Job = collections.namedtuple(
+    'Job', ['job_id', 'spawn', 'destination', 'agent', 'behavior', 'weather', 'seed'])
+Server = collections.namedtuple('Server', ['host', 'port', 'tm_port'])
+JobResult = collections.namedtuple('JobResult', ['job', 'server', 'attempts', 'output', 'error'])
+
+
+def parse_server(text):
+    """Parses a HOST:PORT:TM_PORT server description"""
+    parts = text.split(':')
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError('expected HOST:PORT:TM_PORT, got %r' % text)
+    return Server(parts[0], int(parts[1]), int(parts[2]))
+
+
+def load_jobs(filename):
+    """Loads the job list from a JSON file"""
+    with open(filename) as json_file:
+        entries = json.load(json_file)
+    jobs = []
+    for job_id, entry in enumerate(entries):
+        jobs.append(Job(
+            job_id=job_id,
+            spawn=int(entry['spawn']),
+            destination=int(entry['destination']),
+            agent=entry.get('agent', 'Behavior'),
+            behavior=entry.get('behavior', 'normal'),
+            weather=entry.get('weather'),
+            seed=int(entry.get('seed', 2))))
+    return jobs
+
+
+def run_job_subprocess(job, server, output, timeout, collector=COLLECTOR_SCRIPT, extra_args=()):
+    """Runs one job in a collector process, raises if it fails or times out"""
+    command = [
+        sys.executable, collector,
+        '--host', server.host,
+        '--port', str(server.port),
+        '--tm-port', str(server.tm_port),
+        '--spawn-point', str(job.spawn),
+        '--destination-point', str(job.destination),
+        '--agent', job.agent,
+        '--behavior', job.behavior,
+        '--seed', str(job.seed),
+        '--output', output]
+    if job.weather:
+        command += ['--weather', job.weather]
+    command += list(extra_args)
+
+    log_filename = os.path.splitext(output)[0] + '.log'
+    with open(log_filename, 'w') as log_file:
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+        try:
+            returncode = process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            # SIGINT lets the collector run its cleanup and release the server
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(timeout=SHUTDOWN_GRACE)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            raise RuntimeError('job %d timed out after %.0f s' % (job.job_id, timeout))
+    if returncode != 0:
+        raise RuntimeError('job %d exited with code %d, see %s' % (job.job_id, returncode, log_filename))
+
+
+class ScenarioFarm(object):
+    """Dispatches jobs to a pool of CARLA servers"""
+
+    def __init__(self, servers, output_dir, runner=run_job_subprocess, retries=2, timeout=1800.0):
+        """Constructor method"""
+        if not servers:
+            raise ValueError('The farm needs at least one server')
+        self.servers = list(servers)
+        self.output_dir = output_dir
+        self.retries = retries
+        self.timeout = timeout
+        self._runner = runner
+        # Free servers, failed ones are put back at the end so the retry of a
+        # job preferably lands on a different instance.
+        self._free_servers = collections.deque(self.servers)
+        self._free_condition = threading.Condition()
+
+    def run(self, jobs):
+        """Runs all the jobs, returns one JobResult per job"""
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        with ThreadPoolExecutor(max_workers=len(self.servers)) as executor:
+            return list(executor.map(self._run_job, jobs))
+
+    def _acquire_server(self):
+        with self._free_condition:
+            while not self._free_servers:
+                self._free_condition.wait()
+            return self._free_servers.popleft()
+
+    def _release_server(self, server):
+        with self._free_condition:
+            self._free_servers.append(server)
+            self._free_condition.notify()
+
+    def _run_job(self, job):
+        output = os.path.join(self.output_dir, 'job_%04d.xlsx' % job.job_id)
+        error = None
+        for attempt in range(1, self.retries + 2):
+            server = self._acquire_server()
+            logging.info('job %d: attempt %d on %s:%d', job.job_id, attempt, server.host, server.port)
+            try:
+                if os.path.exists(output):
+                    os.remove(output)
+                self._runner(job, server, output, self.timeout)
+                if not os.path.exists(output):
+                    raise RuntimeError('job %d finished without writing %s' % (job.job_id, output))
+                return JobResult(job, server, attempt, output, None)
+            except Exception as exception:  # pylint: disable=broad-except
+                error = exception
+                logging.warning('job %d: attempt %d failed: %s', job.job_id, attempt, exception)
+            finally:
+                self._release_server(server)
+        return JobResult(job, None, self.retries + 1, None, str(error))
+
+
+def merge_outputs(results, filename):
+    """Merges the outputs of the successful jobs into one table tagged with the job metadata"""
+    frames = []
+    for result in results:
+        if result.output is None:
+            continue
+        data = pd.read_excel(result.output)
+        job = result.job
+        data.insert(0, 'Job', job.job_id)
+        data.insert(1, 'Spawn Point', job.spawn)
+        data.insert(2, 'Destination Point', job.destination)
+        data.insert(3, 'Agent', job.agent)
+        data.insert(4, 'Behavior', job.behavior)
+        data.insert(5, 'Weather', job.weather or '')
+        data.insert(6, 'Seed', job.seed)
+        data.insert(7, 'Server', '%s:%d' % (result.server.host, result.server.port))
+        data.insert(8, 'Attempts', result.attempts)
+        frames.append(data)
+    if not frames:
+        return None
+    merged = pd.concat(frames, ignore_index=True)
+    if filename.endswith('.csv'):
+        merged.to_csv(filename, index=False)
+    else:
+        merged.to_excel(filename, index=False, engine='openpyxl')
+    return merged
+
+
+def save_summary(results, filename):
+    """Writes one status row per job"""
+    rows = []
+    for result in results:
+        row = result.job._asdict()
+        row['server'] = '%s:%d' % (result.server.host, result.server.port) if result.server else ''
+        row['attempts'] = result.attempts
+        row['output'] = result.output or ''
+        row['error'] = result.error or ''
+        rows.append(row)
+    pd.DataFrame(rows).to_csv(filename, index=False)
+
+
+def main():
+    """Main method"""
+    argparser = argparse.ArgumentParser(description='CARLA scenario farm')
+    argparser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        dest='debug',
+        help='Print debug information')
+    argparser.add_argument(
+        '-j', '--jobs',
+        metavar='FILE',
+        required=True,
+        help='JSON file with the list of jobs')
+    argparser.add_argument(
+        '-s', '--server',
+        metavar='HOST:PORT:TM_PORT',
+        dest='servers',
+        action='append',
+        type=parse_server,
+        required=True,
+        help='CARLA server to use, repeat for every instance of the pool')
+    argparser.add_argument(
+        '--output-dir',
+        metavar='DIR',
+        default='farm_output',
+        help='Directory for the per-job outputs and logs (default: farm_output)')
+    argparser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        default='farm_output/merged.xlsx',
+        help='Merged output, .xlsx or .csv (default: farm_output/merged.xlsx)')
+    argparser.add_argument(
+        '--retries',
+        default=2,
+        type=int,
+        help='Number of retries of a failed job (default: 2)')
+    argparser.add_argument(
+        '--timeout',
+        default=1800.0,
+        type=float,
+        help='Timeout of a single job in seconds (default: 1800)')
+    argparser.add_argument(
+        '--collector',
+        metavar='SCRIPT',
+        default=COLLECTOR_SCRIPT,
+        help='Collector script run for every job (default: generate_data_with_automatic_control.py)')
+    argparser.add_argument(
+        'collector_args',
+        nargs=argparse.REMAINDER,
+        help='Extra arguments forwarded to the collector, after "--" (e.g. -- --fast)')
+    args = argparser.parse_args()
+
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=log_level)
+
+    extra_args = [x for x in args.collector_args if x != '--']
+
+    def runner(job, server, output, timeout):
+        run_job_subprocess(job, server, output, timeout, args.collector, extra_args)
+
+    jobs = load_jobs(args.jobs)
+    farm = ScenarioFarm(args.servers, args.output_dir, runner, args.retries, args.timeout)
+    results = farm.run(jobs)
+
+    save_summary(results, os.path.join(args.output_dir, 'summary.csv'))
+    merge_outputs(results, args.output)
+
+    failed = [x for x in results if x.error is not None]
+    print('%d/%d jobs succeeded' % (len(results) - len(failed), len(results)))
+    for result in failed:
+        print('  job %d failed: %s' % (result.job.job_id, result.error))
+
+
+if __name__ == '__main__':
+    main()
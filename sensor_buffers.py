@@ -0,0 +1,73 @@
+"""
+Fixed-size buffers written from sensor callbacks.
+"""
+
+import threading
+
+import numpy as np
+
+
+class CollisionHistory(object):
+    """
+    Collision intensity per frame of the last `size` frames.
+
+    The values live in a NumPy ring buffer that is stored twice back to back,
+    so the last n frames are always a contiguous slice: writing a collision is
+    O(1) and reading the history is a zero-copy view, however long the session
+    has been running.
+    """
+
+    def __init__(self, size=4000):
+        """Constructor method"""
+        self.size = size
+        self._buffer = np.zeros(2 * size)
+        self._head = None  # Newest frame covered by the buffer
+        self._lock = threading.Lock()
+
+    def add(self, frame, intensity):
+        """Accumulates the intensity of a collision that happened at a frame"""
+        with self._lock:
+            self._advance(frame)
+            if frame <= self._head - self.size:
+                return
+            slot = frame % self.size
+            self._buffer[slot] += intensity
+            self._buffer[slot + self.size] += intensity
+
+    def window(self, length, frame=None):
+        """
+        Read-only view of the intensities of the last `length` frames, oldest
+        first, ending at `frame` (or at the newest frame seen).
+        """
+        length = min(length, self.size)
+        with self._lock:
+            if frame is not None:
+                self._advance(frame)
+            if self._head is None:
+                view = self._buffer[:length]
+            else:
+                start = (self._head - length + 1) % self.size
+                view = self._buffer[start:start + length]
+        view = view.view()
+        view.flags.writeable = False
+        return view
+
+    def _advance(self, frame):
+        """Moves the head to a newer frame clearing the slots of the frames in between"""
+        if self._head is None:
+            self._head = frame
+            return
+        steps = frame - self._head
+        if steps <= 0:
+            return
+        if steps >= self.size:
+            self._buffer[:] = 0.0
+        else:
+            first = (self._head + 1) % self.size
+            end = first + steps
+            self._buffer[first:end] = 0.0
+            self._buffer[first + self.size:min(end + self.size, 2 * self.size)] = 0.0
+            if end > self.size:
+                # Wrapped around, the mirror of the first slots too
+                self._buffer[:end - self.size] = 0.0
+        self._head = frame
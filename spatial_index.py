@@ -0,0 +1,102 @@
+"""
+Spatial index of the vehicles of a world.
+
+The vehicle positions are read once per tick from the world snapshot into a
+NumPy array (no per-actor get_location() RPC) and radius / k-nearest queries
+are answered with a KD-tree, or a vectorized scan when there are only a few
+vehicles. The vehicle actor list itself is only re-fetched from the server
+when the set of actor ids of the snapshot changes, i.e. when actors are
+spawned or destroyed.
+"""
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# Below this number of vehicles a vectorized scan beats building a tree
+TREE_MIN_SIZE = 64
+
+# Position given to vehicles missing from the snapshot, far from everything
+# but finite so the tree can still be built
+FAR_AWAY = 1e9
+
+
+class VehicleIndex(object):
+    """Positions of the vehicles of a world at the last update"""
+
+    def __init__(self, world, actor_filter='vehicle.*'):
+        """Constructor method"""
+        self._world = world
+        self._actor_filter = actor_filter
+        self._snapshot_ids = None  # Actor ids of the snapshot the actor list matches
+        self._tree = None
+        self.actors = []
+        self.ids = np.empty(0, dtype=np.int64)
+        self.positions = np.empty((0, 3))
+
+    def __len__(self):
+        return len(self.actors)
+
+    def update(self, snapshot=None):
+        """Reads the positions of the vehicles from a world snapshot"""
+        if snapshot is None:
+            snapshot = self._world.get_snapshot()
+        # Ids, not the count, a destroyed and a spawned actor leave it unchanged
+        snapshot_ids = frozenset(x.id for x in snapshot)
+        if snapshot_ids != self._snapshot_ids:
+            self._refresh_actors()
+            self._snapshot_ids = snapshot_ids
+        for i, actor_id in enumerate(self.ids):
+            actor_snapshot = snapshot.find(int(actor_id))
+            if actor_snapshot is None:
+                # Destroyed, keep it out of every query and refresh next time
+                self.positions[i] = FAR_AWAY
+                self._snapshot_ids = None
+                continue
+            location = actor_snapshot.get_transform().location
+            self.positions[i, 0] = location.x
+            self.positions[i, 1] = location.y
+            self.positions[i, 2] = location.z
+        self._tree = None
+
+    def _refresh_actors(self):
+        self.actors = list(self._world.get_actors().filter(self._actor_filter))
+        self.ids = np.array([x.id for x in self.actors], dtype=np.int64)
+        self.positions = np.empty((len(self.actors), 3))
+
+    def _get_tree(self):
+        if self._tree is None and cKDTree is not None and len(self.actors) >= TREE_MIN_SIZE:
+            self._tree = cKDTree(self.positions)
+        return self._tree
+
+    def query_radius(self, point, radius):
+        """Returns (distances, indices) of the vehicles within radius of a point, nearest first"""
+        point = np.asarray(point, dtype=np.float64)
+        tree = self._get_tree()
+        if tree is not None:
+            indices = np.asarray(tree.query_ball_point(point, radius), dtype=np.int64)
+            distances = np.sqrt(np.sum((self.positions[indices] - point) ** 2, axis=1))
+        else:
+            distances = np.sqrt(np.sum((self.positions - point) ** 2, axis=1))
+            indices = np.flatnonzero(distances <= radius)
+            distances = distances[indices]
+        order = np.argsort(distances)
+        return distances[order], indices[order]
+
+    def query_nearest(self, point, k=1):
+        """Returns (distances, indices) of the k vehicles nearest to a point, nearest first"""
+        point = np.asarray(point, dtype=np.float64)
+        k = min(k, len(self.actors))
+        if k == 0:
+            return np.empty(0), np.empty(0, dtype=np.int64)
+        tree = self._get_tree()
+        if tree is not None:
+            distances, indices = tree.query(point, k)
+            return np.atleast_1d(distances), np.atleast_1d(indices)
+        distances = np.sqrt(np.sum((self.positions - point) ** 2, axis=1))
+        indices = np.argpartition(distances, k - 1)[:k]
+        order = np.argsort(distances[indices])
+        return distances[indices][order], indices[order]
@@ -0,0 +1,56 @@
+import argparse
+
+import numpy as np
+import pytest
+
+pytest.importorskip('carla')
+matplotlib = pytest.importorskip('matplotlib')
+matplotlib.use('Agg')
+
+import draw_spawnPoints  # noqa: E402
+
+
+def fake_waypoints(count=221):
+    """A straight two-lane road with count spawn points along it"""
+    n = 200
+    x = np.linspace(0.0, 1000.0, n)
+    spawn_points = np.zeros((count, 6))
+    spawn_points[:, 0] = np.linspace(0.0, 1000.0, count)
+    spawn_points[:, 1] = np.tile([0.0, 40.0], count)[:count]
+    return {
+        'x': np.concatenate([x, x]), 'y': np.concatenate([np.zeros(n), np.full(n, 40.0)]),
+        'z': np.zeros(2 * n), 'pitch': np.zeros(2 * n), 'yaw': np.zeros(2 * n),
+        'lane_width': np.full(2 * n, 3.5), 'road_id': np.repeat([1, 2], n).astype(np.int32),
+        'offsets': np.array([0, n, 2 * n]), 'spawn_points': spawn_points}
+
+
+@pytest.fixture
+def visualization(monkeypatch):
+    monkeypatch.setattr(draw_spawnPoints, 'load_waypoints', lambda map_name: fake_waypoints())
+    viz = draw_spawnPoints.MapVisualization(argparse.Namespace(map='Town01', host='localhost', port=2000))
+    yield viz
+    draw_spawnPoints.plt.close(viz.fig)
+
+
+def label_texts(ax):
+    return [x.get_text() for x in ax.texts]
+
+
+def test_each_label_drawn_once(visualization):
+    visualization.draw_roads()
+    visualization.draw_spawn_points(step=1)
+    texts = label_texts(visualization.ax)
+    assert texts
+    assert len(texts) == len(set(texts))
+    assert len(visualization.ax.texts) == len(visualization._labels)
+
+
+def test_labels_redone_once_on_zoom(visualization):
+    visualization.draw_roads()
+    visualization.draw_spawn_points(step=1)
+    visualization.ax.set_xlim(0.0, 200.0)
+    visualization.ax.set_ylim(-60.0, 20.0)
+    texts = label_texts(visualization.ax)
+    assert texts
+    assert len(texts) == len(set(texts))
+    assert len(visualization.ax.texts) == len(visualization._labels)
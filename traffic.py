@@ -0,0 +1,96 @@
+"""
+Background traffic for the data collectors.
+
+BackgroundTraffic populates the world of a CarlaSession with NPC vehicles
+driven by the traffic manager, so the hero is recorded in congestion instead
+of on empty roads:
+
+    traffic = BackgroundTraffic(session, hybrid_radius=70.0)
+    traffic.spawn(200, exclude=[hero_spawn_point], seed=2)
+    ...
+    traffic.destroy()
+
+All the vehicles are spawned and handed to the autopilot in a single batch
+(SpawnActor(...).then(SetAutopilot(FutureActor, True, tm_port))) and destroyed
+in a single batch. The traffic manager runs in hybrid physics mode: only the
+vehicles within hybrid_radius meters of the hero (the vehicle with role_name
+'hero') are simulated with full physics, the others are teleported along
+their paths, which keeps the server fast with hundreds of NPCs.
+"""
+
+import logging
+import random
+
+import carla
+
+import actor_batch
+
+NPC_FILTER = 'vehicle.*'
+DEFAULT_HYBRID_RADIUS = 70.0  # m
+LEADING_DISTANCE = 2.5  # m, distance kept by the NPCs to the vehicle in front
+
+
+class BackgroundTraffic(object):
+    """NPC vehicles driven by the traffic manager of a session"""
+
+    def __init__(self, session, hybrid_radius=DEFAULT_HYBRID_RADIUS, blueprint_filter=NPC_FILTER):
+        """Constructor method. A hybrid_radius of None disables hybrid physics."""
+        self.session = session
+        self.hybrid_radius = hybrid_radius
+        self.vehicles = []
+        # Two-wheelers do not behave well under the autopilot
+        self._blueprints = [
+            x for x in session.blueprints.filter(blueprint_filter)
+            if not x.has_attribute('number_of_wheels') or int(x.get_attribute('number_of_wheels')) == 4]
+        if not self._blueprints:
+            raise ValueError('no vehicle blueprint matches %r' % blueprint_filter)
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def spawn(self, count, exclude=(), seed=None):
+        """
+        Spawns up to count NPC vehicles on the map spawn points, skipping the
+        indices in exclude (the hero's), and returns how many were spawned.
+        """
+        rng = random.Random(seed)
+        tm = self.session.traffic_manager
+        if self.hybrid_radius is not None:
+            tm.set_hybrid_physics_mode(True)
+            tm.set_hybrid_physics_radius(self.hybrid_radius)
+        tm.set_global_distance_to_leading_vehicle(LEADING_DISTANCE)
+        if seed is not None:
+            tm.set_random_device_seed(seed)
+
+        excluded = set(exclude)
+        spawn_points = [x for i, x in enumerate(self.session.spawn_points) if i not in excluded]
+        rng.shuffle(spawn_points)
+        if count > len(spawn_points):
+            logging.warning('requested %d NPC vehicles, but only %d spawn points are free',
+                            count, len(spawn_points))
+        tm_port = tm.get_port()
+        commands = []
+        for transform in spawn_points[:count]:
+            blueprint = rng.choice(self._blueprints)
+            blueprint.set_attribute('role_name', 'autopilot')
+            if blueprint.has_attribute('color'):
+                blueprint.set_attribute('color', rng.choice(blueprint.get_attribute('color').recommended_values))
+            commands.append(actor_batch.SpawnActor(blueprint, transform).then(
+                carla.command.SetAutopilot(carla.command.FutureActor, True, tm_port)))
+
+        actors, errors = actor_batch.spawn_actors(self.session.client, self.session.world, commands)
+        if errors:
+            # Mostly spawn points blocked by another actor
+            logging.info('%d NPC vehicles could not be spawned', len(errors))
+        spawned = [x for x in actors if x is not None]
+        self.vehicles.extend(spawned)
+        # Let the new vehicles appear before the hero starts
+        self.session.tick()
+        return len(spawned)
+
+    def destroy(self):
+        """Destroys every NPC vehicle and turns hybrid physics back off"""
+        actor_batch.destroy_actors(self.session.client, self.vehicles)
+        self.vehicles = []
+        if self.hybrid_radius is not None:
+            self.session.traffic_manager.set_hybrid_physics_mode(False)